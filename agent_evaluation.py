@@ -1,9 +1,15 @@
 import copy
 import elo
+import json
+import math
+import multiprocessing
 import numpy as np
+import os
 import random
-from mcts import get_mcts_move, get_linear_default_policy
-from state import State, Move
+import sqlite3
+import time
+from mcts import get_mcts_move, get_linear_default_policy, MCTSSearcher, default_policy
+from state import State, Move, seed_random
 
 #Best Vanilla paramters for t=0.1 -> c=0.25
 #Best Linear paramters for t=0.1 -> c=1.0, depth=1300
@@ -35,7 +41,8 @@ class Agent:
     def get_state_value(self, state: State):
         raise NotImplementedError()
 
-    def setup(self):
+    def setup(self, seed=None):
+        """Called before every game, with a seed for the searches of the agent when the game has one"""
         pass
 
     def teardown(self):
@@ -45,74 +52,209 @@ class Agent:
         pass
 
 class MCTSAgent(Agent):
-    def __init__(self, name: str, c: float, t: float):
+    def __init__(self, name: str, c: float, t: float, workers: int = 1, max_rollouts: float = float('inf')):
         self.c = c
         self.t = t
+        self.workers = workers
+        self.max_rollouts = max_rollouts
+        self._searcher = MCTSSearcher(c=c)
+        #Seeds the searches split across processes, which do not go through the searcher
+        self._rng = random.Random()
         super().__init__(name)
 
+    def setup(self, seed=None):
+        self._searcher.reset(seed)
+        self._rng.seed(seed)
+
     def get_move(self, state: State):
-        return get_mcts_move(state, self.t, c=self.c)
+        if self.workers > 1:
+            return get_mcts_move(state, self.t, c=self.c, workers=self.workers, max_rollouts=self.max_rollouts, seed=self._rng.getrandbits(63))
+        return self._searcher.get_move(state, self.t, max_rollouts=self.max_rollouts)
 
     def get_state_value(self, state: State):
-        return get_mcts_move(state, self.t, c=self.c, return_value=True)[0]
+        if self.workers > 1:
+            return get_mcts_move(state, self.t, c=self.c, return_value=True, workers=self.workers, max_rollouts=self.max_rollouts, seed=self._rng.getrandbits(63))[0]
+        return self._searcher.get_value(state, self.t, max_rollouts=self.max_rollouts)[0]
 
 class MCTSLinearApproximationAgent(Agent):
-    def __init__(self, name: str, c: float, t: float, depth: int):
+    def __init__(self, name: str, c: float, t: float, depth: int, workers: int = 1, max_rollouts: float = float('inf')):
         self.c = c
         self.t = t
         self.depth = depth
+        self.workers = workers
+        self.max_rollouts = max_rollouts
         self._default_policy = get_linear_default_policy(depth)
+        self._searcher = MCTSSearcher(c=c, default_policy=self._default_policy)
+        self._rng = random.Random()
         super().__init__(name)
 
+    def setup(self, seed=None):
+        self._searcher.reset(seed)
+        self._rng.seed(seed)
+
     def get_move(self, state: State):
-        return get_mcts_move(state, self.t, c=self.c, default_policy=self._default_policy)
+        if self.workers > 1:
+            return get_mcts_move(state, self.t, c=self.c, default_policy=self._default_policy, workers=self.workers, max_rollouts=self.max_rollouts, seed=self._rng.getrandbits(63))
+        return self._searcher.get_move(state, self.t, max_rollouts=self.max_rollouts)
 
     def get_state_value(self, state: State):
-        return get_mcts_move(state, self.t, c=self.c, default_policy=self._default_policy, return_value=True)[0]
+        if self.workers > 1:
+            return get_mcts_move(state, self.t, c=self.c, default_policy=self._default_policy, return_value=True, workers=self.workers, max_rollouts=self.max_rollouts, seed=self._rng.getrandbits(63))[0]
+        return self._searcher.get_value(state, self.t, max_rollouts=self.max_rollouts)[0]
 
 class RandomAgent(Agent):
     def get_move(self, state: State):
         return random.choice(state.get_moves())
 
+def play_game(white: Agent, black: Agent, seed: int):
+    """Plays a game between two agents with the dice and the agents' searches seeded from seed, and returns the winner,
+    the number of turns in which a player moved and the seconds each agent spent per move"""
+    random.seed(seed)
+    seed_random(seed)
+    white.setup(seed)
+    black.setup(seed + 1)
+    agents = [white, black]
+    move_time = [0.0, 0.0]
+    n_moves = [0, 0]
+    plies = 0
+    after_roll = False
+    state = State()
+    while not state.game_ended():
+        if state.is_nature_turn():
+            move = random.choice(state.get_moves())
+            after_roll = True
+        else:
+            player = state.get_player_turn()
+            start_time = time.perf_counter()
+            move = agents[player].get_move(state)
+            move_time[player] += time.perf_counter() - start_time
+            n_moves[player] += 1
+            #A turn is counted at its first move
+            if after_roll:
+                plies += 1
+            after_roll = False
+        state.do_move(move)
+    white.teardown()
+    black.teardown()
+    return {"winner": state.get_winner(), "plies": plies,
+            "time_per_move": [move_time[player] / max(n_moves[player], 1) for player in [WHITE, BLACK]]}
+
+_worker_agents = None
+
+def _set_worker_agents(agents: list):
+    global _worker_agents
+    _worker_agents = agents
+
+def _play_scheduled_game(game: tuple):
+    (i, white_index, black_index, seed) = game
+    result = play_game(_worker_agents[white_index], _worker_agents[black_index], seed)
+    result.update({"game": i, "white": white_index, "black": black_index, "seed": seed})
+    return result
+
 class Tournament:
-    def __init__(self, agents: list):
+    """Plays games between random pairs of agents and rates them with Elo. The pairings and the seed of every game
+    follow from the seed of the tournament, and the ratings are updated in the order of the games, so a tournament gives
+    the same ratings whether its games are played in one process or many, as long as the agents are limited by rollouts
+    rather than time. Results are appended to a log as they arrive, from which a stopped tournament resumes"""
+    def __init__(self, agents: list, seed: int = 0):
         self.agents = agents
+        self.seed = seed
         self._elo = elo.setup(k_factor=100)
         self.ratings = [elo.Rating(1200) for _ in agents]
         self.n_games_played = [0 for _ in agents]
 
-    def _play_game(self, agent1_index: int, agent2_index: int):
-        assert agent1_index != agent2_index
-        agent1 = self.agents[agent1_index]
-        agent2 = self.agents[agent2_index]
-        state = State()
-        while not state.game_ended():
-            if state.is_nature_turn():
-                move = random.choice(state.get_moves())
-            elif state.get_player_turn() == WHITE:
-                move = agent1.get_move(state)
-            else:
-                assert state.get_player_turn() == BLACK
-                move = agent2.get_move(state)
-            state.do_move(move)
-        self.n_games_played[agent1_index] += 1
-        self.n_games_played[agent2_index] += 1
-        if state.get_winner() == WHITE:
-            (self.ratings[agent1_index], self.ratings[agent2_index]) = self._elo.rate_1vs1(self.ratings[agent1_index], self.ratings[agent2_index])
+    def schedule(self, n_games: int):
+        """Returns the game number, white's and black's agent indices and the seed of each game"""
+        rng = random.Random(self.seed)
+        n_agents = len(self.agents)
+        games = []
+        for i in range(n_games):
+            agent1_index = rng.randint(0, n_agents - 1)
+            agent2_index = rng.choice([j for j in range(n_agents) if j != agent1_index])
+            games.append((i, agent1_index, agent2_index, rng.getrandbits(63)))
+        return games
+
+    def _rate(self, result: dict):
+        (white_index, black_index) = (result["white"], result["black"])
+        self.n_games_played[white_index] += 1
+        self.n_games_played[black_index] += 1
+        if result["winner"] == WHITE:
+            (self.ratings[white_index], self.ratings[black_index]) = self._elo.rate_1vs1(self.ratings[white_index], self.ratings[black_index])
         else:
-            (self.ratings[agent2_index], self.ratings[agent1_index]) = self._elo.rate_1vs1(self.ratings[agent2_index], self.ratings[agent1_index])
+            (self.ratings[black_index], self.ratings[white_index]) = self._elo.rate_1vs1(self.ratings[black_index], self.ratings[white_index])
 
-    def do_tournament(self, n_games: int):
+    def _load_results(self, log_path: str, games: list):
+        """Returns the results in the log that belong to the scheduled games, checking that the log was written by the
+        same tournament"""
+        results = {}
+        if log_path is None or not os.path.exists(log_path):
+            return results
+        with open(log_path) as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                try:
+                    result = json.loads(line)
+                except ValueError:
+                    #The last line of a killed run may be cut short
+                    continue
+                i = result["game"]
+                if i >= len(games):
+                    continue
+                (_, white_index, black_index, seed) = games[i]
+                if (result["white"], result["black"], result["seed"]) != (white_index, black_index, seed) or result["agents"] != [str(self.agents[white_index]), str(self.agents[black_index])]:
+                    raise ValueError("{} was written by a different tournament".format(log_path))
+                results[i] = result
+        return results
+
+    def do_tournament(self, n_games: int, workers: int = 1, log_path: str = None):
+        """Plays n_games games in as many processes as workers and rates the agents. With a log path, every result is
+        appended to it as one line of JSON and the games already in it are not played again"""
+        _check_pool_agents(self.agents, workers)
+        self.ratings = [elo.Rating(1200) for _ in self.agents]
+        self.n_games_played = [0 for _ in self.agents]
+        games = self.schedule(n_games)
+        results = self._load_results(log_path, games)
+        remaining = [game for game in games if game[0] not in results]
         self.print_status()
-        for i in range(n_games):
-            print("Game {}/{}".format(i+1, n_games))
-
-            n_agents = len(self.agents)
-            agent1_index = random.randint(0, n_agents - 1)
-            agent2_index = random.choice([i for i in range(n_agents) if i != agent1_index])
-            self._play_game(agent1_index, agent2_index)
-            if i % 50 == 0:
-                self.print_status
+        log = None
+        if log_path is not None:
+            log = open(log_path, "a+")
+            #Start on a new line after a line that a killed run left unfinished
+            if log.tell() > 0:
+                log.seek(log.tell() - 1)
+                if log.read(1) != "\n":
+                    log.write("\n")
+        process_pool = None
+        try:
+            if workers > 1:
+                process_pool = multiprocessing.Pool(workers, initializer=_set_worker_agents, initargs=(self.agents,))
+                played = process_pool.imap_unordered(_play_scheduled_game, remaining)
+            else:
+                _set_worker_agents(self.agents)
+                played = map(_play_scheduled_game, remaining)
+            n_rated = 0
+            for result in played:
+                result["agents"] = [str(self.agents[result["white"]]), str(self.agents[result["black"]])]
+                results[result["game"]] = result
+                if log is not None:
+                    log.write(json.dumps(result) + "\n")
+                    log.flush()
+                print("Game {}/{}: {} beat {}".format(len(results), n_games, *(result["agents"] if result["winner"] == WHITE else result["agents"][::-1])))
+                #Rate the games in order, each as soon as the games before it are in
+                while n_rated < n_games and n_rated in results:
+                    self._rate(results[n_rated])
+                    n_rated += 1
+                    if n_rated % 50 == 0:
+                        self.print_status()
+            while n_rated < n_games and n_rated in results:
+                self._rate(results[n_rated])
+                n_rated += 1
+        finally:
+            if process_pool is not None:
+                process_pool.terminate()
+            if log is not None:
+                log.close()
         self.print_status()
     
     def print_status(self):
@@ -121,6 +263,183 @@ class Tournament:
             n_games_played = self.n_games_played[i]
             print("{} - {} - {} games played".format(agent, int(rating), n_games_played))
 
+def _check_pool_agents(agents: list, workers: int):
+    """Raises ValueError if games would be played in a process pool by an agent that searches in processes of its own,
+    which the daemonic pool processes cannot start"""
+    if workers > 1:
+        for agent in agents:
+            if getattr(agent, "workers", 1) > 1:
+                raise ValueError("{} searches with {} workers, which cannot run in games played with {} workers".format(agent, agent.workers, workers))
+
+def _play_games(agents: list, games: list, workers: int = 1):
+    """Yields the results of the scheduled games in the order they were scheduled, playing them in as many processes as
+    workers. Closing the generator stops the games still being played"""
+    if workers > 1:
+        process_pool = multiprocessing.Pool(workers, initializer=_set_worker_agents, initargs=(agents,))
+        try:
+            yield from process_pool.imap(_play_scheduled_game, games)
+        finally:
+            process_pool.terminate()
+    else:
+        _set_worker_agents(agents)
+        yield from map(_play_scheduled_game, games)
+
+def expected_score(elo_difference: float):
+    """Returns the probability that a player rated elo_difference above their opponent wins"""
+    return 1.0 / (1.0 + 10.0 ** (-elo_difference / 400.0))
+
+class SPRT:
+    """Sequential probability ratio test between the hypotheses that a player is elo0 or elo1 Elo stronger than their
+    opponent, given the outcomes of their games one at a time. alpha and beta are the probabilities of accepting elo1
+    when elo0 holds and of accepting elo0 when elo1 holds"""
+    def __init__(self, elo0: float = -50.0, elo1: float = 50.0, alpha: float = 0.05, beta: float = 0.05):
+        assert elo0 < elo1
+        self.p0 = expected_score(elo0)
+        self.p1 = expected_score(elo1)
+        self.lower = math.log(beta / (1.0 - alpha))
+        self.upper = math.log((1.0 - beta) / alpha)
+        self.wins = 0
+        self.losses = 0
+
+    @property
+    def llr(self):
+        """Log likelihood ratio of elo1 against elo0"""
+        return self.wins * math.log(self.p1 / self.p0) + self.losses * math.log((1.0 - self.p1) / (1.0 - self.p0))
+
+    def update(self, won: bool):
+        if won:
+            self.wins += 1
+        else:
+            self.losses += 1
+
+    def decision(self):
+        """Returns 1 once elo1 is accepted, 0 once elo0 is accepted and None while the test goes on"""
+        llr = self.llr
+        if llr >= self.upper:
+            return 1
+        if llr <= self.lower:
+            return 0
+        return None
+
+def play_match(agent1: Agent, agent2: Agent, max_games: int = 1000, seed: int = 0, workers: int = 1, sprt: SPRT = None):
+    """Plays agent1 against agent2 until the SPRT decides which hypothesis about agent1's strength holds, or for
+    max_games games. The agents alternate colours and each pair of games is played with the same seed, which makes the
+    dice of the two games alike. Results are taken in the order of the games, so the outcome is the same for any number
+    of workers. Returns the wins and losses of agent1, the log likelihood ratio and the decision of the test"""
+    _check_pool_agents([agent1, agent2], workers)
+    sprt = SPRT() if sprt is None else sprt
+    rng = random.Random(seed)
+    games = []
+    for i in range(0, max_games, 2):
+        game_seed = rng.getrandbits(63)
+        games.append((i, 0, 1, game_seed))
+        games.append((i + 1, 1, 0, game_seed))
+    played = _play_games([agent1, agent2], games[:max_games], workers)
+    try:
+        for result in played:
+            sprt.update(result["winner"] == (WHITE if result["white"] == 0 else BLACK))
+            if sprt.decision() is not None:
+                break
+    finally:
+        played.close()
+    return {"wins": sprt.wins, "losses": sprt.losses, "llr": sprt.llr, "decision": sprt.decision()}
+
+def race(agents: list, n_survivors: int = 1, games_per_round: int = 8, seed: int = 0, workers: int = 1):
+    """Successive halving over agents: in every round the remaining agents are paired at random, each pair plays
+    games_per_round games, and the half of the agents with the lowest share of wins over all their games so far is
+    dropped. The number of games per round doubles, so most games are played between the strongest agents. Returns the
+    agents with their wins and games, best first, followed by the dropped agents in reverse order of elimination"""
+    _check_pool_agents(agents, workers)
+    rng = random.Random(seed)
+    wins = [0 for _ in agents]
+    n_games = [0 for _ in agents]
+    remaining = list(range(len(agents)))
+    dropped = []
+    round_games = games_per_round
+    score = lambda i: wins[i] / max(n_games[i], 1)
+    while len(remaining) > n_survivors:
+        order = remaining[:]
+        rng.shuffle(order)
+        if len(order) % 2 == 1:
+            order.append(rng.choice(order[:-1]))
+        games = []
+        for k in range(0, len(order), 2):
+            for g in range(0, round_games, 2):
+                game_seed = rng.getrandbits(63)
+                games.append((len(games), order[k], order[k + 1], game_seed))
+                games.append((len(games), order[k + 1], order[k], game_seed))
+        for result in _play_games(agents, games, workers):
+            winner = result["white"] if result["winner"] == WHITE else result["black"]
+            loser = result["black"] if result["winner"] == WHITE else result["white"]
+            wins[winner] += 1
+            n_games[winner] += 1
+            n_games[loser] += 1
+        remaining.sort(key=score, reverse=True)
+        n_kept = max(n_survivors, (len(remaining) + 1) // 2)
+        dropped = remaining[n_kept:] + dropped
+        remaining = remaining[:n_kept]
+        print("Kept {} agents, best {} with {}/{} wins".format(n_kept, agents[remaining[0]], wins[remaining[0]], n_games[remaining[0]]))
+        round_games *= 2
+    return [(agents[i], wins[i], n_games[i]) for i in remaining + dropped]
+
+def describe_policy(policy):
+    """Returns a string naming a default policy and its settings, to tell apart values searched with different ones. The
+    weights of a linear policy are not part of it, policies with other weights than the built in ones need a name"""
+    settings = [type(policy).__name__]
+    for name in ["depth", "n_playouts", "stop_at_race"]:
+        if hasattr(policy, name):
+            settings.append("{}={}".format(name, getattr(policy, name)))
+    if getattr(policy, "bearoff", None) is not None:
+        settings.append("bearoff")
+    return " ".join(settings)
+
+class ReferenceStore:
+    """Values of positions estimated by long MCTS searches, kept in an SQLite database at path. A value is stored for each
+    position, exploration constant and default policy along with the number of rollouts behind it. Asking for more
+    rollouts than are stored runs a search for the difference only and merges it into the stored value, weighting each
+    search by its rollouts as the root parallel search does. The merge is a single SQL statement, so several processes
+    may refine the same values at once"""
+    def __init__(self, path: str):
+        self.path = path
+        self._connection = sqlite3.connect(path, timeout=600.0, isolation_level=None)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("""CREATE TABLE IF NOT EXISTS reference_values (position BLOB, c REAL, policy TEXT,
+                                    rollouts INTEGER, white_value REAL, black_value REAL, PRIMARY KEY (position, c, policy))""")
+
+    def __reduce__(self):
+        return (ReferenceStore, (self.path,))
+
+    def close(self):
+        self._connection.close()
+
+    def lookup(self, state: State, c: float = 0.25, policy_name: str = None):
+        """Returns the stored rollouts and values of white and black for state, or None"""
+        row = self._connection.execute("SELECT rollouts, white_value, black_value FROM reference_values WHERE position = ? AND c = ? AND policy = ?",
+                                       (state.position_key(), c, policy_name or describe_policy(default_policy))).fetchone()
+        return None if row is None else (row[0], (row[1], row[2]))
+
+    def add(self, state: State, rollouts: int, value: tuple, c: float = 0.25, policy_name: str = None):
+        """Merges the values of white and black found by a search of rollouts rollouts into those stored for state"""
+        self._connection.execute("""INSERT INTO reference_values VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT (position, c, policy) DO UPDATE SET
+                                    white_value = (white_value * rollouts + excluded.white_value * excluded.rollouts) / (rollouts + excluded.rollouts),
+                                    black_value = (black_value * rollouts + excluded.black_value * excluded.rollouts) / (rollouts + excluded.rollouts),
+                                    rollouts = rollouts + excluded.rollouts""",
+                                 (state.position_key(), c, policy_name or describe_policy(default_policy), rollouts, value[0], value[1]))
+
+    def get_value(self, state: State, rollouts: int, c: float = 0.25, default_policy=default_policy, policy_name: str = None, workers: int = 1):
+        """Returns the values of white and black for state from at least rollouts rollouts, searching only for those
+        that are not stored yet. A value refined this way is the average of the values found by independent searches,
+        each weighted by its rollouts, rather than the value of one search of all the rollouts: every search grows its
+        own tree from the root, like the workers of a root parallel search"""
+        policy_name = policy_name or describe_policy(default_policy)
+        stored = self.lookup(state, c, policy_name)
+        stored_rollouts = 0 if stored is None else stored[0]
+        if stored_rollouts < rollouts:
+            value = get_mcts_move(state, float('inf'), c=c, return_value=True, max_rollouts=rollouts - stored_rollouts, default_policy=default_policy, workers=workers)
+            self.add(state, rollouts - stored_rollouts, value, c, policy_name)
+            stored = self.lookup(state, c, policy_name)
+        return stored[1]
+
 class Evaluator: 
     def __init__(self, states: State, values: float):
         self.state_values = values
@@ -144,13 +463,14 @@ class Evaluator:
         for (i, agent) in enumerate(agents):
             print("{} {:.4f}".format(agent, scores[i]))
             
-random.seed(1)
-states = [State()] + [get_random_non_starting_state() for _ in range(10)]
-e = Evaluator(states, 
-              [0.5] + [get_mcts_move(states[i], 200000, return_value=True, max_rollouts=50000, verbose=True)[0] for i in range(1, len(states))])
-agents = []
-for c in np.linspace(0.0, 3.5, 10, endpoint=True):
-    for depth in np.arange(0, 80, 10):
-        agents.append(MCTSLinearApproximationAgent("Linear MCTS {:.4f}-{}".format(c, depth), c, 0.1, depth))
-agents.append(MCTSAgent("MCTS", 1.00, 0.1))
-e.evaluate_agents(agents)
\ No newline at end of file
+if __name__ == "__main__":
+    random.seed(1)
+    states = [State()] + [get_random_non_starting_state() for _ in range(10)]
+    store = ReferenceStore("reference_values.db")
+    e = Evaluator(states, [0.5] + [store.get_value(states[i], 50000)[0] for i in range(1, len(states))])
+    agents = []
+    for c in np.linspace(0.0, 3.5, 10, endpoint=True):
+        for depth in np.arange(0, 80, 10):
+            agents.append(MCTSLinearApproximationAgent("Linear MCTS {:.4f}-{}".format(c, depth), c, 0.1, depth))
+    agents.append(MCTSAgent("MCTS", 1.00, 0.1))
+    e.evaluate_agents(agents)
\ No newline at end of file
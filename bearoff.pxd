@@ -0,0 +1,48 @@
+# One-sided bear-off database. A position is the number of checkers, 0 to 15 in total, that need a die showing 1 to 6 to
+# be borne off. The lookups are inline so that State can stop its playouts at a bear-off without importing this module.
+
+cdef enum:
+    N_BEAROFF_POSITIONS = 54264
+
+ctypedef struct BearoffTable:
+    #The distribution of the number of rolls needed to bear off position i is stored in data[offsets[i]:offsets[i + 1]]
+    #as probabilities scaled to 65535, starting with the probability of needing first[i] rolls
+    const unsigned int *offsets
+    const unsigned char *first
+    const unsigned short *data
+    unsigned int binomial[21][7]
+
+cdef inline unsigned int bearoff_index(const BearoffTable *table, const int *counts) noexcept nogil:
+    """Returns the index of the position with counts[d] checkers needing a die showing d + 1"""
+    cdef unsigned int index = 0
+    cdef int d, total = 0
+    for d in range(6):
+        total += counts[d]
+        index += table.binomial[total + d][d + 1]
+    return index
+
+cdef inline double bearoff_win_probability(const BearoffTable *table, unsigned int on_roll, unsigned int other) noexcept nogil:
+    """Returns the probability that the player about to roll from position on_roll bears off before the other player"""
+    cdef unsigned int i
+    cdef unsigned int j = table.offsets[other]
+    cdef unsigned int end_j = table.offsets[other + 1]
+    cdef int k = table.first[on_roll]
+    cdef int k_other = table.first[other]
+    cdef double other_before = 0.0
+    cdef double p = 0.0
+    #The player on roll wins by finishing on their kth roll if the other player needs k rolls or more
+    for i in range(table.offsets[on_roll], table.offsets[on_roll + 1]):
+        while k_other < k and j < end_j:
+            other_before += table.data[j]
+            j += 1
+            k_other += 1
+        p += table.data[i] * (65535.0 - other_before)
+        k += 1
+    return p / (65535.0 * 65535.0)
+
+cdef class BearoffDatabase:
+    cdef BearoffTable table
+    cdef readonly object path
+    cdef object _offsets, _first, _data
+
+    cdef unsigned int _index(self, object counts) except *
@@ -0,0 +1,219 @@
+# cython: profile=False
+cimport cython
+from libc.stdlib cimport malloc, free
+from libc.math cimport INFINITY
+import numpy as np
+
+cdef int MAX_ROLLS = 192
+cdef unsigned int MAGIC = 0x4F424742
+cdef unsigned int VERSION = 1
+cdef int HEADER_SIZE = 16
+
+cdef void _init_binomial(BearoffTable *table) noexcept nogil:
+    cdef int n, k
+    for n in range(21):
+        table.binomial[n][0] = 1
+        for k in range(1, 7):
+            table.binomial[n][k] = 0 if n == 0 else table.binomial[n - 1][k - 1] + table.binomial[n - 1][k]
+
+cdef class _Generator:
+    """Works out, for every one-sided position, the play of each roll that minimises the expected number of rolls left
+    and the resulting distribution of the number of rolls needed. Positions are solved in order of increasing pip count,
+    since every move lowers it. The moves are those of State: a checker is borne off only by a die showing exactly its
+    distance, and a turn ends once no die left can be played"""
+    cdef BearoffTable table
+    cdef double *expected
+    cdef float *distributions
+
+    def __cinit__(self):
+        _init_binomial(&self.table)
+        self.expected = <double *>malloc(N_BEAROFF_POSITIONS * sizeof(double))
+        self.distributions = <float *>malloc(N_BEAROFF_POSITIONS * MAX_ROLLS * sizeof(float))
+        if self.expected == NULL or self.distributions == NULL:
+            raise MemoryError()
+
+    def __dealloc__(self):
+        free(self.expected)
+        free(self.distributions)
+
+    cdef void _search(self, int *counts, int *dice, int n_dice, bint doubles, int max_point, double *best, unsigned int *best_index) noexcept nogil:
+        """Plays the dice in every way from counts and keeps the reachable position with the lowest expected number of
+        rolls. Moves with equal dice are only tried in order of non-increasing source point, which reaches the same
+        positions with fewer sequences"""
+        cdef int k, n, point
+        cdef bint can_move = False
+        cdef unsigned int index
+        for k in range(n_dice):
+            n = dice[k]
+            if k > 0 and n == dice[k - 1]:
+                continue
+            for point in range(n - 1, 6):
+                if counts[point] == 0:
+                    continue
+                can_move = True
+                if point > max_point:
+                    continue
+                counts[point] -= 1
+                if point >= n:
+                    counts[point - n] += 1
+                dice[k], dice[n_dice - 1] = dice[n_dice - 1], dice[k]
+                self._search(counts, dice, n_dice - 1, doubles, point if doubles else 5, best, best_index)
+                dice[k], dice[n_dice - 1] = dice[n_dice - 1], dice[k]
+                if point >= n:
+                    counts[point - n] -= 1
+                counts[point] += 1
+        if not can_move:
+            index = bearoff_index(&self.table, counts)
+            if self.expected[index] < best[0]:
+                best[0] = self.expected[index]
+                best_index[0] = index
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    @cython.cdivision(True)
+    cdef void _solve(self, int *counts) noexcept nogil:
+        cdef unsigned int index = bearoff_index(&self.table, counts)
+        cdef float *distribution = &self.distributions[index * MAX_ROLLS]
+        cdef int i, j, k, n_dice
+        cdef int dice[4]
+        cdef double p, best, stay, total
+        cdef unsigned int best_index
+        cdef unsigned int successors[21]
+        cdef double probabilities[21]
+        cdef int n_successors = 0
+        for k in range(MAX_ROLLS):
+            distribution[k] = 0.0
+        if index == 0:
+            self.expected[index] = 0.0
+            distribution[0] = 1.0
+            return
+        stay = 0.0
+        total = 0.0
+        #Rolls that cannot be played leave the position as it is
+        self.expected[index] = INFINITY
+        for i in range(1, 7):
+            for j in range(i, 7):
+                p = (1.0 if i == j else 2.0) / 36.0
+                n_dice = 4 if i == j else 2
+                dice[0] = i
+                dice[1] = j
+                dice[2] = i
+                dice[3] = i
+                best = INFINITY
+                best_index = index
+                self._search(counts, dice, n_dice, i == j, 5, &best, &best_index)
+                if best_index == index:
+                    stay += p
+                else:
+                    successors[n_successors] = best_index
+                    probabilities[n_successors] = p
+                    n_successors += 1
+                    total += p * self.expected[best_index]
+        self.expected[index] = (1.0 + total) / (1.0 - stay)
+        for k in range(1, MAX_ROLLS):
+            p = stay * distribution[k - 1]
+            for i in range(n_successors):
+                p += probabilities[i] * self.distributions[successors[i] * MAX_ROLLS + k - 1]
+            distribution[k] = p
+        #Needing MAX_ROLLS rolls or more is counted as needing the last one
+        p = 0.0
+        for k in range(MAX_ROLLS - 1):
+            p += distribution[k]
+        distribution[MAX_ROLLS - 1] = max(0.0, 1.0 - p)
+
+    def run(self):
+        cdef int counts[6]
+        cdef int d
+        cdef list positions = []
+        for c0 in range(16):
+            for c1 in range(16 - c0):
+                for c2 in range(16 - c0 - c1):
+                    for c3 in range(16 - c0 - c1 - c2):
+                        for c4 in range(16 - c0 - c1 - c2 - c3):
+                            for c5 in range(16 - c0 - c1 - c2 - c3 - c4):
+                                positions.append((c0 + 2 * c1 + 3 * c2 + 4 * c3 + 5 * c4 + 6 * c5, (c0, c1, c2, c3, c4, c5)))
+        positions.sort()
+        for (_, position) in positions:
+            for d in range(6):
+                counts[d] = position[d]
+            self._solve(counts)
+        return np.asarray(<float [:N_BEAROFF_POSITIONS, :MAX_ROLLS]>self.distributions).copy()
+
+def generate_bearoff_database(path):
+    """Solves every one-sided bear-off position of up to 15 checkers and writes the distributions of the number of rolls
+    needed to path, for BearoffDatabase to map into memory. The probabilities are stored as 16 bit integers summing to
+    65535, without the leading and trailing bins that round to zero"""
+    distributions = _Generator().run().astype(np.float64)
+    distributions /= distributions.sum(axis=1, keepdims=True)
+    scaled = distributions * 65535.0
+    counts = np.floor(scaled).astype(np.int64)
+    #Hand the units lost to rounding down to the largest remainders so that every distribution sums to 65535
+    deficit = 65535 - counts.sum(axis=1)
+    order = np.argsort(counts - scaled, axis=1, kind='stable')
+    rows = np.repeat(np.arange(len(counts)), deficit)
+    columns = order[rows, np.concatenate([np.arange(k) for k in deficit])]
+    np.add.at(counts, (rows, columns), 1)
+    nonzero = counts > 0
+    first = np.argmax(nonzero, axis=1)
+    last = MAX_ROLLS - np.argmax(nonzero[:, ::-1], axis=1)
+    offsets = np.zeros(N_BEAROFF_POSITIONS + 1, dtype=np.uint32)
+    offsets[1:] = np.cumsum(last - first)
+    data = np.concatenate([counts[i, first[i]:last[i]] for i in range(N_BEAROFF_POSITIONS)]).astype(np.uint16)
+    with open(path, 'wb') as f:
+        f.write(np.asarray([MAGIC, VERSION, N_BEAROFF_POSITIONS, len(data)], dtype='<u4').tobytes())
+        f.write(offsets.astype('<u4').tobytes())
+        f.write(data.astype('<u2').tobytes())
+        f.write(first.astype(np.uint8).tobytes())
+
+cdef class BearoffDatabase:
+    """One-sided bear-off database written by generate_bearoff_database and mapped into memory. Gives the exact probability
+    of winning a position where both players have all their checkers in their home board, assuming each player plays to
+    bear off in as few rolls as possible on average"""
+    def __init__(self, path):
+        cdef const unsigned int [::1] offsets
+        cdef const unsigned char [::1] first
+        cdef const unsigned short [::1] data
+        header = np.fromfile(path, dtype='<u4', count=4)
+        if len(header) != 4 or header[0] != MAGIC or header[1] != VERSION or header[2] != N_BEAROFF_POSITIONS:
+            raise ValueError("{} is not a bear-off database".format(path))
+        self.path = path
+        self._offsets = np.memmap(path, dtype='<u4', mode='r', offset=HEADER_SIZE, shape=(N_BEAROFF_POSITIONS + 1,))
+        self._data = np.memmap(path, dtype='<u2', mode='r', offset=HEADER_SIZE + 4 * (N_BEAROFF_POSITIONS + 1), shape=(header[3],))
+        self._first = np.memmap(path, dtype=np.uint8, mode='r', offset=HEADER_SIZE + 4 * (N_BEAROFF_POSITIONS + 1) + 2 * header[3], shape=(N_BEAROFF_POSITIONS,))
+        offsets = self._offsets
+        first = self._first
+        data = self._data
+        self.table.offsets = &offsets[0]
+        self.table.first = &first[0]
+        self.table.data = &data[0]
+        _init_binomial(&self.table)
+
+    def __reduce__(self):
+        return (BearoffDatabase, (self.path,))
+
+    def __len__(self):
+        return N_BEAROFF_POSITIONS
+
+    cdef unsigned int _index(self, object counts) except *:
+        cdef int c[6]
+        cdef int d
+        if len(counts) != 6 or sum(counts) > 15 or min(counts) < 0:
+            raise ValueError("Expected the number of checkers, 15 at most, needing each die from 1 to 6")
+        for d in range(6):
+            c[d] = counts[d]
+        return bearoff_index(&self.table, c)
+
+    def get_distribution(self, counts):
+        """Returns the probabilities of needing 0, 1, 2, ... rolls to bear off the position with counts[d] checkers
+        needing a die showing d + 1"""
+        cdef unsigned int index = self._index(counts)
+        distribution = np.zeros(self.table.first[index] + self.table.offsets[index + 1] - self.table.offsets[index])
+        distribution[self.table.first[index]:] = self._data[self.table.offsets[index]:self.table.offsets[index + 1]]
+        return distribution / 65535.0
+
+    def win_probability(self, on_roll, other):
+        """Returns the probability that the player about to roll from counts on_roll bears off before the other player"""
+        return bearoff_win_probability(&self.table, self._index(on_roll), self._index(other))
+
+def load_bearoff_database(path):
+    return BearoffDatabase(path)
@@ -1,12 +1,179 @@
-from state import State
+from state import State, get_roll_move, seed_random
 from mcts import get_mcts_move, get_linear_default_policy
+from utils import state_to_vector
+import argparse
+import copy
+import json
+import numpy as np
+import platform
 import random
+import sys
 import time
 
-if __name__ == "__main__":
-    random.seed(1)
+#Fixed positions to benchmark from: white's and black's pieces on each point, pieces on the bar and borne off, and the
+#opening roll that starts the game, where a higher first die gives white the turn
+CORPUS = {
+    "opening": (
+        [0, 0, 0, 0, 0, 5, 0, 3, 0, 0, 0, 0, 5, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 2],
+        [2, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 5, 0, 0, 0, 0, 3, 0, 5, 0, 0, 0, 0, 0],
+        [0, 0], [0, 0], (3, 1)),
+    "middle": (
+        [0, 4, 7, 2, 0, 0, 0, 0, 0, 0, 0, 0, 1, 0, 0, 0, 1, 0, 0, 0, 0, 0, 0, 0],
+        [1, 0, 0, 0, 1, 0, 0, 0, 0, 2, 0, 0, 0, 0, 1, 0, 0, 0, 0, 0, 2, 4, 4, 0],
+        [0, 0], [0, 0], (2, 4)),
+    "contact": (
+        [5, 2, 4, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 1, 0, 0, 1, 0, 0, 1, 0, 0],
+        [0, 0, 0, 1, 0, 0, 0, 0, 1, 0, 0, 1, 0, 0, 1, 0, 0, 1, 0, 0, 2, 0, 0, 7],
+        [1, 1], [0, 0], (4, 2)),
+    "race": (
+        [11, 1, 0, 0, 0, 0, 0, 0, 0, 0, 1, 0, 0, 0, 0, 0, 0, 0, 1, 0, 1, 0, 0, 0],
+        [0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 4, 11],
+        [0, 0], [0, 0], (5, 2)),
+    "bearoff": (
+        [4, 2, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0],
+        [0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 1, 4, 7],
+        [0, 0], [9, 3], (6, 1)),
+}
+
+def load_position(name):
+    """Returns the corpus position name with its opening roll played, so that the player to move has dice to play"""
+    (white, black, bar, beared_off, (i, j)) = CORPUS[name]
     state = State()
-    while state.is_nature_turn():
-        state.do_move(random.choice(state.get_moves()))
-    #get_mcts_move(state, 20, verbose=True, default_policy=get_linear_default_policy(1300))
-    get_mcts_move(state, 20, verbose=True)
+    state.debug_reset_board(np.asarray([white, black], dtype=np.int8), np.asarray(bar, dtype=np.int8), np.asarray(beared_off, dtype=np.int8))
+    state.do_move(get_roll_move(i, j))
+    return state
+
+def rate(function, duration):
+    """Calls function, which does some units of work and returns how many, for at least duration seconds and returns
+    the units per second"""
+    units = 0
+    start = time.perf_counter()
+    while True:
+        units += function()
+        elapsed = time.perf_counter() - start
+        if elapsed >= duration:
+            return units / elapsed
+
+def bench_copy(state):
+    def run():
+        for _ in range(1000):
+            copy.copy(state)
+        return 1000
+    return run
+
+def bench_movement_moves(state):
+    def run():
+        for _ in range(1000):
+            state.get_movement_moves()
+        return 1000
+    return run
+
+def bench_do_move(state):
+    #Replays the same random game, so every run applies the same moves
+    random.seed(1)
+    moves = []
+    s = copy.copy(state)
+    while not s.game_ended():
+        move = random.choice(s.get_moves())
+        moves.append(move)
+        s.do_move(move)
+    def run():
+        s = copy.copy(state)
+        for move in moves:
+            s.do_move(move)
+        return len(moves)
+    return run
+
+def bench_play_game_to_end(state):
+    def run():
+        for _ in range(100):
+            copy.copy(state).play_game_to_end()
+        return 100
+    return run
+
+def bench_state_to_vector(state):
+    def run():
+        for _ in range(1000):
+            state_to_vector(state)
+        return 1000
+    return run
+
+def bench_linear_policy(state):
+    policy = get_linear_default_policy(10)
+    def run():
+        for _ in range(100):
+            policy(state)
+        return 100
+    return run
+
+def bench_mcts(rollouts):
+    def bench(state):
+        def run():
+            get_mcts_move(state, float('inf'), max_rollouts=rollouts, seed=1)
+            return rollouts
+        return run
+    return bench
+
+BENCHMARKS = ["copy", "get_movement_moves", "do_move", "play_game_to_end", "state_to_vector", "linear_policy", "mcts_rollouts"]
+
+def run_benchmarks(duration, rollouts, repeat=3, positions=None, benchmarks=None):
+    """Returns a dict from "position/benchmark" to the best rate out of repeat measurements, in units of work per
+    second. The best rate is the one least disturbed by the rest of the machine"""
+    suite = {
+        "copy": bench_copy,
+        "get_movement_moves": bench_movement_moves,
+        "do_move": bench_do_move,
+        "play_game_to_end": bench_play_game_to_end,
+        "state_to_vector": bench_state_to_vector,
+        "linear_policy": bench_linear_policy,
+        "mcts_rollouts": bench_mcts(rollouts),
+    }
+    results = {}
+    for position in positions or CORPUS:
+        for name in benchmarks or BENCHMARKS:
+            random.seed(1)
+            seed_random(1)
+            run = suite[name](load_position(position))
+            results["{}/{}".format(position, name)] = max(rate(run, duration) for _ in range(repeat))
+    return results
+
+def compare(results, baseline, threshold):
+    """Returns the keys of results that are slower than in baseline by more than the fraction threshold"""
+    regressions = []
+    for (key, value) in sorted(results.items()):
+        if key not in baseline:
+            print("{:<36} {:>14.1f}".format(key, value))
+            continue
+        change = value / baseline[key] - 1.0
+        flag = ""
+        if change < -threshold:
+            regressions.append(key)
+            flag = "REGRESSION"
+        print("{:<36} {:>14.1f} {:>14.1f} {:>+8.1%} {}".format(key, value, baseline[key], change, flag))
+    return regressions
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measures the speed of the engine over a fixed corpus of positions")
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--baseline", help="compare against the results in this JSON file")
+    parser.add_argument("--threshold", type=float, default=0.1, help="fraction by which a rate may drop below the baseline before it counts as a regression")
+    parser.add_argument("--duration", type=float, default=0.5, help="seconds spent on each measurement")
+    parser.add_argument("--repeat", type=int, default=3, help="measurements of each benchmark, of which the best is kept")
+    parser.add_argument("--rollouts", type=int, default=2000, help="rollouts per MCTS search")
+    parser.add_argument("--positions", nargs="*", choices=list(CORPUS), help="positions to run, all by default")
+    parser.add_argument("--benchmarks", nargs="*", choices=BENCHMARKS, help="benchmarks to run, all by default")
+    args = parser.parse_args()
+
+    results = run_benchmarks(args.duration, args.rollouts, args.repeat, args.positions, args.benchmarks)
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)["results"]
+    regressions = compare(results, baseline, args.threshold)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"python": platform.python_version(), "machine": platform.machine(), "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                       "duration": args.duration, "repeat": args.repeat, "rollouts": args.rollouts, "results": results}, f, indent=2, sort_keys=True)
+    if regressions:
+        print("{} benchmarks regressed by more than {:.0%}".format(len(regressions), args.threshold))
+        sys.exit(1)
@@ -1,52 +1,170 @@
 from mcts import get_mcts_move
-from state import State
-import csv
+from state import State, LinearWeights, seed_random
+from utils import states_to_matrix
+import argparse
 import copy
-import itertools
+import json
 import math
+import multiprocessing
 import numpy as np
+import os
 import random
+import time
 
-from sklearn.linear_model import LinearRegression
-from sklearn.model_selection import train_test_split, cross_validate
-
-def state_to_vector(state):
-    board = state.get_board()
-    bar = state.get_bar()
-    beared_off = state.get_beared_off()
-    x = np.empty(26, dtype=np.float32)
-    for i in range(24):
-        x[i] = board[0, i] - board[1, i]
-    x[24] = bar[0] - bar[1]
-    x[25] = beared_off[0] - beared_off[1]
-    return list(x)
-
-def create_dataset(n_games, positions_per_game, mcts_c, mcts_t, out_filename):
-    positions = []
-    values = []
-
-    for i in range(n_games):
-        print("{}/{}".format(i + 1, n_games))
+#A sample of a dataset: the game it was drawn from, the features of utils.state_to_vector and the probability of white
+#winning estimated by MCTS
+RECORD_DTYPE = np.dtype([("game", "<u4"), ("features", "<f4", (52,)), ("value", "<f4")])
+#Room for the .npy header, which is rewritten in place as the number of records grows
+HEADER_SIZE = 192
+
+def _write_header(f, n_records):
+    header = "{{'descr': {}, 'fortran_order': False, 'shape': ({},), }}".format(repr(RECORD_DTYPE.descr), n_records)
+    header = header.ljust(HEADER_SIZE - 10 - 1) + "\n"
+    f.seek(0)
+    f.write(b"\x93NUMPY\x01\x00" + np.uint16(len(header)).astype("<u2").tobytes() + header.encode("latin1"))
+
+def _read_header(f):
+    f.seek(0)
+    if np.lib.format.read_magic(f) != (1, 0):
+        raise ValueError("{} is not a dataset written by generate_dataset".format(f.name))
+    (shape, _, dtype) = np.lib.format.read_array_header_1_0(f)
+    if dtype != RECORD_DTYPE or f.tell() != HEADER_SIZE:
+        raise ValueError("{} is not a dataset written by generate_dataset".format(f.name))
+    return shape[0]
+
+def _check_parameters(path, parameters):
+    """Checks that the dataset at path was generated with parameters, which are kept in a JSON file next to it, or
+    records them for a new dataset"""
+    parameters_path = path + ".json"
+    if not os.path.exists(path):
+        with open(parameters_path, "w") as f:
+            json.dump(parameters, f, indent=2, sort_keys=True)
+        return
+    if not os.path.exists(parameters_path):
+        raise ValueError("{} has no {} with the parameters it was generated with".format(path, parameters_path))
+    with open(parameters_path) as f:
+        stored = json.load(f)
+    different = sorted(name for name in set(stored) | set(parameters) if stored.get(name) != parameters.get(name))
+    if different:
+        raise ValueError("{} was generated with different {}".format(path, ", ".join("{} {!r}".format(name, stored.get(name)) for name in different)))
+
+def _label_game(args):
+    """Plays a random game seeded with seed and returns the records of positions_per_game of its positions"""
+    (game, seed, positions_per_game, mcts_c, mcts_t, max_rollouts) = args
+    random.seed(seed)
+    seed_random(seed)
+    states = []
+    state = State()
+    while not state.game_ended():
+        states.append(copy.copy(state))
+        state.do_move(random.choice(state.get_moves()))
+    states = random.sample(states, min(positions_per_game, len(states)))
+    records = np.zeros(len(states), dtype=RECORD_DTYPE)
+    records["game"] = game
+    records["features"] = states_to_matrix(states)
+    for (i, state) in enumerate(states):
+        records[i]["value"] = get_mcts_move(state, mcts_t, mcts_c, return_value=True, max_rollouts=max_rollouts, seed=(seed * positions_per_game + i) & 0xFFFFFFFFFFFFFFFF)[0]
+    return records
+
+def generate_dataset(path, n_games, positions_per_game, mcts_c, mcts_t, max_rollouts=float('inf'), workers=1, seed=0):
+    """Labels positions of n_games random games in as many processes as workers and appends them as RECORD_DTYPE
+    records to the .npy file at path, which np.load can map into memory. Game i is played from seed + i and its k-th
+    labelled position is searched from (seed + i) * positions_per_game + k, so no two positions share a search seed.
+    The record count in the header is only updated once the records of a game are written, so an interrupted run is
+    resumed by calling again with the same arguments, which drops anything written after the last complete game. The
+    arguments that decide the records are written to path + ".json" and resuming with others raises a ValueError, as
+    n_games is the only one that may change"""
+    _check_parameters(path, {"positions_per_game": positions_per_game, "mcts_c": mcts_c, "mcts_t": mcts_t, "max_rollouts": max_rollouts,
+                             "seed": seed, "dtype": repr(RECORD_DTYPE.descr)})
+    if os.path.exists(path):
+        f = open(path, "r+b")
+        n_records = _read_header(f)
+        f.truncate(HEADER_SIZE + n_records * RECORD_DTYPE.itemsize)
+        first_game = int(np.memmap(f, dtype=RECORD_DTYPE, mode="r", offset=HEADER_SIZE, shape=(n_records,))["game"].max()) + 1 if n_records > 0 else 0
+    else:
+        f = open(path, "w+b")
+        n_records = 0
+        first_game = 0
+        _write_header(f, n_records)
+    games = [(game, seed + game, positions_per_game, mcts_c, mcts_t, max_rollouts) for game in range(first_game, n_games)]
+    process_pool = multiprocessing.Pool(workers) if workers > 1 else None
+    start_time = time.time()
+    n_labelled = 0
+    try:
+        for (k, records) in enumerate(process_pool.imap(_label_game, games) if process_pool is not None else map(_label_game, games)):
+            f.seek(HEADER_SIZE + n_records * RECORD_DTYPE.itemsize)
+            f.write(records.tobytes())
+            f.flush()
+            n_records += len(records)
+            _write_header(f, n_records)
+            f.flush()
+            n_labelled += len(records)
+            print("Game {}/{}, {} positions, {:.2f} positions/s".format(first_game + k + 1, n_games, n_records, n_labelled / (time.time() - start_time)))
+    finally:
+        if process_pool is not None:
+            process_pool.terminate()
+        f.close()
+    return n_records
+
+def load_dataset(path):
+    """Maps the records of a dataset written by generate_dataset into memory"""
+    return np.load(path, mmap_mode="r")
+
+def fit_least_squares(features, values, l2=0.0):
+    """Returns the LinearWeights minimising the squared error of intercept + features . w against values, plus l2 times
+    the squared norm of w"""
+    features = np.asarray(features, dtype=np.float64)
+    values = np.asarray(values, dtype=np.float64)
+    #Centering takes the intercept out of the problem, so that it is not penalised
+    mean = features.mean(axis=0)
+    centered = features - mean
+    a = centered.T @ centered + l2 * np.eye(features.shape[1])
+    w = np.linalg.lstsq(a, centered.T @ (values - values.mean()), rcond=None)[0]
+    return LinearWeights(w, values.mean() - mean @ w)
+
+def fit_td_lambda(n_games, alpha=0.001, lam=0.7, weights=None, seed=0):
+    """Fits the linear value of white winning with TD(lambda) over n_games games of random play seeded from seed, starting
+    from weights or from zero. Every game is a single pass of accumulating traces over the matrix of its positions"""
+    random.seed(seed)
+    w = np.zeros(52) if weights is None else weights.get_weights().copy()
+    intercept = 0.5 if weights is None else weights.intercept
+    for _ in range(n_games):
         states = []
         state = State()
         while not state.game_ended():
-            states.append(copy.copy(state))
-            moves = state.get_moves()
-            state.do_move(random.choice(moves))
-        states = random.sample(states, positions_per_game)
-        for state in states:
-            positions.append(state_to_vector(state))
-            #Saves probability of white winning
-            values.append(get_mcts_move(state, mcts_t, mcts_c, return_value=True)[0])
-
-    with open("{}".format(out_filename), "w") as f:
-        writer = csv.writer(f)
-        for (i, position) in enumerate(positions):
-            writer.writerow(itertools.chain(position, [values[i]]))
-    #xs = np.concatenate(positions, axis=0)
-    #ys = np.asarray(values, dtype=np.float32)
-    
-    #np.save(filename_xs, xs)
-    #np.save(filename_ys, ys)
-
-create_dataset(4000, 1, math.sqrt(2), 1, "train2.csv")
\ No newline at end of file
+            if not state.is_nature_turn():
+                states.append(copy.copy(state))
+            state.do_move(random.choice(state.get_moves()))
+        x = states_to_matrix(states).astype(np.float64)
+        trace = np.zeros(53)
+        for t in range(len(x)):
+            value = intercept + x[t] @ w
+            target = (1.0 if state.get_winner() == 0 else 0.0) if t + 1 == len(x) else intercept + x[t + 1] @ w
+            trace = lam * trace
+            trace[:52] += x[t]
+            trace[52] += 1.0
+            delta = alpha * (target - value)
+            w += delta * trace[:52]
+            intercept += delta * trace[52]
+    return LinearWeights(w, intercept)
+
+def train(dataset_path, weights_path, l2=1.0):
+    """Fits the weights of the linear default policy to a dataset written by generate_dataset and saves them to
+    weights_path, for get_linear_default_policy to load"""
+    records = load_dataset(dataset_path)
+    weights = fit_least_squares(records["features"], records["value"], l2)
+    error = np.sqrt(np.mean((records["features"] @ weights.get_weights() + weights.intercept - records["value"]) ** 2))
+    print("Fitted {} positions, root mean squared error {:.4f}".format(len(records), error))
+    weights.save(weights_path)
+    return weights
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generates a dataset of positions valued by MCTS and fits the weights of the linear default policy to it")
+    parser.add_argument("--dataset", default="train.npy")
+    parser.add_argument("--weights", default="weights.npz")
+    parser.add_argument("--games", type=int, default=4000)
+    parser.add_argument("--workers", type=int, default=multiprocessing.cpu_count())
+    parser.add_argument("--l2", type=float, default=1.0)
+    args = parser.parse_args()
+    generate_dataset(args.dataset, args.games, 1, math.sqrt(2), 1, workers=args.workers)
+    train(args.dataset, args.weights, args.l2)
\ No newline at end of file
@@ -1,5 +1,5 @@
 from PIL import Image, ImageDraw, ImageTk, ImageFont
-from state import State, Move
+from state import State, get_movement_move
 from mcts import get_mcts_move
 import tkinter as tk
 import numpy as np
@@ -71,8 +71,7 @@ class TkApp(tk.Tk):
         self.interface.handle_click_event(x, y)
         if self.interface.has_suggested_move():
             suggested_move = self.interface.get_suggested_move()
-            move_hashes = [hash(move) for move in self.state.get_moves()]
-            if hash(suggested_move) in move_hashes:
+            if suggested_move in self.state.get_moves():
                 self.do_move(suggested_move)
             self.interface.clear_suggested_move()
         self.update_interface()
@@ -149,11 +148,7 @@ class Interface:
             if src == BAR:
                 src = -1 if self.player_turn == BLACK else 24
             self.selected_point = None
-            self.suggested_move = Move()
-            self.suggested_move.is_movement_move = True
-            self.suggested_move.src = src
-            self.suggested_move.dst = dst
-            self.suggested_move.n = abs(src - dst)
+            self.suggested_move = get_movement_move(src, dst, abs(src - dst))
         else:
             if point is None:
                 self.selected_point = None
@@ -1,7 +1,17 @@
 # cython: profile=False
-from state import State, Move
-from utils import state_to_vector
+from state cimport State, LinearWeights, UndoRecord, play_length, play_move, play_append
+from state import Move, get_move, get_play, seed_random, load_linear_weights
+from bearoff cimport BearoffTable, BearoffDatabase
+from bearoff import load_bearoff_database
+from libc.math cimport log, sqrt, INFINITY
+from libc.string cimport memset
+from libc.stdlib cimport malloc, calloc, realloc, free
+from rng cimport Rng, rng_seed, rng_next, rng_below, rng_uniform
+cimport cython
+import atexit
 import copy
+import multiprocessing
+import threading
 import numpy as np
 import math
 import random
@@ -9,6 +19,7 @@ import time
 
 cdef int WHITE = 0
 cdef int BLACK = 1
+cdef int NONE = 2
 
 cdef float [::1] WEIGHTS = np.asarray([-4.353895,  -4.3358836, -4.335479,  -4.3396845, -4.347475,  -4.34851,
  -4.360351,  -4.3610826, -4.3669796, -4.367299,  -4.3697615, -4.3710756,
@@ -20,139 +31,909 @@ cdef float [::1] WEIGHTS = np.asarray([-4.353895,  -4.3358836, -4.335479,  -4.33
  -2.769256,  -2.7723508, -2.7798846, -2.7839608, -2.7837057, -2.7644653,
  -4.399285,  -2.7201962, -4.2949524, -2.8242497], dtype=np.float32)
 cdef float INTERCEPT = 107.28579
+#The estimated probability of white winning is INTERCEPT - WEIGHTS . features
+cdef LinearWeights LINEAR_WEIGHTS = LinearWeights(-np.asarray(WEIGHTS, dtype=np.float64), INTERCEPT)
 
-cdef dict new_node(object state, object parent=None, object move=None):
-    cdef bint _is_chance
-    s = copy.copy(state)
-    _is_chance = s.is_nature_turn()
-    if move is not None:
-        s.do_move(move)
-    return {'s': s, 'r': [0.0, 0.0], 'visits': 0, 'parent': parent, 'children': {}, 'n_moves': len(state.get_moves()), 'is_chance': _is_chance}
+ctypedef struct Node:
+    int parent
+    #Children are allocated as one contiguous block, so the siblings of a child are the nodes that follow it in the block
+    int first_child
+    int n_children
+    #Number of children of a decision node that have been given a state, in the order they were shuffled into
+    int n_expanded
+    int visits
+    #Rollouts currently in progress below this node, counted as losses so that parallel threads spread over the tree
+    int virtual_loss
+    double r[2]
+    #Probability of this node being sampled from its parent if the parent is a chance node
+    double p
+    #Zobrist key of the node's state
+    unsigned long long key
+    short move
+    signed char turn
+    #Flags are single bytes so that a node takes 64 bytes
+    char is_chance
+    char is_terminal
+    #Set once the node's state has been created, or reached by a search that replays moves instead of keeping states
+    char has_state
 
-cdef bint is_terminal(dict v):
-    return v['s'].game_ended()
+ctypedef struct SearchCounters:
+    #Leaves selected by tree_policy and the sum and maximum of their depths
+    long long leaves
+    long long depth
+    int max_depth
+    #States created by copying another one, for the nodes of the tree and for playouts
+    long long copies
+    long long playouts
+    #Turns played by the playouts
+    long long plies
 
-cdef bint fully_expanded(dict v):
-    return len(untried_actions(v)) == 0
+ctypedef struct TTEntry:
+    unsigned long long key
+    int visits
+    double r[2]
 
-cdef dict tree_policy(dict v, double c):
-    while not is_terminal(v):
-        if not fully_expanded(v):
-            return expand(v)
-        else:
-            v = best_child(v, c)[0]
+cdef class TranspositionTable:
+    """Fixed size table of visits and rewards keyed by the Zobrist key of a position. Every node of a search that reaches
+    the same position, through whatever order of moves, adds to and selects by the same entry. A position replaces
+    whatever other position was stored in its slot"""
+    cdef TTEntry *entries
+    cdef unsigned long long mask
+
+    def __cinit__(self, int size=1 << 16):
+        cdef unsigned long long capacity = 1
+        while capacity < size:
+            capacity *= 2
+        self.entries = <TTEntry *>calloc(capacity, sizeof(TTEntry))
+        if self.entries == NULL:
+            raise MemoryError()
+        self.mask = capacity - 1
+
+    def __dealloc__(self):
+        free(self.entries)
+
+    def __len__(self):
+        return self.mask + 1
+
+    def __reduce__(self):
+        #The entries are not kept, an unpickled table starts empty
+        return (TranspositionTable, (self.mask + 1,))
+
+    def clear(self):
+        memset(self.entries, 0, (self.mask + 1) * sizeof(TTEntry))
+
+    def get(self, object state):
+        """Returns the visits and rewards stored for state, or None"""
+        cdef TTEntry *entry = self.probe(state.get_hash())
+        if entry == NULL:
+            return None
+        return (entry.visits, entry.r[0], entry.r[1])
+
+    cdef TTEntry *probe(self, unsigned long long key) noexcept nogil:
+        cdef TTEntry *entry = &self.entries[key & self.mask]
+        return entry if entry.key == key and entry.visits > 0 else NULL
+
+    cdef void update(self, unsigned long long key, double white_reward, double black_reward) noexcept nogil:
+        cdef TTEntry *entry = &self.entries[key & self.mask]
+        if entry.key != key:
+            entry.key = key
+            entry.visits = 0
+            entry.r[0] = 0.0
+            entry.r[1] = 0.0
+        entry.visits += 1
+        entry.r[0] += white_reward
+        entry.r[1] += black_reward
+
+cdef class NodePool:
+    """Growable pool of search tree nodes kept in one contiguous array. Nodes are referred to by their index and the root is
+    node 0. The State of a node is only created once the node is first reached by the search. Without store_states only
+    the root keeps its State and the search replays moves from it to reach the others. With whole_turns, the children
+    of a decision node are the plays of the turn rather than single moves, and the play leading to each node is kept
+    alongside the nodes"""
+    cdef Node *nodes
+    #The play leading to each node with whole_turns, or 0 where a single move does
+    cdef unsigned long long *plays
+    cdef int size, capacity
+    cdef list states
+    cdef bint store_states
+
+    def __cinit__(self, int capacity=4096, bint store_states=True, bint whole_turns=False):
+        self.nodes = <Node *>malloc(capacity * sizeof(Node))
+        self.plays = <unsigned long long *>malloc(capacity * sizeof(unsigned long long)) if whole_turns else NULL
+        if self.nodes == NULL or (whole_turns and self.plays == NULL):
+            raise MemoryError()
+        self.size = 0
+        self.capacity = capacity
+        self.states = []
+        self.store_states = store_states
+
+    def __dealloc__(self):
+        free(self.nodes)
+        free(self.plays)
+
+    def __len__(self):
+        return self.size
+
+    cdef int allocate(self, int n, int parent) except -1:
+        """Allocates n consecutive nodes with the given parent and returns the index of the first one. Any Node pointers into
+        the pool are invalidated"""
+        cdef int first, i, capacity
+        cdef Node *nodes
+        cdef Node *node
+        cdef unsigned long long *plays
+        if self.size + n > self.capacity:
+            capacity = self.capacity
+            while self.size + n > capacity:
+                capacity *= 2
+            nodes = <Node *>realloc(self.nodes, capacity * sizeof(Node))
+            if nodes == NULL:
+                raise MemoryError()
+            self.nodes = nodes
+            if self.plays != NULL:
+                plays = <unsigned long long *>realloc(self.plays, capacity * sizeof(unsigned long long))
+                if plays == NULL:
+                    raise MemoryError()
+                self.plays = plays
+            self.capacity = capacity
+        first = self.size
+        for i in range(first, first + n):
+            node = &self.nodes[i]
+            node.parent = parent
+            node.first_child = -1
+            node.n_children = 0
+            node.n_expanded = 0
+            node.visits = 0
+            node.virtual_loss = 0
+            node.r[0] = 0.0
+            node.r[1] = 0.0
+            node.p = 1.0
+            node.move = -1
+            node.turn = 0
+            node.is_chance = False
+            node.is_terminal = False
+            node.has_state = False
+            node.key = 0
+            if self.plays != NULL:
+                self.plays[i] = 0
+            if self.store_states or i == 0:
+                self.states.append(None)
+        self.size += n
+        return first
+
+    cdef void set_state(self, int v, State s):
+        """Sets the fields of v from its state s, which is kept unless only the root's state is"""
+        cdef Node *node = &self.nodes[v]
+        if self.store_states or v == 0:
+            self.states[v] = s
+        node.turn = s.get_player_turn()
+        node.is_chance = s.is_nature_turn()
+        node.is_terminal = s.game_ended()
+        node.has_state = True
+        node.key = s._hash
+
+    cdef State get_state(self, int v):
+        return self.states[v]
+
+    cdef unsigned long long edge(self, int v) noexcept nogil:
+        """Returns the play that leads from the parent of v to v, a single move unless the pool has whole turns"""
+        if self.plays != NULL and self.plays[v] != 0:
+            return self.plays[v]
+        return play_append(0, self.nodes[v].move)
+
+    cdef NodePool subtree(self, int v):
+        """Returns a new pool holding a copy of the subtree below v with v as its root"""
+        cdef NodePool pool = NodePool(whole_turns=self.plays != NULL)
+        cdef int head, u, nu, first, parent, k
+        cdef list queue = [v]
+        pool.allocate(1, -1)
+        head = 0
+        #Nodes are copied in breadth first order, so the copy of the node at queue[i] is node i of the new pool
+        while head < len(queue):
+            u = queue[head]
+            nu = head
+            head += 1
+            first = -1
+            if self.nodes[u].n_children > 0:
+                first = pool.allocate(self.nodes[u].n_children, nu)
+                for k in range(self.nodes[u].n_children):
+                    queue.append(self.nodes[u].first_child + k)
+            parent = pool.nodes[nu].parent
+            pool.nodes[nu] = self.nodes[u]
+            pool.nodes[nu].parent = parent
+            pool.nodes[nu].first_child = first
+            pool.nodes[nu].virtual_loss = 0
+            pool.states[nu] = self.states[u]
+            if self.plays != NULL:
+                pool.plays[nu] = self.plays[u]
+        return pool
+
+    cdef int find(self, State state, int max_depth):
+        """Returns the shallowest node within max_depth of the root whose state is in the same position as state, or -1"""
+        cdef list level = [0]
+        cdef list next_level
+        cdef int depth, u, k
+        cdef State s
+        for depth in range(max_depth + 1):
+            next_level = []
+            for u in level:
+                s = self.states[u]
+                if s is None:
+                    continue
+                if s.same_position(state):
+                    return u
+                for k in range(self.nodes[u].n_children):
+                    next_level.append(self.nodes[u].first_child + k)
+            level = next_level
+        return -1
+
+cdef State materialize(NodePool pool, int v):
+    """Creates the state of node v by applying its move to its parent's state"""
+    cdef State s = State.__new__(State)
+    s.copy_from(pool.get_state(pool.nodes[v].parent))
+    s._do_play(pool.edge(v))
+    pool.set_state(v, s)
+    return s
+
+cdef class Replay:
+    """The working state of a search thread that does not keep a State in every node. The search applies the moves from
+    the root to the leaf it selects and then takes them back"""
+    cdef State state
+    cdef UndoRecord *undo
+    cdef int n, capacity
+
+    def __cinit__(self, State root):
+        self.state = State.__new__(State)
+        self.state.copy_from(root)
+        self.n = 0
+        self.capacity = 64
+        self.undo = <UndoRecord *>malloc(self.capacity * sizeof(UndoRecord))
+        if self.undo == NULL:
+            raise MemoryError()
+
+    def __dealloc__(self):
+        free(self.undo)
+
+    cdef int push(self, unsigned long long play) except -1:
+        """Applies the moves of play"""
+        cdef UndoRecord *undo
+        cdef int k
+        for k in range(play_length(play)):
+            if self.n == self.capacity:
+                undo = <UndoRecord *>realloc(self.undo, 2 * self.capacity * sizeof(UndoRecord))
+                if undo == NULL:
+                    raise MemoryError()
+                self.undo = undo
+                self.capacity *= 2
+            self.state._do_move_undo(play_move(play, k), &self.undo[self.n])
+            self.n += 1
+        return 0
+
+    cdef void unwind(self) noexcept nogil:
+        """Takes back every move, returning the state to the root"""
+        while self.n > 0:
+            self.n -= 1
+            self.state._undo_move(&self.undo[self.n])
+
+cdef int expand(NodePool pool, int v, Rng *rng, State s) except -1:
+    """Allocates the children of v, whose state is s. Outcomes of a chance node are weighted by their probability and the
+    moves or plays of a decision node are shuffled so that expanding them in order tries them in a random order"""
+    cdef list moves
+    cdef object move, p
+    cdef int first, i, j
+    if pool.nodes[v].is_chance:
+        moves = s.get_chance_moves()
+        first = pool.allocate(len(moves), v)
+        for (i, (move, p)) in enumerate(moves):
+            pool.nodes[first + i].move = move.code
+            pool.nodes[first + i].p = p
+    else:
+        moves = s.get_move_codes() if pool.plays == NULL else s.get_turn_move_codes()
+        for i in range(len(moves) - 1, 0, -1):
+            j = rng_below(rng, i + 1)
+            moves[i], moves[j] = moves[j], moves[i]
+        first = pool.allocate(len(moves), v)
+        for (i, move) in enumerate(moves):
+            if pool.plays == NULL:
+                pool.nodes[first + i].move = move
+            else:
+                pool.plays[first + i] = move
+    pool.nodes[v].first_child = first
+    pool.nodes[v].n_children = len(moves)
+    return first
+
+@cython.cdivision(True)
+cdef int sample_chance_child(NodePool pool, int v, double u) noexcept nogil:
+    """Picks a child of chance node v using u drawn uniformly from [0, 1)"""
+    cdef Node *node = &pool.nodes[v]
+    cdef int k, last
+    cdef double total = 0.0
+    last = node.first_child + node.n_children - 1
+    for k in range(node.first_child, last):
+        total += pool.nodes[k].p
+        if u < total:
+            return k
+    return last
+
+@cython.cdivision(True)
+cdef int best_child(NodePool pool, int v, double c, TranspositionTable tt) noexcept nogil:
+    """Selects a child of v by UCT. With a transposition table the value of a child is taken from the table when the
+    table has seen its position more often than the child itself"""
+    cdef Node *node = &pool.nodes[v]
+    cdef Node *child
+    cdef TTEntry *entry
+    cdef int k, best, turn, visits, value_visits
+    cdef double x, highest_x, log_visits, value
+    best = -1
+    highest_x = -INFINITY
+    turn = node.turn
+    log_visits = log(node.visits + node.virtual_loss)
+    for k in range(node.first_child, node.first_child + node.n_children):
+        child = &pool.nodes[k]
+        visits = child.visits + child.virtual_loss
+        if visits == 0:
+            return k
+        value = child.r[turn]
+        value_visits = child.visits
+        if tt is not None:
+            entry = tt.probe(child.key)
+            if entry != NULL and entry.visits > child.visits:
+                value = entry.r[turn]
+                value_visits = entry.visits
+        x = value / (value_visits + child.virtual_loss) + c * sqrt((2 * log_visits) / visits)
+        if x > highest_x:
+            best = k
+            highest_x = x
+    return best
+
+cdef inline void count_leaf(SearchCounters *counters, int depth, bint materialized) noexcept nogil:
+    counters.leaves += 1
+    counters.depth += depth
+    if depth > counters.max_depth:
+        counters.max_depth = depth
+    if materialized:
+        counters.copies += 1
+
+cdef int descend(NodePool pool, int v, Replay replay) except -1:
+    """Moves the search from the parent of v to v, adding a virtual loss to v"""
+    pool.nodes[v].virtual_loss += 1
+    if replay is not None:
+        replay.push(pool.edge(v))
     return v
-        
-cdef bint is_chance(dict v):
-    return v['is_chance']
-    
-cdef list untried_actions(dict v):
-    cdef object move
-    return [move for move in v['s'].get_moves() if not move in v['children']]
-
-cdef dict add_child(dict v, object move):
-    v['children'][move] = new_node(v['s'], v, move)
-    return v['children'][move]
-
-cdef dict expand(dict v):
-    cdef object move, a
-    cdef dict v_prime
-    if is_chance(v):
-        for move in v['s'].get_moves():
-            add_child(v, move)
-        return random.choice(list(v['children'].values()))
+
+cdef int tree_policy(NodePool pool, double c, TranspositionTable tt, Rng *rng, SearchCounters *counters, Replay replay) except -1:
+    """Selects a leaf to roll out from, adding a virtual loss to every node on the way which backup removes. With a
+    replay, the moves on the way are applied to its state, which is left at the leaf"""
+    cdef int v, v_prime
+    cdef int depth = 0
+    v = 0
+    pool.nodes[v].virtual_loss += 1
+    while not pool.nodes[v].is_terminal:
+        if pool.nodes[v].n_children == 0:
+            expand(pool, v, rng, pool.get_state(v) if replay is None else replay.state)
+        depth += 1
+        if pool.nodes[v].is_chance:
+            v_prime = descend(pool, sample_chance_child(pool, v, rng_uniform(rng)), replay)
+            if not pool.nodes[v_prime].has_state:
+                break
+            v = v_prime
+        elif pool.nodes[v].n_expanded < pool.nodes[v].n_children:
+            v_prime = descend(pool, pool.nodes[v].first_child + pool.nodes[v].n_expanded, replay)
+            pool.nodes[v].n_expanded += 1
+            break
+        else:
+            v = descend(pool, best_child(pool, v, c, tt), replay)
     else:
-        a = random.choice(untried_actions(v))
-        v_prime = add_child(v, a)
-        return v_prime
-    
-cdef dict get_children(dict v):
-    return v['children']
-
-cdef tuple best_child(dict v, double c):
-    cdef double x, highest_x
-    cdef dict best
-    cdef object best_move
-    cdef int turn
-    x = float('-inf')
-    highest_x = float('-inf')
-    best = None
-    best_move = None
-    turn = v['s'].get_player_turn()
-    if is_chance(v):
-        best_move = random.choice(list(get_children(v).keys()))
-        best = v['children'][best_move]
+        count_leaf(counters, depth, False)
+        return v
+    if replay is None:
+        materialize(pool, v_prime)
     else:
-        for move in get_children(v).keys():
-            v_prime = v['children'][move]
-            if v_prime['visits'] == 0:
-                best = v_prime
-                best_move = move
-                highest_x = float('inf')
+        pool.set_state(v_prime, replay.state)
+    count_leaf(counters, depth, replay is None)
+    return v_prime
+
+cdef inline long long ply(State s) noexcept nogil:
+    """Counts the turns of a game, so that the difference between two states of it is the number of turns in between"""
+    return 2 * s.turn_number + (1 if s.turn == BLACK else 0)
+
+cdef class LeafBatch:
+    """Rewards of the leaves of one batch, reused between the batches of a search thread, and the counters of the
+    thread's search. A search that does not keep states copies its leaves into states"""
+    cdef int size
+    cdef double [:, ::1] rewards
+    cdef SearchCounters counters
+    cdef list states
+
+    def __init__(self, int size):
+        self.size = size
+        self.rewards = np.zeros((size, 2), dtype=np.float64)
+        self.states = [State.__new__(State) for _ in range(size)]
+
+cdef class DefaultPolicy:
+    """Estimates the rewards of a leaf as the average over n_playouts playouts. playout advances a copy of the leaf state
+    and is called without the GIL, so that rollouts of a tree parallel search run concurrently, then evaluate turns the
+    resulting state into rewards. With a bear-off database, playouts stop once both players are bearing off and are
+    scored with the exact probability of winning from there. With stop_at_race, playouts stop as soon as contact is broken
+    and are scored with the race estimate of State.race_win_probability"""
+    cdef readonly int n_playouts
+    cdef readonly BearoffDatabase bearoff
+    cdef readonly bint stop_at_race
+    cdef const BearoffTable *table
+
+    def __init__(self, int n_playouts=1, BearoffDatabase bearoff=None, bint stop_at_race=False):
+        if n_playouts < 1:
+            raise ValueError("n_playouts must be at least 1")
+        self.n_playouts = n_playouts
+        self.bearoff = bearoff
+        self.stop_at_race = stop_at_race
+        self.table = NULL if bearoff is None else &bearoff.table
+
+    cdef void playout(self, State s, Rng *rng) noexcept nogil:
+        s._play_game_to_end(rng, self.table, self.stop_at_race)
+
+    cdef void evaluate(self, State s, double *r):
+        if s.winner == NONE:
+            r[WHITE] = s._race_win_probability(self.table)
+            r[BLACK] = 1.0 - r[WHITE]
+        else:
+            r[WHITE] = 0.0
+            r[BLACK] = 0.0
+            r[s.winner] = 1.0
+
+    cdef void prepare(self, State root):
+        """Called on the root state of a search before any node is created from it"""
+        pass
+
+    cdef long long estimate(self, State leaf, Rng *rng, double *r):
+        """Estimates the rewards of leaf into r and returns the number of turns played by the playouts"""
+        cdef State s = State.__new__(State)
+        cdef double sample[2]
+        cdef int k
+        cdef long long plies = 0
+        r[WHITE] = 0.0
+        r[BLACK] = 0.0
+        for k in range(self.n_playouts):
+            s.copy_from(leaf)
+            with nogil:
+                self.playout(s, rng)
+            plies += ply(s) - ply(leaf)
+            self.evaluate(s, sample)
+            r[WHITE] += sample[WHITE]
+            r[BLACK] += sample[BLACK]
+        r[WHITE] /= self.n_playouts
+        r[BLACK] /= self.n_playouts
+        return plies
+
+    cdef void estimate_batch(self, list leaves, Rng *rng, LeafBatch batch):
+        """Estimates the rewards of each leaf into the rows of batch.rewards"""
+        cdef int i
+        for i in range(len(leaves)):
+            batch.counters.plies += self.estimate(leaves[i], rng, &batch.rewards[i, 0])
+        batch.counters.playouts += len(leaves) * self.n_playouts
+        batch.counters.copies += len(leaves) * self.n_playouts
+
+    def __reduce__(self):
+        return (DefaultPolicy, (self.n_playouts, self.bearoff, self.stop_at_race))
+
+    def __call__(self, State s):
+        cdef double r[2]
+        cdef Rng rng
+        rng_seed(&rng, random.getrandbits(64))
+        self.estimate(s, &rng, r)
+        return [r[WHITE], r[BLACK]]
+
+default_policy = DefaultPolicy()
+
+cdef class LinearDefaultPolicy(DefaultPolicy):
+    """Plays depth random moves from a leaf and then estimates the probability of white winning with a linear function of
+    the position. The states of a search carry the weights, so the value of a playout is kept up to date by do_move instead
+    of being computed from its features"""
+    cdef readonly int depth
+    cdef readonly LinearWeights linear_weights
+    cdef float max_white_r, min_white_r
+
+    def __init__(self, int depth, int n_playouts=1, LinearWeights weights=None, BearoffDatabase bearoff=None, bint stop_at_race=False):
+        super().__init__(n_playouts, bearoff, stop_at_race)
+        self.depth = depth
+        self.linear_weights = LINEAR_WEIGHTS if weights is None else weights
+        self.max_white_r = 0.9
+        self.min_white_r = 0.1
+
+    def __reduce__(self):
+        return (LinearDefaultPolicy, (self.depth, self.n_playouts, self.linear_weights, self.bearoff, self.stop_at_race))
+
+    cdef void prepare(self, State root):
+        if root._linear_weights is not self.linear_weights:
+            root.set_linear_weights(self.linear_weights)
+
+    cdef void playout(self, State s, Rng *rng) noexcept nogil:
+        s._play_game_to_depth(self.depth, rng, self.table, self.stop_at_race)
+
+    cdef void evaluate(self, State s, double *r):
+        if s.game_ended() or s._should_stop(self.table, self.stop_at_race):
+            DefaultPolicy.evaluate(self, s, r)
+        else:
+            self.prepare(s)
+            r[WHITE] = min(max(self.min_white_r, s._linear_value()), self.max_white_r)
+            r[BLACK] = 1.0 - r[WHITE]
+
+def get_linear_default_policy(int depth, int n_playouts=1, object weights=None, object bearoff=None, bint stop_at_race=False):
+    """Returns a LinearDefaultPolicy with the given LinearWeights, or the weights saved at the given path, or the
+    built in weights if weights is None. bearoff is a BearoffDatabase or the path of one"""
+    if weights is not None and not isinstance(weights, LinearWeights):
+        weights = load_linear_weights(weights)
+    if bearoff is not None and not isinstance(bearoff, BearoffDatabase):
+        bearoff = load_bearoff_database(bearoff)
+    return LinearDefaultPolicy(depth, n_playouts, weights, bearoff, stop_at_race)
+
+cdef void backup(NodePool pool, int v, double white_reward, double black_reward, TranspositionTable tt) noexcept nogil:
+    while v != -1:
+        pool.nodes[v].virtual_loss -= 1
+        pool.nodes[v].visits += 1
+        pool.nodes[v].r[0] += white_reward
+        pool.nodes[v].r[1] += black_reward
+        if tt is not None:
+            tt.update(pool.nodes[v].key, white_reward, black_reward)
+        v = pool.nodes[v].parent
+
+cdef void add_counters(SearchCounters *total, const SearchCounters *counters) noexcept nogil:
+    total.leaves += counters.leaves
+    total.depth += counters.depth
+    total.max_depth = max(total.max_depth, counters.max_depth)
+    total.copies += counters.copies
+    total.playouts += counters.playouts
+    total.plies += counters.plies
+
+cdef int TIMING_INTERVAL = 16
+
+class SearchStatistics:
+    """What a search did: its rollouts, the nodes in its tree, the depth in the tree of the leaves it rolled out from, the
+    playouts made and the turns they took, the States it copied and the seconds spent by all its threads selecting
+    leaves, estimating them and backing up their rewards. children holds the visits and the average rewards of white
+    and black of each move from the root, and time the wall time of the search"""
+    def __init__(self):
+        self.rollouts = 0
+        self.nodes = 0
+        self.leaves = 0
+        self.total_depth = 0
+        self.max_depth = 0
+        self.copies = 0
+        self.playouts = 0
+        self.plies = 0
+        self.tree_policy_time = 0.0
+        self.default_policy_time = 0.0
+        self.backup_time = 0.0
+        self.time = 0.0
+        self.children = {}
+
+    @property
+    def average_depth(self):
+        return self.total_depth / self.leaves if self.leaves > 0 else 0.0
+
+    @property
+    def average_rollout_length(self):
+        """Average number of times a playout passed the turn to the other player"""
+        return self.plies / self.playouts if self.playouts > 0 else 0.0
+
+    def merge(self, other):
+        """Adds the statistics of another search of the same position"""
+        for name in ["rollouts", "nodes", "leaves", "total_depth", "copies", "playouts", "plies", "tree_policy_time", "default_policy_time", "backup_time"]:
+            setattr(self, name, getattr(self, name) + getattr(other, name))
+        self.max_depth = max(self.max_depth, other.max_depth)
+
+    def __str__(self):
+        return "\n".join([
+            "Made {} rollouts in {:.2f} seconds, {} nodes and {} state copies".format(self.rollouts, self.time, self.nodes, self.copies),
+            "Leaf depth {:.1f} on average and {} at most, playouts of {:.1f} turns".format(self.average_depth, self.max_depth, self.average_rollout_length),
+            "Seconds in tree policy {:.3f}, default policy {:.3f}, backup {:.3f}".format(self.tree_policy_time, self.default_policy_time, self.backup_time)])
+
+cdef class Search:
+    """A search tree together with its budget. run may be called from several threads at once to grow the tree in
+    parallel; the tree is only touched while holding lock and rollouts of a DefaultPolicy are made without the GIL. Each
+    descent selects batch_size leaves, whose virtual losses steer the descents apart, before they are evaluated together
+    and backed up. Every thread counts what it does and times one batch in TIMING_INTERVAL, which is enough to tell how
+    the time is split between the phases of a search without timing each of them"""
+    cdef NodePool pool
+    cdef TranspositionTable tt
+    cdef double c, max_time, start_time
+    cdef int batch_size
+    cdef object max_rollouts, default_policy, lock
+    cdef readonly object rollouts
+    cdef SearchCounters counters
+    #Estimated seconds spent by all threads in each phase
+    cdef double times[3]
+
+    def __init__(self, NodePool pool, double max_time, double c, object max_rollouts, object default_policy, TranspositionTable tt=None, int batch_size=1):
+        if batch_size < 1:
+            raise ValueError("batch_size must be at least 1")
+        self.pool = pool
+        self.batch_size = batch_size
+        self.tt = tt
+        self.c = c
+        self.max_time = max_time
+        #A fractional budget is rounded up, as the rollouts are counted in whole batches
+        self.max_rollouts = max_rollouts if max_rollouts == float('inf') else math.ceil(max_rollouts)
+        self.default_policy = default_policy
+        self.rollouts = 0
+        self.lock = threading.Lock()
+        self.start_time = time.time()
+        memset(&self.counters, 0, sizeof(SearchCounters))
+        memset(self.times, 0, sizeof(self.times))
+
+    def run(self, unsigned long long seed):
+        """Grows the tree until the budget is spent. Every random choice made by this call is drawn from a generator
+        seeded with seed"""
+        cdef DefaultPolicy policy = self.default_policy if isinstance(self.default_policy, DefaultPolicy) else None
+        cdef LeafBatch batch = LeafBatch(self.batch_size)
+        cdef Replay replay = None if self.pool.store_states else Replay(self.pool.get_state(0))
+        cdef Rng rng
+        cdef int i, n
+        cdef long long batches = 0, timed_batches = 0
+        cdef double times[4]
+        cdef double phase_times[3]
+        cdef list leaves, states
+        cdef object reward
+        cdef bint timed
+        rng_seed(&rng, seed)
+        memset(phase_times, 0, sizeof(phase_times))
+        while time.time() - self.start_time < self.max_time and self.rollouts < self.max_rollouts:
+            timed = batches % TIMING_INTERVAL == 0
+            batches += 1
+            if timed:
+                times[0] = time.perf_counter()
+            with self.lock:
+                n = self.batch_size if self.rollouts + self.batch_size <= self.max_rollouts else int(self.max_rollouts - self.rollouts)
+                self.rollouts += n
+                if replay is None:
+                    leaves = [tree_policy(self.pool, self.c, self.tt, &rng, &batch.counters, None) for i in range(n)]
+                    states = [self.pool.get_state(v) for v in leaves]
+                else:
+                    leaves = []
+                    for i in range(n):
+                        leaves.append(tree_policy(self.pool, self.c, self.tt, &rng, &batch.counters, replay))
+                        (<State>batch.states[i]).copy_from(replay.state)
+                        replay.unwind()
+                    batch.counters.copies += n
+                    states = batch.states[:n]
+            if timed:
+                times[1] = time.perf_counter()
+            if policy is not None:
+                policy.estimate_batch(states, &rng, batch)
             else:
-                x = v_prime['r'][turn] / v_prime['visits'] + c * math.sqrt((2 * math.log(v['visits'])) / v_prime['visits'])
-                if x > highest_x:
-                    best = v_prime
-                    best_move = move
-                    highest_x = x
-    return (best, best_move)
-
-cdef list default_policy(object s):
-    cdef list r
-    s = copy.copy(s)
+                for i in range(n):
+                    reward = self.default_policy(states[i])
+                    batch.rewards[i, WHITE] = reward[WHITE]
+                    batch.rewards[i, BLACK] = reward[BLACK]
+            if timed:
+                times[2] = time.perf_counter()
+            with self.lock:
+                for i in range(n):
+                    backup(self.pool, leaves[i], batch.rewards[i, WHITE], batch.rewards[i, BLACK], self.tt)
+            if timed:
+                times[3] = time.perf_counter()
+                timed_batches += 1
+                for i in range(3):
+                    phase_times[i] += times[i + 1] - times[i]
+        with self.lock:
+            add_counters(&self.counters, &batch.counters)
+            if timed_batches > 0:
+                for i in range(3):
+                    self.times[i] += phase_times[i] * batches / timed_batches
+
+    cdef object get_statistics(self):
+        statistics = SearchStatistics()
+        statistics.rollouts = self.rollouts
+        statistics.nodes = len(self.pool)
+        statistics.leaves = self.counters.leaves
+        statistics.total_depth = self.counters.depth
+        statistics.max_depth = self.counters.max_depth
+        statistics.copies = self.counters.copies
+        statistics.playouts = self.counters.playouts
+        statistics.plies = self.counters.plies
+        (statistics.tree_policy_time, statistics.default_policy_time, statistics.backup_time) = self.times
+        return statistics
+
+cdef NodePool new_tree(object state, bint store_states=True, bint whole_turns=False):
+    cdef NodePool pool = NodePool(store_states=store_states, whole_turns=whole_turns)
+    pool.allocate(1, -1)
+    pool.set_state(0, copy.copy(state))
+    return pool
+
+cdef object new_seed(object seed):
+    return random.getrandbits(64) if seed is None else seed
+
+cdef object search(NodePool pool, double max_time, double c, object max_rollouts, object default_policy, int threads, TranspositionTable tt=None, object seed=None, int batch_size=1):
+    """Grows the tree in pool from the given number of threads and returns the SearchStatistics of the search. Thread i
+    draws from a generator seeded with seed + i"""
+    cdef Search tree_search = Search(pool, max_time, c, max_rollouts, default_policy, tt, batch_size)
+    cdef list workers
+    seed = new_seed(seed)
+    if isinstance(default_policy, DefaultPolicy):
+        (<DefaultPolicy>default_policy).prepare(pool.get_state(0))
+    if threads > 1:
+        workers = [threading.Thread(target=tree_search.run, args=((seed + i) & 0xFFFFFFFFFFFFFFFF,)) for i in range(threads)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+    else:
+        tree_search.run(seed)
+    return tree_search.get_statistics()
+
+cdef dict root_statistics(NodePool pool):
+    """Returns the visits and rewards of each child of the root keyed by move code, or by play code if the pool has whole
+    turns and the root is a decision node"""
+    cdef Node *v0 = &pool.nodes[0]
+    cdef int k
+    if pool.plays != NULL and not v0.is_chance:
+        return {pool.plays[k]: [pool.nodes[k].visits, pool.nodes[k].r[0], pool.nodes[k].r[1]] for k in range(v0.first_child, v0.first_child + v0.n_children)}
+    return {pool.nodes[k].move: [pool.nodes[k].visits, pool.nodes[k].r[0], pool.nodes[k].r[1]] for k in range(v0.first_child, v0.first_child + v0.n_children)}
+
+def _search_worker(tuple args):
+    cdef NodePool pool
+    (state, max_time, c, max_rollouts, default_policy, threads, seed, batch_size, store_states, whole_turns) = args
+    random.seed(seed)
+    seed_random(seed)
+    pool = new_tree(state, store_states, whole_turns)
+    statistics = search(pool, max_time, c, max_rollouts, default_policy, threads, None, seed, batch_size)
+    return (statistics, pool.nodes[0].visits, pool.nodes[0].r[0], pool.nodes[0].r[1], root_statistics(pool))
+
+cdef dict _process_pools = {}
+
+def close_process_pools():
+    """Shuts down the worker processes used by root parallel searches"""
+    for process_pool in _process_pools.values():
+        process_pool.terminate()
+    _process_pools.clear()
+
+atexit.register(close_process_pools)
+
+cdef object get_process_pool(int workers):
+    if workers not in _process_pools:
+        _process_pools[workers] = multiprocessing.Pool(workers)
+    return _process_pools[workers]
+
+cdef tuple parallel_search(object state, double max_time, double c, object max_rollouts, object default_policy, int threads, int workers, object seed=None, int batch_size=1, bint store_states=True, bint whole_turns=False):
+    """Runs independent searches from state in worker processes and merges their root statistics"""
+    cdef list args, results
+    cdef dict children, worker_children
+    cdef object worker_rollouts, statistics
+    cdef int i
+    args = []
+    seed = new_seed(seed)
+    for i in range(workers):
+        #Split the rollout budget so the total is the same as for a single search
+        worker_rollouts = max_rollouts if max_rollouts == float('inf') else max_rollouts // workers + (1 if i < max_rollouts % workers else 0)
+        args.append((state, max_time, c, worker_rollouts, default_policy, threads, (seed + i * threads) & 0xFFFFFFFFFFFFFFFF, batch_size, store_states, whole_turns))
+    results = get_process_pool(workers).map(_search_worker, args)
+    statistics = SearchStatistics()
+    visits = 0
     r = [0.0, 0.0]
-    r[s.play_game_to_end()] += 1.0
-    return r
-
-def get_linear_default_policy(int depth):
-    cdef float [:] weights = WEIGHTS
-    cdef float intercept = INTERCEPT
-    cdef float max_white_r = 0.9
-    cdef float min_white_r = 0.1
-    def default_policy(object s):
-        cdef list r
-        s = copy.copy(s)
-        s.play_game_to_depth(depth)
-        r = [0.0, 0.0]
-        if s.game_ended():
-            r[s.get_winner()] += 1.0
-        else:
-            vector = state_to_vector(s)
-            r[WHITE] = min(max(min_white_r, intercept - np.dot(vector, weights)), max_white_r)
-            r[BLACK] = 1.0 - r[WHITE]            
-        return r
-    return default_policy
-
-cdef void backup(dict v, list rewards):
-    while v is not None:
-        v['visits'] += 1
-        v['r'][0] += rewards[0]
-        v['r'][1] += rewards[1]
-        v = v['parent']
-
-cpdef get_mcts_move(object state, double max_time, double c=0.250, bint verbose=False, bint return_value=False, object max_rollouts=float('inf'), object default_policy=default_policy):
-    cdef dict v0, vl
-    cdef double start_time
-    cdef object move, most_visits_move, rollouts, most_visits
-    v0 = new_node(state)
-    start_time = time.time()
-    rollouts = 0
-    while time.time() - start_time < max_time and rollouts < max_rollouts:
-        vl = tree_policy(v0,  c)
-        reward = default_policy(vl['s'])
-        backup(vl, reward)
-        rollouts += 1
+    children = {}
+    for (worker_statistics, worker_visits, r0, r1, worker_children) in results:
+        statistics.merge(worker_statistics)
+        visits += worker_visits
+        r[0] += r0
+        r[1] += r1
+        for (move, stats) in worker_children.items():
+            if move in children:
+                for i in range(3):
+                    children[move][i] += stats[i]
+            else:
+                children[move] = stats
+    return (statistics, visits, r, children)
+
+cdef object search_result(object state, object statistics, object visits, list r, dict children, double start_time, bint verbose, bint return_value, bint return_statistics, bint whole_turns=False):
+    cdef object move, most_visits_move, most_visits, result
+    cdef bint plays = whole_turns and not state.is_nature_turn()
+    cdef object get_edge = get_play if plays else get_move
+    statistics.time = time.time() - start_time
+    statistics.children = {get_edge(move): (stats[0], stats[1] / stats[0], stats[2] / stats[0]) for (move, stats) in children.items() if stats[0] > 0}
     if verbose:
-        print("Made {} rollouts in {:.2f} seconds".format(rollouts, time.time() - start_time))
-        print("White reward at root {:.2f}".format(v0['r'][0] / v0['visits']))
-        print("Black reward at root {:.2f}".format(v0['r'][1] / v0['visits']))
+        print(statistics)
+        print("White reward at root {:.2f}".format(r[0] / visits))
+        print("Black reward at root {:.2f}".format(r[1] / visits))
     if not return_value:
-        most_visits_move = random.choice(state.get_moves())
-        most_visits = float('-inf')
-        for move in v0['children'].keys():
-            if v0['children'][move]['visits'] > most_visits:
-                most_visits = v0['children'][move]['visits']
-                most_visits_move = move
-        return most_visits_move
+        most_visits_move = random.choice(state.get_turn_moves() if plays else state.get_moves())
+        most_visits = -1
+        for (move, stats) in children.items():
+            if stats[0] > most_visits:
+                most_visits = stats[0]
+                most_visits_move = get_edge(move)
+        result = most_visits_move
+    else:
+        result = (r[0] / visits, r[1] / visits)
+    return (result, statistics) if return_statistics else result
+
+cpdef get_mcts_move(object state, double max_time, double c=0.250, bint verbose=False, bint return_value=False, object max_rollouts=float('inf'), object default_policy=default_policy, int workers=1, int threads=1, TranspositionTable transposition_table=None, object seed=None, int batch_size=1, bint return_statistics=False, bint store_states=True, bint whole_turns=False):
+    """Returns the move chosen by MCTS, or the estimated rewards of white and black if return_value is set, followed by
+    the SearchStatistics of the search if return_statistics is set. With threads above one, that many threads grow a
+    single shared tree. With workers above one, that many independent searches are run in parallel processes and their
+    root statistics are combined. A transposition table shares statistics between nodes that reach the same position, it
+    is not used by the worker processes. Given a seed and a rollout budget instead of a time limit, a single threaded
+    search always returns the same result. With batch_size above one, leaves are selected and evaluated batch_size at a
+    time. Without store_states, the nodes of the tree do not keep a State each: every thread keeps a single state and
+    applies and takes back the moves from the root to each leaf it selects, which makes the tree much smaller. With
+    whole_turns, each turn is a single decision between the plays of State.get_turn_moves instead of a decision for
+    every die, and a Play is returned instead of a Move when a player is to move"""
+    cdef NodePool pool
+    cdef double start_time
+    cdef dict children
+    cdef object statistics, visits, r
+    start_time = time.time()
+    if workers > 1:
+        (statistics, visits, r, children) = parallel_search(state, max_time, c, max_rollouts, default_policy, threads, workers, seed, batch_size, store_states, whole_turns)
     else:
-        return (v0['r'][0] / v0['visits'], v0['r'][1] / v0['visits'])
+        pool = new_tree(state, store_states, whole_turns)
+        statistics = search(pool, max_time, c, max_rollouts, default_policy, threads, transposition_table, seed, batch_size)
+        visits = pool.nodes[0].visits
+        r = [pool.nodes[0].r[0], pool.nodes[0].r[1]]
+        children = root_statistics(pool)
+    return search_result(state, statistics, visits, r, children, start_time, verbose, return_value, return_statistics, whole_turns)
+
+cdef class MCTSSearcher:
+    """Searches positions of one game while keeping the search tree between calls. When asked about a position that the
+    previous tree reached, after the moves that were played and the dice that were rolled since, the subtree below it is
+    kept along with its statistics instead of being searched again. With a seed, the searches of a game are reproducible
+    when they are limited by rollouts. With whole_turns, the tree has a decision node per turn as in get_mcts_move"""
+    cdef readonly double c
+    cdef readonly int threads, max_depth, batch_size
+    cdef readonly bint whole_turns
+    cdef object policy
+    cdef NodePool pool
+    cdef TranspositionTable tt
+    cdef Rng rng
+
+    def __init__(self, double c=0.250, object default_policy=default_policy, int threads=1, int max_depth=16, TranspositionTable transposition_table=None, object seed=None, int batch_size=1, bint whole_turns=False):
+        self.c = c
+        self.tt = transposition_table
+        self.policy = default_policy
+        self.threads = threads
+        self.max_depth = max_depth
+        self.batch_size = batch_size
+        self.whole_turns = whole_turns
+        self.pool = None
+        rng_seed(&self.rng, new_seed(seed))
+
+    def __reduce__(self):
+        #Only the settings and the state of the generator are kept, an unpickled searcher starts without a tree
+        return (MCTSSearcher, (self.c, self.policy, self.threads, self.max_depth, self.tt, 0, self.batch_size, self.whole_turns), self.rng.s)
+
+    def __setstate__(self, unsigned long long s):
+        self.rng.s = s
+
+    def reset(self, object seed=None):
+        """Discards the search tree and the contents of the transposition table, and reseeds the searcher if seed is
+        given"""
+        self.pool = None
+        if self.tt is not None:
+            self.tt.clear()
+        if seed is not None:
+            rng_seed(&self.rng, seed)
+
+    cdef void _move_root(self, State state):
+        cdef int v = -1
+        if self.pool is not None:
+            v = self.pool.find(state, self.max_depth)
+        if v == -1:
+            self.pool = new_tree(state, True, self.whole_turns)
+        elif v != 0:
+            self.pool = self.pool.subtree(v)
+
+    def tree_size(self):
+        return 0 if self.pool is None else len(self.pool)
+
+    def search(self, State state, double max_time, bint verbose=False, bint return_value=False, object max_rollouts=float('inf'), bint return_statistics=False):
+        """Searches state like get_mcts_move, reusing the statistics already gathered for it"""
+        cdef double start_time = time.time()
+        cdef object statistics
+        self._move_root(state)
+        statistics = search(self.pool, max_time, self.c, max_rollouts, self.policy, self.threads, self.tt, rng_next(&self.rng), self.batch_size)
+        return search_result(state, statistics, self.pool.nodes[0].visits, [self.pool.nodes[0].r[0], self.pool.nodes[0].r[1]],
+                             root_statistics(self.pool), start_time, verbose, return_value, return_statistics, self.whole_turns)
+
+    def get_move(self, State state, double max_time, bint verbose=False, object max_rollouts=float('inf'), bint return_statistics=False):
+        return self.search(state, max_time, verbose=verbose, max_rollouts=max_rollouts, return_statistics=return_statistics)
+
+    def get_value(self, State state, double max_time, bint verbose=False, object max_rollouts=float('inf'), bint return_statistics=False):
+        return self.search(state, max_time, verbose=verbose, return_value=True, max_rollouts=max_rollouts, return_statistics=return_statistics)
@@ -0,0 +1,37 @@
+# Small, fast generator used by playouts and searches. Each search or thread owns its own Rng so that results can be
+# reproduced from a seed and no state is shared between threads.
+cimport cython
+
+ctypedef struct Rng:
+    unsigned long long s
+
+cdef inline unsigned long long splitmix64(unsigned long long *x) noexcept nogil:
+    """Advances the splitmix64 state x and returns its next output"""
+    cdef unsigned long long z
+    x[0] += 0x9E3779B97F4A7C15ULL
+    z = x[0]
+    z = (z ^ (z >> 30)) * 0xBF58476D1CE4E5B9ULL
+    z = (z ^ (z >> 27)) * 0x94D049BB133111EBULL
+    return z ^ (z >> 31)
+
+cdef inline void rng_seed(Rng *rng, unsigned long long seed) noexcept nogil:
+    #splitmix64 of the seed, which is never zero for the xorshift state
+    rng.s = splitmix64(&seed) | 1
+
+cdef inline unsigned long long rng_next(Rng *rng) noexcept nogil:
+    """xorshift64*"""
+    cdef unsigned long long x = rng.s
+    x ^= x >> 12
+    x ^= x << 25
+    x ^= x >> 27
+    rng.s = x
+    return x * 2685821657736338717ULL
+
+cdef inline unsigned int rng_below(Rng *rng, unsigned int n) noexcept nogil:
+    """Returns an integer drawn uniformly from [0, n)"""
+    return <unsigned int>(((rng_next(rng) >> 32) * n) >> 32)
+
+@cython.cdivision(True)
+cdef inline double rng_uniform(Rng *rng) noexcept nogil:
+    """Returns a double drawn uniformly from [0, 1)"""
+    return (rng_next(rng) >> 11) * (1.0 / 9007199254740992.0)
@@ -9,7 +9,8 @@ state_ext = Extension("state", sources=['state.pyx'], include_dirs=[numpy.get_in
 
 mcts_ext = Extension("mcts", sources=['mcts.pyx'], include_dirs=[numpy.get_include()])
 utils_ext = Extension("utils", sources=['utils.pyx'], include_dirs=[numpy.get_include()])
+bearoff_ext = Extension("bearoff", sources=['bearoff.pyx'], include_dirs=[numpy.get_include()])
 
 setup(
-    ext_modules = cythonize([state_ext, mcts_ext, utils_ext], language_level=3, annotate=True)
+    ext_modules = cythonize([state_ext, mcts_ext, utils_ext, bearoff_ext], language_level=3, annotate=True)
 )
@@ -0,0 +1,179 @@
+cimport numpy as np
+from rng cimport Rng
+from bearoff cimport BearoffTable, BearoffDatabase
+
+cdef enum:
+    N_ROLL_MOVES = 36
+    N_MOVES = 306
+    MAX_LEGAL_MOVES = 64
+    N_FEATURES = 52
+    #Length of the encoding of State.to_bytes
+    STATE_BYTES = 13
+    MAX_PLAY_MOVES = 4
+
+#A play is the sequence of moves that make up a turn packed into an integer: the number of moves in the lowest 3 bits
+#followed by the code of each move in 9 bits
+cdef inline int play_length(unsigned long long play) noexcept nogil:
+    return play & 7
+
+cdef inline int play_move(unsigned long long play, int k) noexcept nogil:
+    return (play >> (3 + 9 * k)) & 511
+
+cdef inline unsigned long long play_append(unsigned long long play, int code) noexcept nogil:
+    return (play + 1) | (<unsigned long long>code << (3 + 9 * (play & 7)))
+
+cdef class Move:
+    cdef readonly bint is_movement_move
+    cdef readonly signed char src, dst, n, i, j
+    cdef readonly short code
+
+cdef class Play:
+    cdef readonly unsigned long long code
+
+cdef class LinearWeights:
+    cdef readonly double intercept
+    cdef double w[N_FEATURES]
+
+cpdef void seed_random(unsigned long long seed)
+cpdef Move get_move(int code)
+cpdef Move get_roll_move(int i, int j)
+cpdef Move get_movement_move(int src, int dst, int n)
+cpdef Play get_play(unsigned long long code)
+
+ctypedef struct UndoRecord:
+    #What do_move changes beyond the pieces moved by code, with whether a piece of the other player was hit
+    short code
+    bint hit
+    signed char turn, winner
+    bint is_nature_turn, game_has_started
+    signed char piece_moves_left[4]
+    int n_piece_moves_left
+    int turn_number
+    unsigned long long hash
+    double linear_score
+
+ctypedef struct TurnEnd:
+    #A play after which the turn is over, the Zobrist key of the position it leads to and the number of dice it used
+    unsigned long long play
+    unsigned long long key
+    int used
+
+ctypedef struct TurnSearch:
+    TurnEnd *ends
+    int n, capacity
+    bint doubles
+
+cdef class Undo:
+    cdef UndoRecord record
+
+cdef class State:
+    cdef signed char board[2][24]
+    cdef signed char bar[2]
+    cdef signed char beared_off[2]
+    cdef signed char _piece_moves_left[4]
+    cdef int _n_piece_moves_left
+    cdef int turn, turn_number, winner
+    cdef bint _is_nature_turn, game_has_started
+    cdef short _legal_moves[MAX_LEGAL_MOVES]
+    cdef int _n_legal_moves
+    cdef unsigned long long _hash
+    cdef int _pips[2]
+    #Bit i is set if the player has a piece on point i
+    cdef unsigned int _occupied[2]
+    #Bit i is set if the player has two or more pieces on point i, which the other player cannot move to
+    cdef unsigned int _blocked[2]
+    cdef LinearWeights _linear_weights
+    cdef double _linear_score
+
+    cpdef void reset(self)
+    cpdef void debug_reset_board(self, signed char [:, ::1] board, signed char [::1] bar=*, signed char [::1] beared_off=*)
+    cpdef void copy_from(self, State other)
+    cdef void _load_position(self, signed char *board, signed char *bar, signed char *beared_off, int turn) noexcept nogil
+    cdef void _reset(self)
+    cdef unsigned long long _compute_hash(self) noexcept nogil
+    cpdef unsigned long long get_hash(self)
+    cdef void _compute_incremental(self) noexcept nogil
+    cdef double _compute_linear_score(self) noexcept nogil
+    cpdef void set_linear_weights(self, LinearWeights weights)
+    cpdef LinearWeights get_linear_weights(self)
+    cpdef double linear_value(self) except? -1
+    cdef double _linear_value(self) noexcept nogil
+    cdef void _set_board(self, int player, int point, int count) noexcept nogil
+    cdef void _set_bar(self, int player, int count) noexcept nogil
+    cdef void _set_beared_off(self, int player, int count) noexcept nogil
+    cdef void _set_turn(self, int player) noexcept nogil
+    cdef void _set_nature_turn(self, bint is_nature_turn) noexcept nogil
+    cdef np.ndarray _view(self, signed char *data, int nd, np.npy_intp *shape)
+    cpdef bint same_position(self, State other)
+    cpdef bytes position_key(self)
+    cdef int _encode(self, unsigned char *data) except -1
+    cdef int _decode(self, const unsigned char *data) except -1
+    cpdef bytes to_bytes(self)
+    cpdef int get_player_turn(self)
+    cpdef list get_moves(self)
+    cpdef list get_move_codes(self)
+    cpdef int get_winner(self)
+    cpdef bint is_nature_turn(self)
+    cpdef bint has_game_started(self)
+    cpdef void set_nature_turn(self, bint is_nature_turn)
+    cpdef void set_turn(self, int player)
+    cpdef int play_game_to_end(self, BearoffDatabase bearoff=*, bint stop_at_race=*)
+    cpdef int play_game_to_depth(self, int depth, BearoffDatabase bearoff=*, bint stop_at_race=*)
+    cdef bint _should_stop(self, const BearoffTable *bearoff, bint stop_at_race) noexcept nogil
+    cdef int _play_game_to_end(self, Rng *rng, const BearoffTable *bearoff, bint stop_at_race) noexcept nogil
+    cdef int _play_game_to_depth(self, int depth, Rng *rng, const BearoffTable *bearoff, bint stop_at_race) noexcept nogil
+    cpdef int pip_count(self, int player)
+    cpdef bint is_race(self)
+    cdef bint _is_race(self) noexcept nogil
+    cdef double _race_rolls(self, int player) noexcept nogil
+    cpdef double race_win_probability(self, BearoffDatabase bearoff=*) except? -1
+    cdef double _race_win_probability(self, const BearoffTable *bearoff) noexcept nogil
+    cpdef bint is_bearoff(self)
+    cdef bint _is_bearoff(self) noexcept nogil
+    cdef bint _at_bearoff(self) noexcept nogil
+    cpdef double bearoff_win_probability(self, BearoffDatabase bearoff) except? -1
+    cdef double _bearoff_win_probability(self, const BearoffTable *bearoff) noexcept nogil
+    cdef bint _has_piece(self, int point) noexcept nogil
+    cdef int _forward(self, int point, int n) noexcept nogil
+    cpdef int bar_point(self)
+    cpdef int bearing_off_point(self)
+    cdef int _bar_point(self) noexcept nogil
+    cdef int _bearing_off_point(self) noexcept nogil
+    cpdef list get_movement_moves(self)
+    cdef int _get_movement_move_codes(self, short *codes) noexcept nogil
+    cdef void _generate_piece_moves_from_dice(self, int i, int j) noexcept nogil
+    cdef void _clear_piece_moves(self) noexcept nogil
+    cdef int _count_piece_moves(self, int n) noexcept nogil
+    cdef bint _has_piece_move(self, int n) noexcept nogil
+    cdef void _use_piece_move(self, signed char n) noexcept nogil
+    cpdef void generate_movement_moves(self)
+    cdef void _generate_movement_moves(self) noexcept nogil
+    cpdef int other_player(self)
+    cdef int _other_player(self) noexcept nogil
+    cpdef bint can_bear_off(self)
+    cdef bint _can_bear_off(self) noexcept nogil
+    cdef bint _is_legal(self, int code) noexcept nogil
+    cpdef Undo do_move(self, Move move)
+    cpdef void undo_move(self, Undo undo)
+    cdef void _do_move_undo(self, int code, UndoRecord *undo) noexcept nogil
+    cdef void _undo_move(self, const UndoRecord *undo) noexcept nogil
+    cpdef list get_turn_moves(self)
+    cpdef list get_turn_move_codes(self)
+    cdef int _search_turn(self, unsigned long long play, int last_src, TurnSearch *search) except -1
+    cpdef void do_turn(self, Play play)
+    cdef unsigned long long _play_key(self, unsigned long long play) noexcept nogil
+    cdef void _do_play(self, unsigned long long play) noexcept nogil
+    cpdef void do_move_code(self, int code)
+    cdef void _do_move_code(self, int code) noexcept nogil
+    cdef void _goto_next_turn(self) noexcept nogil
+    cpdef bint game_ended(self)
+    cpdef bint check_for_winner(self)
+    cdef void _check_for_winner(self) noexcept nogil
+    cpdef signed char n_pieces_on_bar(self, int player)
+    cpdef signed char n_pieces_on_board(self, int player)
+    cpdef signed char n_beared_off_pieces(self, int player)
+    cpdef void generate_pre_game_2d6_moves(self)
+    cpdef void generate_nature_moves(self)
+    cdef void _generate_nature_moves(self) noexcept nogil
+    cpdef list get_chance_moves(self)
+    cpdef list get_roll_2d6_moves(self)
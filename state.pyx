@@ -1,13 +1,15 @@
 # cython: profile=False
-import array
 import copy
 import numpy as np
 import numpy.random as np_random
 cimport numpy as np
 cimport numpy.random as np_random
 cimport cython
-from libc.stdlib cimport rand, srand, RAND_MAX
-from cpython cimport array
+from libc.string cimport memcmp, memcpy, memset
+from libc.stdlib cimport malloc, realloc, free
+from libc.math cimport erfc, sqrt
+from rng cimport Rng, rng_seed, rng_next, rng_below, splitmix64
+from bearoff cimport BearoffTable, BearoffDatabase, bearoff_index, bearoff_win_probability
 
 cdef int WHITE = 0
 cdef int BLACK = 1
@@ -16,35 +18,297 @@ cdef int NONE = 2
 np.import_array()
 
 cdef class Move:
-    cdef public bint is_movement_move
-    cdef public signed char src, dst, n, i, j
+    """An immutable move. Every possible move is interned in a shared table and identified by a small integer code:
+    codes 0-35 are the dice rolls (i, j) and the remaining codes are movement moves (src, dst, n)"""
+    def __init__(self):
+        raise TypeError("Moves are interned, use get_move, get_movement_move or get_roll_move instead")
     
     def __hash__(self):
+        return self.code
+
+    def __eq__(self, other):
+        return isinstance(other, Move) and (<Move>other).code == self.code
+
+    def __reduce__(self):
+        return (get_move, (self.code,))
+
+    def __repr__(self):
         if self.is_movement_move:
-            return hash((self.src, self.dst, self.n))
+            return "Move({}, {}, {})".format(self.src, self.dst, self.n)
         else:
-            return hash((self.i, self.j))
+            return "Move({}, {})".format(self.i, self.j)
+
+cdef class Play:
+    """An immutable sequence of the moves that make up a turn, identified by an integer code packing the codes of its
+    moves. State.get_turn_moves returns the plays of a turn and State.do_turn applies one"""
+    def __init__(self, object moves):
+        cdef Move move
+        self.code = 0
+        for move in moves:
+            if play_length(self.code) == MAX_PLAY_MOVES:
+                raise ValueError("A play has at most {} moves".format(MAX_PLAY_MOVES))
+            self.code = play_append(self.code, move.code)
+
+    @property
+    def moves(self):
+        cdef int k
+        return tuple([MOVES[play_move(self.code, k)] for k in range(play_length(self.code))])
+
+    def __len__(self):
+        return play_length(self.code)
+
+    def __hash__(self):
+        return hash(self.code)
+
+    def __eq__(self, other):
+        return isinstance(other, Play) and (<Play>other).code == self.code
+
+    def __reduce__(self):
+        return (get_play, (self.code,))
+
+    def __repr__(self):
+        return "Play([{}])".format(", ".join(repr(move) for move in self.moves))
+
+cdef list MOVES = []
+#Rolls (i, j) with i <= j and the probability of rolling them in either order
+cdef list DISTINCT_ROLLS = [(code, (1.0 if code // 6 == code % 6 else 2.0) / 36.0) for code in range(N_ROLL_MOVES) if code // 6 <= code % 6]
+cdef signed char MOVE_SRC[N_MOVES]
+cdef signed char MOVE_DST[N_MOVES]
+cdef signed char MOVE_N[N_MOVES]
+#Indexed by [src + 1][dst + 1][n], -1 where no such move exists
+cdef short MOVEMENT_CODES[26][26][7]
+
+cdef void _init_moves():
+    cdef Move move
+    cdef int i, j, n, src, dst, code
+    memset(MOVEMENT_CODES, -1, sizeof(MOVEMENT_CODES))
+    for code in range(N_ROLL_MOVES):
+        move = Move.__new__(Move)
+        move.is_movement_move = False
+        move.i = code // 6 + 1
+        move.j = code % 6 + 1
+        move.code = code
+        MOVES.append(move)
+    code = N_ROLL_MOVES
+    for n in range(1, 7):
+        #White moves towards -1 and enters from 24, black moves towards 24 and enters from -1
+        for (src, dst) in [(src, src - n) for src in range(n - 1, 25)] + [(src, src + n) for src in range(-1, 25 - n)]:
+            move = Move.__new__(Move)
+            move.is_movement_move = True
+            move.src = src
+            move.dst = dst
+            move.n = n
+            move.code = code
+            MOVES.append(move)
+            MOVE_SRC[code] = src
+            MOVE_DST[code] = dst
+            MOVE_N[code] = n
+            MOVEMENT_CODES[src + 1][dst + 1][n] = code
+            code += 1
+    assert code == N_MOVES
+
+_init_moves()
+
+#Zobrist keys. The key for a count of zero is zero so that empty points, bars and dice do not contribute
+cdef unsigned long long Z_BOARD[2][24][16]
+cdef unsigned long long Z_BAR[2][16]
+cdef unsigned long long Z_BEARED_OFF[2][16]
+cdef unsigned long long Z_DICE[7][5]
+cdef unsigned long long Z_TURN[3]
+cdef unsigned long long Z_NATURE_TURN, Z_GAME_HAS_STARTED
+
+cdef void _init_zobrist_keys():
+    #Fixed seed so that keys are the same in every process
+    cdef unsigned long long x = 20200101
+    cdef int player, point, count, n
+    global Z_NATURE_TURN, Z_GAME_HAS_STARTED
+    for player in range(2):
+        for count in range(16):
+            for point in range(24):
+                Z_BOARD[player][point][count] = splitmix64(&x) if count > 0 else 0
+            Z_BAR[player][count] = splitmix64(&x) if count > 0 else 0
+            Z_BEARED_OFF[player][count] = splitmix64(&x) if count > 0 else 0
+    for n in range(7):
+        for count in range(5):
+            Z_DICE[n][count] = splitmix64(&x) if count > 0 and n > 0 else 0
+    for player in range(3):
+        Z_TURN[player] = splitmix64(&x)
+    Z_NATURE_TURN = splitmix64(&x)
+    Z_GAME_HAS_STARTED = splitmix64(&x)
+
+_init_zobrist_keys()
+
+cdef class LinearWeights:
+    """Weights of a linear function of the N_FEATURES features of utils.state_to_vector: the number of white's and then
+    black's pieces on each point, followed by the pieces of both players on the bar and borne off. A State given weights
+    keeps intercept + weights . features up to date as moves are made"""
+    def __init__(self, object weights, double intercept=0.0):
+        cdef int i
+        weights = np.asarray(weights, dtype=np.float64).reshape(-1)
+        if weights.shape[0] != N_FEATURES:
+            raise ValueError("Expected {} weights, got {}".format(N_FEATURES, weights.shape[0]))
+        for i in range(N_FEATURES):
+            self.w[i] = weights[i]
+        self.intercept = intercept
+
+    def get_weights(self):
+        return np.asarray(<double [:N_FEATURES]>self.w).copy()
+
+    def __reduce__(self):
+        return (LinearWeights, (self.get_weights(), self.intercept))
+
+    def save(self, path):
+        """Writes the weights to an .npz file that load_linear_weights reads"""
+        np.savez(path, weights=self.get_weights(), intercept=self.intercept)
+
+def load_linear_weights(path):
+    """Reads LinearWeights from an .npz file with a weights array and an intercept"""
+    with np.load(path) as data:
+        return LinearWeights(data['weights'], float(data['intercept']))
+
+cdef extern from *:
+    """
+    #if defined(_MSC_VER)
+    #include <intrin.h>
+    static inline int backgammon_lowest_bit(unsigned int x) { unsigned long i; _BitScanForward(&i, x); return (int)i; }
+    static inline int backgammon_highest_bit(unsigned int x) { unsigned long i; _BitScanReverse(&i, x); return (int)i; }
+    #else
+    static inline int backgammon_lowest_bit(unsigned int x) { return __builtin_ctz(x); }
+    static inline int backgammon_highest_bit(unsigned int x) { return 31 - __builtin_clz(x); }
+    #endif
+    """
+    int lowest_bit "backgammon_lowest_bit" (unsigned int x) noexcept nogil
+    int highest_bit "backgammon_highest_bit" (unsigned int x) noexcept nogil
+
+#Race estimate: the number of rolls a player needs is taken to be normal with mean RACE_ROLLS plus RACE_POINT_ROLLS[d]
+#for each checker needing a die showing d + 1 to bear off, and for each checker outside the home board the rolls to bring
+#it in plus RACE_OUTSIDE_ROLLS. The variance is RACE_VARIANCE_RATIO times the mean. Fitted to the bear-off database,
+#where bearing off by exact dice only makes the checkers on the low points expensive
+cdef double RACE_ROLLS = 4.011
+cdef double RACE_POINT_ROLLS[6]
+RACE_POINT_ROLLS[:] = [1.749, 0.974, 0.942, 0.654, 0.712, 0.585]
+cdef double RACE_OUTSIDE_ROLLS = 0.936
+cdef double RACE_VARIANCE_RATIO = 2.0
+cdef double PIPS_PER_ROLL = 49.0 / 6.0
+
+cdef Rng _RNG
+rng_seed(&_RNG, 1)
+
+cpdef void seed_random(unsigned long long seed):
+    """Seeds the generator used by random playouts"""
+    rng_seed(&_RNG, seed)
+
+cdef inline void _fork_rng(Rng *rng):
+    """Seeds rng from the module generator, so that every call gets an independent stream"""
+    rng_seed(rng, rng_next(&_RNG))
+
+def _new_state():
+    return State.__new__(State)
+
+cdef inline void _write_bits(unsigned char *data, int k, int value, int n) noexcept nogil:
+    cdef int i
+    for i in range(n):
+        if value & (1 << i):
+            data[(k + i) >> 3] |= 1 << ((k + i) & 7)
+
+cdef inline int _read_bits(const unsigned char *data, int k, int n) noexcept nogil:
+    cdef int i, value = 0
+    for i in range(n):
+        if data[(k + i) >> 3] & (1 << ((k + i) & 7)):
+            value |= 1 << i
+    return value
+
+def encode_states(object states):
+    """Returns the to_bytes encodings of states as the rows of an (N, STATE_BYTES) uint8 array"""
+    cdef Py_ssize_t i, n = len(states)
+    cdef unsigned char [:, ::1] data = np.zeros((n, STATE_BYTES), dtype=np.uint8)
+    cdef State state
+    for i in range(n):
+        state = <State?>states[i]
+        if state is None:
+            raise TypeError("Expected a State, got None")
+        state._encode(&data[i, 0])
+    return np.asarray(data)
+
+def decode_states(object data):
+    """Returns the list of states encoded in a buffer of consecutive to_bytes encodings, such as the array returned by
+    encode_states or its bytes"""
+    cdef const unsigned char [::1] flat = np.frombuffer(data, dtype=np.uint8) if isinstance(data, bytes) else np.ascontiguousarray(data, dtype=np.uint8).reshape(-1)
+    cdef Py_ssize_t i
+    cdef State state
+    cdef list states = []
+    if flat.shape[0] % STATE_BYTES != 0:
+        raise ValueError("Expected a multiple of {} bytes, got {}".format(STATE_BYTES, flat.shape[0]))
+    for i in range(flat.shape[0] // STATE_BYTES):
+        state = State.__new__(State)
+        state._decode(&flat[i * STATE_BYTES])
+        states.append(state)
+    return states
+
+cpdef Move get_move(int code):
+    """Returns the interned move with the given code"""
+    if code < 0 or code >= N_MOVES:
+        raise ValueError("Move codes are in [0, {}), got {}".format(N_MOVES, code))
+    return MOVES[code]
+
+cpdef Move get_roll_move(int i, int j):
+    """Returns the interned move for rolling i and j"""
+    if i < 1 or i > 6 or j < 1 or j > 6:
+        return None
+    return MOVES[(i - 1) * 6 + j - 1]
+
+cpdef Move get_movement_move(int src, int dst, int n):
+    """Returns the interned move of a piece from src to dst using a die showing n, or None if no such move exists"""
+    if src < -1 or src > 24 or dst < -1 or dst > 24 or n < 1 or n > 6 or MOVEMENT_CODES[src + 1][dst + 1][n] == -1:
+        return None
+    return MOVES[MOVEMENT_CODES[src + 1][dst + 1][n]]
+
+cpdef Play get_play(unsigned long long code):
+    """Returns the play with the given code"""
+    cdef Play play = Play.__new__(Play)
+    cdef int k, length = play_length(code)
+    if length > MAX_PLAY_MOVES or code >> (3 + 9 * length) != 0:
+        raise ValueError("{} is not the code of a play".format(code))
+    for k in range(length):
+        if play_move(code, k) >= N_MOVES:
+            raise ValueError("{} is not the code of a play".format(code))
+    play.code = code
+    return play
+
+@cython.wraparound(False)
+@cython.boundscheck(False)
+def play_batch_to_end(signed char [:, :, ::1] boards, signed char [:, ::1] bars, signed char [:, ::1] beared_offs, signed char [::1] turns, object seed=None):
+    """Plays a random game to the end from each of N positions given as an (N, 2, 24) board array with (N, 2) bar and
+    borne-off arrays, where in position i player turns[i] is about to roll the dice. Returns an (N,) int8 array of the
+    winners. The games are played one after another by a native loop that runs without the GIL"""
+    cdef Py_ssize_t n = boards.shape[0]
+    cdef Py_ssize_t i
+    cdef State s = State.__new__(State)
+    cdef Rng rng
+    cdef np.ndarray winners = np.empty((n,), dtype=np.int8)
+    cdef signed char [::1] w = winners
+    if boards.shape[1] != 2 or boards.shape[2] != 24 or bars.shape[0] != n or bars.shape[1] != 2 or beared_offs.shape[0] != n or beared_offs.shape[1] != 2 or turns.shape[0] != n:
+        raise ValueError("Expected boards of shape (N, 2, 24), bars and beared_offs of shape (N, 2) and turns of shape (N,)")
+    for i in range(n):
+        if turns[i] != WHITE and turns[i] != BLACK:
+            raise ValueError("turns must be WHITE or BLACK")
+    if seed is None:
+        _fork_rng(&rng)
+    else:
+        rng_seed(&rng, seed)
+    with nogil:
+        for i in range(n):
+            s._load_position(&boards[i, 0, 0], &bars[i, 0], &beared_offs[i, 0], turns[i])
+            w[i] = s._play_game_to_end(&rng, NULL, False)
+    return winners
+
+cdef class Undo:
+    """Record returned by State.do_move for State.undo_move to take the move back"""
+    def __repr__(self):
+        return "Undo({!r})".format(MOVES[self.record.code])
 
 cdef class State:
-    cdef signed char [:, ::1] board
-    cdef signed char [::1] bar, beared_off
-    cdef int turn, turn_number, winner
-    cdef bint _is_nature_turn, game_has_started
-    cdef list legal_moves, _piece_moves_left
-    cdef array.array _array_template
-    
     def __init__(self):
-        self.board = np.zeros((2, 24), dtype=np.int8)
-        self.bar = np.zeros((2,), dtype=np.int8)
-        self.beared_off = np.zeros((2,), dtype=np.int8)
-        self.turn = NONE
-        self.turn_number = 1
-        self.winner = NONE
-        self._is_nature_turn = True
-        self.game_has_started = False
-        self.legal_moves = []
-        self._piece_moves_left = []
-        self._array_template = array.array('i', [])
         self.reset()
 
     cpdef void reset(self):
@@ -52,81 +316,357 @@ cdef class State:
         self.generate_pre_game_2d6_moves()
         
     cpdef void debug_reset_board(self, signed char [:, ::1] board, signed char [::1] bar=np.zeros((2,), dtype=np.int8), signed char [::1] beared_off=np.zeros((2,), dtype=np.int8)):
+        cdef int i, j
         self._reset()
-        self.board = np.copy(board)
-        self.bar = np.copy(bar)
-        self.beared_off = np.copy(beared_off)
+        for i in range(2):
+            for j in range(24):
+                self.board[i][j] = board[i, j]
+            self.bar[i] = bar[i]
+            self.beared_off[i] = beared_off[i]
+        self._compute_incremental()
         self.generate_pre_game_2d6_moves()
 
-    @cython.wraparound(False)
-    @cython.boundscheck(False)
-    @cython.initializedcheck(False)
+    cpdef void copy_from(self, State other):
+        """Overwrites this state with the contents of other without allocating any arrays"""
+        if other is None:
+            raise TypeError("other must not be None")
+        memcpy(self.board, other.board, sizeof(self.board))
+        memcpy(self.bar, other.bar, sizeof(self.bar))
+        memcpy(self.beared_off, other.beared_off, sizeof(self.beared_off))
+        memcpy(self._piece_moves_left, other._piece_moves_left, sizeof(self._piece_moves_left))
+        self._n_piece_moves_left = other._n_piece_moves_left
+        self._hash = other._hash
+        self._linear_weights = other._linear_weights
+        self._linear_score = other._linear_score
+        self._pips[WHITE] = other._pips[WHITE]
+        self._pips[BLACK] = other._pips[BLACK]
+        self._occupied[WHITE] = other._occupied[WHITE]
+        self._occupied[BLACK] = other._occupied[BLACK]
+        self._blocked[WHITE] = other._blocked[WHITE]
+        self._blocked[BLACK] = other._blocked[BLACK]
+        self.turn = other.turn
+        self.turn_number = other.turn_number
+        self.winner = other.winner
+        self._is_nature_turn = other._is_nature_turn
+        self.game_has_started = other.game_has_started
+        memcpy(self._legal_moves, other._legal_moves, other._n_legal_moves * sizeof(short))
+        self._n_legal_moves = other._n_legal_moves
+
+    cdef void _load_position(self, signed char *board, signed char *bar, signed char *beared_off, int turn) noexcept nogil:
+        """Sets up the position at the start of turn's turn, before the dice are rolled"""
+        cdef int player
+        memcpy(self.board, board, sizeof(self.board))
+        memcpy(self.bar, bar, sizeof(self.bar))
+        memcpy(self.beared_off, beared_off, sizeof(self.beared_off))
+        self.turn = turn
+        self.turn_number = 1
+        self.winner = NONE
+        for player in range(2):
+            if self.beared_off[player] == 15:
+                self.winner = player
+        self._is_nature_turn = True
+        self.game_has_started = True
+        self._n_piece_moves_left = 0
+        self._generate_nature_moves()
+        self._compute_incremental()
+
     def __copy__(self):
-        cdef State state
-        cdef Move move 
-        cdef signed char x
-        cdef int i, j
-        state = State()
-        for i in range(2):
-            for j in range(24):
-                state.board[i, j] = self.board[i, j]
-            state.bar[i] = self.bar[i]
-            state.beared_off[i] = self.beared_off[i]
-        state.turn = self.turn
-        state.turn_number = self.turn_number
-        state.winner = self.winner
-        state._is_nature_turn = self._is_nature_turn
-        state.game_has_started = self.game_has_started
-        if self.is_nature_turn():
-            state.legal_moves = state.get_roll_2d6_moves()
+        cdef State state = State.__new__(State)
+        state.copy_from(self)
+        return state
+
+    def __reduce__(self):
+        return (_new_state, (), self.__getstate__())
+
+    def __getstate__(self):
+        return (self.to_bytes(), self.turn_number, self._linear_weights)
+
+    def __setstate__(self, state):
+        cdef bytes data
+        (data, turn_number, self._linear_weights) = state
+        self._decode(data)
+        self.turn_number = turn_number
+
+    cdef int _encode(self, unsigned char *data) except -1:
+        """Writes the STATE_BYTES byte encoding of the state to data. Like the position ID of gnubg, each player's pieces
+        on the 24 points, the bar and borne off are written in unary as one bit per piece followed by a zero bit, 82 bits
+        at most for 15 pieces each. The player to move, the winner, whether it is a nature turn, whether the game has
+        started and the dice left to play follow in 18 bits"""
+        cdef int player, slot, k, n, i
+        for player in range(2):
+            if self.beared_off[player] + self.n_pieces_on_board(player) > 15:
+                raise ValueError("Cannot encode more than 15 pieces of a player")
+        memset(data, 0, STATE_BYTES)
+        k = 0
+        for player in range(2):
+            for slot in range(26):
+                n = self.board[player][slot] if slot < 24 else (self.bar[player] if slot == 24 else self.beared_off[player])
+                for i in range(n):
+                    data[k >> 3] |= 1 << (k & 7)
+                    k += 1
+                k += 1
+        _write_bits(data, 82, self.turn, 2)
+        _write_bits(data, 84, self.winner, 2)
+        _write_bits(data, 86, self._is_nature_turn, 1)
+        _write_bits(data, 87, self.game_has_started, 1)
+        for i in range(self._n_piece_moves_left):
+            _write_bits(data, 88 + 3 * i, self._piece_moves_left[i], 3)
+        return 0
+
+    cdef int _decode(self, const unsigned char *data) except -1:
+        """Sets the state to the one encoded in data by _encode, with the turn number starting over from 1"""
+        cdef int player, slot, k, n, i, total
+        k = 0
+        for player in range(2):
+            total = 0
+            for slot in range(26):
+                n = 0
+                while k < 82 and data[k >> 3] & (1 << (k & 7)):
+                    n += 1
+                    k += 1
+                k += 1
+                total += n
+                if k > 82 or total > 15:
+                    raise ValueError("Invalid state encoding")
+                if slot < 24:
+                    self.board[player][slot] = n
+                elif slot == 24:
+                    self.bar[player] = n
+                else:
+                    self.beared_off[player] = n
+        self.turn = _read_bits(data, 82, 2)
+        self.winner = _read_bits(data, 84, 2)
+        self._is_nature_turn = _read_bits(data, 86, 1)
+        self.game_has_started = _read_bits(data, 87, 1)
+        self._n_piece_moves_left = 0
+        for i in range(4):
+            n = _read_bits(data, 88 + 3 * i, 3)
+            if n == 0:
+                break
+            if n > 6:
+                raise ValueError("Invalid state encoding")
+            self._piece_moves_left[i] = n
+            self._n_piece_moves_left += 1
+        if self.turn > NONE or self.winner > NONE:
+            raise ValueError("Invalid state encoding")
+        self.turn_number = 1
+        self._compute_incremental()
+        if self.winner != NONE:
+            self._n_legal_moves = 0
+        elif self._is_nature_turn:
+            self._generate_nature_moves()
         else:
-            state.legal_moves = [self._new_movement_move(move.src, move.dst, move.n) for move in self.legal_moves]
-        state._piece_moves_left = [x for x in self._piece_moves_left]
+            self._generate_movement_moves()
+        return 0
+
+    cpdef bytes to_bytes(self):
+        """Returns the position, the player to move, the winner, the kind of turn and the dice left to play encoded in
+        STATE_BYTES bytes"""
+        cdef unsigned char data[STATE_BYTES]
+        self._encode(data)
+        return (<char *>data)[:STATE_BYTES]
+
+    @staticmethod
+    def from_bytes(const unsigned char [::1] data):
+        """Returns the state encoded by to_bytes"""
+        cdef State state = State.__new__(State)
+        if data.shape[0] != STATE_BYTES:
+            raise ValueError("Expected {} bytes, got {}".format(STATE_BYTES, data.shape[0]))
+        state._decode(&data[0])
         return state
 
-    cdef Move _new_movement_move(self, signed char src, signed char dst, signed char n):
-        cdef Move move = Move()
-        move.src = src
-        move.dst = dst
-        move.n = n
-        move.is_movement_move = True
-        return move
-    
     cdef void _reset(self):
-        self.board = np.zeros((2, 24), dtype=np.int8)
-        self.bar = np.zeros((2,), dtype=np.int8)
-        self.beared_off = np.zeros((2,), dtype=np.int8)
+        memset(self.board, 0, sizeof(self.board))
+        memset(self.bar, 0, sizeof(self.bar))
+        memset(self.beared_off, 0, sizeof(self.beared_off))
         self.turn = NONE
         self.turn_number = 1
         self._is_nature_turn = True
         self.game_has_started = False
-        self._piece_moves_left = []
+        self._n_piece_moves_left = 0
         self.winner = NONE
         #Place white pieces
-        self.board[WHITE, 23] = 2
-        self.board[WHITE, 12] = 5
-        self.board[WHITE, 7] = 3
-        self.board[WHITE, 5] = 5
+        self.board[WHITE][23] = 2
+        self.board[WHITE][12] = 5
+        self.board[WHITE][7] = 3
+        self.board[WHITE][5] = 5
         #Place black pieces
-        self.board[BLACK, 0] = 2
-        self.board[BLACK, 11] = 5
-        self.board[BLACK, 16] = 3
-        self.board[BLACK, 18] = 5
+        self.board[BLACK][0] = 2
+        self.board[BLACK][11] = 5
+        self.board[BLACK][16] = 3
+        self.board[BLACK][18] = 5
+        self._compute_incremental()
+
+    cdef unsigned long long _compute_hash(self) noexcept nogil:
+        """Computes the Zobrist key of the state from scratch. do_move keeps the key up to date incrementally"""
+        cdef unsigned long long h = 0
+        cdef int player, point, n
+        for player in range(2):
+            for point in range(24):
+                h ^= Z_BOARD[player][point][self.board[player][point]]
+            h ^= Z_BAR[player][self.bar[player]]
+            h ^= Z_BEARED_OFF[player][self.beared_off[player]]
+        for n in range(1, 7):
+            h ^= Z_DICE[n][self._count_piece_moves(n)]
+        h ^= Z_TURN[self.turn]
+        if self._is_nature_turn:
+            h ^= Z_NATURE_TURN
+        if self.game_has_started:
+            h ^= Z_GAME_HAS_STARTED
+        return h
+
+    cpdef unsigned long long get_hash(self):
+        """Returns the 64 bit Zobrist key of the position, the side to move, the dice left to play and whether it is a
+        nature turn"""
+        return self._hash
+
+    cdef void _compute_incremental(self) noexcept nogil:
+        """Recomputes from scratch everything that do_move keeps up to date incrementally"""
+        cdef int player, point
+        self._hash = self._compute_hash()
+        self._linear_score = self._compute_linear_score()
+        for player in range(2):
+            self._pips[player] = 25 * self.bar[player]
+            self._occupied[player] = 0
+            self._blocked[player] = 0
+            for point in range(24):
+                self._pips[player] += self.board[player][point] * (point + 1 if player == WHITE else 24 - point)
+                if self.board[player][point] > 0:
+                    self._occupied[player] |= 1u << point
+                if self.board[player][point] > 1:
+                    self._blocked[player] |= 1u << point
+
+    cdef double _compute_linear_score(self) noexcept nogil:
+        """Computes the linear value of the state from scratch. do_move keeps it up to date incrementally"""
+        cdef double score
+        cdef int player, point
+        if self._linear_weights is None:
+            return 0.0
+        score = self._linear_weights.intercept
+        for player in range(2):
+            for point in range(24):
+                score += self._linear_weights.w[player * 24 + point] * self.board[player][point]
+            score += self._linear_weights.w[48 + player] * self.bar[player]
+            score += self._linear_weights.w[50 + player] * self.beared_off[player]
+        return score
+
+    cpdef void set_linear_weights(self, LinearWeights weights):
+        """Makes the state keep the linear value of its position under weights, or stop doing so if weights is None"""
+        self._linear_weights = weights
+        self._linear_score = self._compute_linear_score()
+
+    cpdef LinearWeights get_linear_weights(self):
+        return self._linear_weights
+
+    cpdef double linear_value(self) except? -1:
+        """Returns intercept + weights . features for the weights given to set_linear_weights"""
+        if self._linear_weights is None:
+            raise ValueError("The state has no linear weights")
+        return self._linear_score
+
+    cdef double _linear_value(self) noexcept nogil:
+        return self._linear_score
+
+    cdef inline void _set_board(self, int player, int point, int count) noexcept nogil:
+        self._hash ^= Z_BOARD[player][point][self.board[player][point]] ^ Z_BOARD[player][point][count]
+        if self._linear_weights is not None:
+            self._linear_score += self._linear_weights.w[player * 24 + point] * (count - self.board[player][point])
+        self._pips[player] += (count - self.board[player][point]) * (point + 1 if player == WHITE else 24 - point)
+        if count > 0:
+            self._occupied[player] |= 1u << point
+        else:
+            self._occupied[player] &= ~(1u << point)
+        if count > 1:
+            self._blocked[player] |= 1u << point
+        else:
+            self._blocked[player] &= ~(1u << point)
+        self.board[player][point] = count
+
+    cdef inline void _set_bar(self, int player, int count) noexcept nogil:
+        self._hash ^= Z_BAR[player][self.bar[player]] ^ Z_BAR[player][count]
+        if self._linear_weights is not None:
+            self._linear_score += self._linear_weights.w[48 + player] * (count - self.bar[player])
+        self._pips[player] += 25 * (count - self.bar[player])
+        self.bar[player] = count
+
+    cdef inline void _set_beared_off(self, int player, int count) noexcept nogil:
+        self._hash ^= Z_BEARED_OFF[player][self.beared_off[player]] ^ Z_BEARED_OFF[player][count]
+        if self._linear_weights is not None:
+            self._linear_score += self._linear_weights.w[50 + player] * (count - self.beared_off[player])
+        self.beared_off[player] = count
+
+    cdef inline void _set_turn(self, int player) noexcept nogil:
+        self._hash ^= Z_TURN[self.turn] ^ Z_TURN[player]
+        self.turn = player
+
+    cdef inline void _set_nature_turn(self, bint is_nature_turn) noexcept nogil:
+        if self._is_nature_turn != is_nature_turn:
+            self._hash ^= Z_NATURE_TURN
+        self._is_nature_turn = is_nature_turn
+
+    cdef np.ndarray _view(self, signed char *data, int nd, np.npy_intp *shape):
+        """Wraps data owned by this state in a NumPy array that keeps the state alive"""
+        cdef np.ndarray arr = np.PyArray_SimpleNewFromData(nd, shape, np.NPY_INT8, data)
+        np.set_array_base(arr, self)
+        return arr
 
     def get_board(self):
-        return np.asarray(self.board)
+        cdef np.npy_intp shape[2]
+        shape[0] = 2
+        shape[1] = 24
+        return self._view(&self.board[0][0], 2, shape)
 
     def get_bar(self):
-        return np.asarray(self.bar)
+        cdef np.npy_intp shape[1]
+        shape[0] = 2
+        return self._view(&self.bar[0], 1, shape)
 
     def get_beared_off(self):
-        return np.asarray(self.beared_off)
+        cdef np.npy_intp shape[1]
+        shape[0] = 2
+        return self._view(&self.beared_off[0], 1, shape)
+
+    cpdef bint same_position(self, State other):
+        """Returns True if other is in the same position as this state with the same dice left to play, regardless of the
+        order the dice were rolled in"""
+        cdef int n
+        if (memcmp(self.board, other.board, sizeof(self.board)) != 0 or memcmp(self.bar, other.bar, sizeof(self.bar)) != 0
+                or memcmp(self.beared_off, other.beared_off, sizeof(self.beared_off)) != 0 or self.turn != other.turn
+                or self.winner != other.winner or self._is_nature_turn != other._is_nature_turn
+                or self.game_has_started != other.game_has_started or self._n_piece_moves_left != other._n_piece_moves_left):
+            return False
+        for n in range(1, 7):
+            if self._count_piece_moves(n) != other._count_piece_moves(n):
+                return False
+        return True
+
+    cpdef bytes position_key(self):
+        """Returns an encoding of the position that is equal for two states exactly when same_position holds between them:
+        the board, bar and borne off pieces, then the player to move, the winner, whether it is a nature turn, whether the
+        game has started and how many of each die are left to play"""
+        cdef signed char key[62]
+        cdef int n
+        memcpy(key, self.board, 48)
+        memcpy(&key[48], self.bar, 2)
+        memcpy(&key[50], self.beared_off, 2)
+        key[52] = self.turn
+        key[53] = self.winner
+        key[54] = self._is_nature_turn
+        key[55] = self.game_has_started
+        for n in range(1, 7):
+            key[55 + n] = self._count_piece_moves(n)
+        return (<char *>key)[:62]
 
     cpdef int get_player_turn(self):
         return self.turn
 
     cpdef list get_moves(self):
-        return self.legal_moves
+        cdef int k
+        return [MOVES[self._legal_moves[k]] for k in range(self._n_legal_moves)]
+
+    cpdef list get_move_codes(self):
+        cdef int k
+        return [self._legal_moves[k] for k in range(self._n_legal_moves)]
 
     cpdef int get_winner(self):
         return self.winner
@@ -138,56 +678,148 @@ cdef class State:
         return self.game_has_started
 
     cpdef void set_nature_turn(self, bint is_nature_turn):
-        self._is_nature_turn = is_nature_turn
+        self._set_nature_turn(is_nature_turn)
 
     cpdef void set_turn(self, int player):
-        self.turn = player
+        self._set_turn(player)
 
-    @cython.wraparound(False)
-    @cython.boundscheck(False)    
-    @cython.nonecheck(False)
-    cpdef int play_game_to_end(self):
-        cdef int i, n_moves
-        cdef list moves
-        while not self.game_ended():
-            moves = self.get_moves()
-            n_moves = len(moves)
-            i = int(rand() / RAND_MAX * n_moves)
-            self.do_move(moves[i])
-        return self.get_winner()
+    cpdef int play_game_to_end(self, BearoffDatabase bearoff=None, bint stop_at_race=False):
+        """Plays random moves until the game ends and returns the winner. Given a bear-off database, stops as soon as both
+        players are bearing off at the start of a turn, and with stop_at_race as soon as contact is broken, and returns
+        NONE. race_win_probability then estimates the outcome"""
+        cdef Rng rng
+        cdef const BearoffTable *table = NULL if bearoff is None else &bearoff.table
+        _fork_rng(&rng)
+        with nogil:
+            return self._play_game_to_end(&rng, table, stop_at_race)
 
-    @cython.wraparound(False)
-    @cython.boundscheck(False)    
-    @cython.nonecheck(False)
-    cpdef int play_game_to_depth(self, int depth):
-        cdef int i, ply, n_moves
-        cdef list moves
-        ply = 0
-        while not self.game_ended() and ply < depth:
-            moves = self.get_moves()
-            n_moves = len(moves)
-            i = int(rand() / RAND_MAX * n_moves)
-            self.do_move(moves[i])
+    cpdef int play_game_to_depth(self, int depth, BearoffDatabase bearoff=None, bint stop_at_race=False):
+        """Plays depth random moves, or until the game ends or stops early like play_game_to_end"""
+        cdef Rng rng
+        cdef const BearoffTable *table = NULL if bearoff is None else &bearoff.table
+        _fork_rng(&rng)
+        with nogil:
+            return self._play_game_to_depth(depth, &rng, table, stop_at_race)
+
+    cdef bint _should_stop(self, const BearoffTable *bearoff, bint stop_at_race) noexcept nogil:
+        if not self._is_nature_turn or not self.game_has_started:
+            return False
+        return (stop_at_race and self._is_race()) or (bearoff != NULL and self._is_bearoff())
+
+    cdef int _play_game_to_end(self, Rng *rng, const BearoffTable *bearoff, bint stop_at_race) noexcept nogil:
+        """Plays random moves until the game ends, drawing from the caller's generator rng, or until it reaches a bear-off
+        if bearoff is not NULL or a race if stop_at_race is set"""
+        while self.winner == NONE:
+            if (bearoff != NULL or stop_at_race) and self._should_stop(bearoff, stop_at_race):
+                break
+            self._do_move_code(self._legal_moves[rng_below(rng, self._n_legal_moves)])
+        return self.winner
+
+    cdef int _play_game_to_depth(self, int depth, Rng *rng, const BearoffTable *bearoff, bint stop_at_race) noexcept nogil:
+        cdef int ply = 0
+        while self.winner == NONE and ply < depth:
+            if (bearoff != NULL or stop_at_race) and self._should_stop(bearoff, stop_at_race):
+                break
+            self._do_move_code(self._legal_moves[rng_below(rng, self._n_legal_moves)])
             ply += 1
-        return self.get_winner()
+        return self.winner
+
+    cpdef int pip_count(self, int player):
+        """Returns the number of pips player has to move to bear off every piece"""
+        return self._pips[player]
+
+    cpdef bint is_race(self):
+        """Returns True once contact is broken, when every white piece has passed every black piece"""
+        return self._is_race()
+
+    cdef bint _is_race(self) noexcept nogil:
+        if self.bar[WHITE] > 0 or self.bar[BLACK] > 0:
+            return False
+        if self._occupied[WHITE] == 0 or self._occupied[BLACK] == 0:
+            return True
+        return highest_bit(self._occupied[WHITE]) < lowest_bit(self._occupied[BLACK])
+
+    cdef double _race_rolls(self, int player) noexcept nogil:
+        """Returns the estimated mean number of rolls player needs to bear off"""
+        cdef double rolls = RACE_ROLLS
+        cdef int d, point, distance
+        if self.beared_off[player] == 15:
+            return 0.0
+        for d in range(6):
+            rolls += RACE_POINT_ROLLS[d] * self.board[player][d if player == WHITE else 23 - d]
+        for d in range(6, 24):
+            point = d if player == WHITE else 23 - d
+            if self.board[player][point] > 0:
+                rolls += self.board[player][point] * ((d - 5) / PIPS_PER_ROLL + RACE_OUTSIDE_ROLLS)
+        return rolls
+
+    cpdef double race_win_probability(self, BearoffDatabase bearoff=None) except? -1:
+        """Estimates the probability of white winning a race from the start of a turn, exactly with a bear-off database
+        once both players are bearing off"""
+        if not self._is_nature_turn or not self.game_has_started or self.winner != NONE or not self._is_race():
+            raise ValueError("Contact must be broken and the dice not yet rolled")
+        return self._race_win_probability(NULL if bearoff is None else &bearoff.table)
+
+    cdef double _race_win_probability(self, const BearoffTable *bearoff) noexcept nogil:
+        cdef double on_roll, other, p
+        if bearoff != NULL and self._is_bearoff():
+            return self._bearoff_win_probability(bearoff)
+        on_roll = self._race_rolls(self.turn)
+        other = self._race_rolls(1 - self.turn)
+        #The player on roll wins ties, as they finish first
+        p = 0.5 * erfc(-(other - on_roll + 0.5) / sqrt(2.0 * RACE_VARIANCE_RATIO * (on_roll + other)))
+        return p if self.turn == WHITE else 1.0 - p
+
+    cpdef bint is_bearoff(self):
+        """Returns True if both players have all their pieces that are not borne off in their home board"""
+        return self._is_bearoff()
+
+    cdef bint _is_bearoff(self) noexcept nogil:
+        cdef int i
+        if self.bar[WHITE] > 0 or self.bar[BLACK] > 0:
+            return False
+        for i in range(6, 24):
+            if self.board[WHITE][i] > 0 or self.board[BLACK][23 - i] > 0:
+                return False
+        return True
+
+    cdef bint _at_bearoff(self) noexcept nogil:
+        """Returns True at the start of a turn of a game in which both players are bearing off"""
+        return self._is_nature_turn and self.game_has_started and self.winner == NONE and self._is_bearoff()
+
+    cpdef double bearoff_win_probability(self, BearoffDatabase bearoff) except? -1:
+        """Returns the exact probability of white winning from the start of a turn at which both players are bearing off"""
+        if not self._at_bearoff():
+            raise ValueError("Both players must be bearing off and the dice not yet rolled")
+        return self._bearoff_win_probability(&bearoff.table)
+
+    cdef double _bearoff_win_probability(self, const BearoffTable *bearoff) noexcept nogil:
+        cdef int counts[2][6]
+        cdef int d
+        cdef double p
+        for d in range(6):
+            counts[WHITE][d] = self.board[WHITE][d]
+            counts[BLACK][d] = self.board[BLACK][23 - d]
+        p = bearoff_win_probability(bearoff, bearoff_index(bearoff, counts[self.turn]), bearoff_index(bearoff, counts[1 - self.turn]))
+        return p if self.turn == WHITE else 1.0 - p
 
     @cython.wraparound(False)
     @cython.boundscheck(False)
     @cython.initializedcheck(False)
-    cdef bint _has_piece(self, int point) nogil:
+    cdef bint _has_piece(self, int point) noexcept nogil:
         """Returns True if point has a piece belonging to the player whose turn it is"""
-        return self.board[self.turn, point] > 0
+        return self.board[self.turn][point] > 0
     
     @cython.wraparound(False)
     @cython.boundscheck(False)
     @cython.initializedcheck(False)
-    cdef int _forward(self, int point, int n) nogil:
+    cdef int _forward(self, int point, int n) noexcept nogil:
         cdef int new_point
         """Gets point n steps forward from point from the perspective of the player whose turn it is. Returns -1 if no such point exists or is unmovable"""
         new_point = point - n if self.turn == WHITE else point + n
         new_point = new_point if new_point >= 0 and new_point < 24 else -1
         if new_point != -1:
-            new_point = new_point if self.board[self._other_player(), new_point] <= 1 else -1
+            new_point = new_point if self.board[self._other_player()][new_point] <= 1 else -1
         return new_point
 
     cpdef int bar_point(self):
@@ -196,64 +828,116 @@ cdef class State:
     cpdef int bearing_off_point(self):
         return -1 if self.turn == WHITE else 24
 
-    cdef int _bar_point(self) nogil:
+    cdef int _bar_point(self) noexcept nogil:
         return -1 if self.turn == BLACK else 24
 
-    cdef int _bearing_off_point(self) nogil:
+    cdef int _bearing_off_point(self) noexcept nogil:
         return -1 if self.turn == WHITE else 24
 
-    @cython.wraparound(False)
-    @cython.boundscheck(False)
-    cdef array.array _get_points_with_pieces(self):
-        cdef array.array points = array.clone(self._array_template, 0, False)
-        cdef int i, point
-        i = 0
-        for point in range(24):
-            if self._has_piece(point):
-                array.resize_smart(points, i + 1)
-                points[i] = point
-                i += 1
-        return points
-
     @cython.wraparound(False)
     @cython.boundscheck(False)
     @cython.initializedcheck(False)
     cpdef list get_movement_moves(self):
         """Returns a list of all possible moves that can be made using the rolls from numbers obtained from a particular pair of dice"""
-        cdef list legal_moves = []
-        cdef int i, src, dest, n
-        cdef array.array points_with_pieces = self._get_points_with_pieces()#[point for point in range(24) if self._has_piece(point)]
-        for n in set(self._piece_moves_left):
+        cdef short codes[MAX_LEGAL_MOVES]
+        cdef int k, n_codes
+        n_codes = self._get_movement_move_codes(codes)
+        return [MOVES[codes[k]] for k in range(n_codes)]
+
+    @cython.wraparound(False)
+    @cython.boundscheck(False)
+    cdef int _get_movement_move_codes(self, short *codes) noexcept nogil:
+        """Writes the codes of all possible movement moves to codes and returns how many there are. For each die, the
+        points that can move are found with the occupied and blocked bitmasks and read off in increasing order"""
+        cdef int n_codes = 0
+        cdef int k, src, dest, n
+        cdef unsigned int dice = 0
+        cdef unsigned int sources
+        cdef bint can_bear_off = self.bar[self.turn] == 0 and self._can_bear_off()
+        for k in range(self._n_piece_moves_left):
+            dice |= 1u << self._piece_moves_left[k]
+        for n in range(1, 7):
+            if not dice & (1u << n):
+                continue
             if self.bar[self.turn] > 0:
                 dest = self._forward(self._bar_point(), n)
                 if dest > -1:
-                    legal_moves.append(self._new_movement_move(self._bar_point(), dest, n))
+                    codes[n_codes] = MOVEMENT_CODES[self._bar_point() + 1][dest + 1][n]
+                    n_codes += 1
+                continue
+            if can_bear_off:
+                src = n - 1 if self.turn == WHITE else 24 - n
+                if self._has_piece(src):
+                    codes[n_codes] = MOVEMENT_CODES[src + 1][self._bearing_off_point() + 1][n]
+                    n_codes += 1
+            #Points with a piece whose destination n points ahead is on the board and not blocked
+            if self.turn == WHITE:
+                sources = self._occupied[WHITE] & ~(self._blocked[BLACK] << n) & ~((1u << n) - 1)
             else:
-                if self._can_bear_off():
-                    if self._has_piece(n - 1 if self.turn == WHITE else 24 - n):
-                        legal_moves.append(self._new_movement_move(n - 1 if self.turn == WHITE else 24 - n, self._bearing_off_point(), n))
-                for i in range(len(points_with_pieces)):
-                    src = points_with_pieces[i]
-                    dest = self._forward(src, n)
-                    if dest > -1:
-                        legal_moves.append(self._new_movement_move(src, dest, n))
-
-        return legal_moves
-
-    cdef void _generate_piece_moves_from_dice(self, Move dice):
-        self._piece_moves_left.clear()
-        if dice.i == dice.j:
-            self._piece_moves_left = [dice.i] * 4
+                sources = self._occupied[BLACK] & ~(self._blocked[WHITE] >> n) & ((1u << (24 - n)) - 1)
+            while sources:
+                src = lowest_bit(sources)
+                sources &= sources - 1
+                codes[n_codes] = MOVEMENT_CODES[src + 1][(src - n if self.turn == WHITE else src + n) + 1][n]
+                n_codes += 1
+        return n_codes
+
+    cdef void _generate_piece_moves_from_dice(self, int i, int j) noexcept nogil:
+        cdef int k
+        self._clear_piece_moves()
+        if i == j:
+            for k in range(4):
+                self._piece_moves_left[k] = i
+            self._n_piece_moves_left = 4
+            self._hash ^= Z_DICE[i][4]
         else:
-            self._piece_moves_left = [dice.i, dice.j]
+            self._piece_moves_left[0] = i
+            self._piece_moves_left[1] = j
+            self._n_piece_moves_left = 2
+            self._hash ^= Z_DICE[i][1] ^ Z_DICE[j][1]
+
+    cdef void _clear_piece_moves(self) noexcept nogil:
+        cdef int n
+        for n in range(1, 7):
+            self._hash ^= Z_DICE[n][self._count_piece_moves(n)]
+        self._n_piece_moves_left = 0
+
+    cdef int _count_piece_moves(self, int n) noexcept nogil:
+        cdef int k, count
+        count = 0
+        for k in range(self._n_piece_moves_left):
+            if self._piece_moves_left[k] == n:
+                count += 1
+        return count
+
+    cdef bint _has_piece_move(self, int n) noexcept nogil:
+        cdef int k
+        for k in range(self._n_piece_moves_left):
+            if self._piece_moves_left[k] == n:
+                return True
+        return False
+
+    cdef void _use_piece_move(self, signed char n) noexcept nogil:
+        """Removes one die showing n from the dice left to play this turn"""
+        cdef int k, count
+        count = self._count_piece_moves(n)
+        for k in range(self._n_piece_moves_left):
+            if self._piece_moves_left[k] == n:
+                self._hash ^= Z_DICE[n][count] ^ Z_DICE[n][count - 1]
+                self._n_piece_moves_left -= 1
+                self._piece_moves_left[k] = self._piece_moves_left[self._n_piece_moves_left]
+                return
 
     cpdef void generate_movement_moves(self):
-        self.legal_moves = self.get_movement_moves()
+        self._generate_movement_moves()
+
+    cdef void _generate_movement_moves(self) noexcept nogil:
+        self._n_legal_moves = self._get_movement_move_codes(self._legal_moves)
 
     cpdef int other_player(self):
         return WHITE if self.turn == BLACK else BLACK if self.turn == WHITE else NONE
 
-    cdef int _other_player(self) nogil:
+    cdef int _other_player(self) noexcept nogil:
         return WHITE if self.turn == BLACK else BLACK if self.turn == WHITE else NONE
 
     cpdef bint can_bear_off(self):
@@ -262,78 +946,269 @@ cdef class State:
     @cython.wraparound(False)
     @cython.boundscheck(False)
     @cython.initializedcheck(False)
-    cdef bint _can_bear_off(self) nogil:
+    cdef bint _can_bear_off(self) noexcept nogil:
         """Returns True if current player can bear off pieces"""
-        cdef int lower, upper, i
         if self.turn == WHITE:
-            lower = 6
-            upper = 24
+            return self._occupied[WHITE] & ~0x3Fu == 0
+        return self._occupied[BLACK] & 0x3FFFFu == 0
+
+    cdef bint _is_legal(self, int code) noexcept nogil:
+        """Returns True if the move with the given code is one of the legal moves of the current position"""
+        cdef int i
+        for i in range(self._n_legal_moves):
+            if self._legal_moves[i] == code:
+                return True
+        return False
+
+    cpdef Undo do_move(self, Move move):
+        """Applies move, which must be one of get_moves, and returns the record that undo_move takes to take it back"""
+        cdef Undo undo = Undo.__new__(Undo)
+        if move is None:
+            raise TypeError("move must not be None")
+        if not self._is_legal(move.code):
+            raise ValueError("{} is not a legal move".format(move))
+        self._do_move_undo(move.code, &undo.record)
+        return undo
+
+    cpdef void undo_move(self, Undo undo):
+        """Takes back the last move applied, given the record do_move returned for it"""
+        if undo is None:
+            raise TypeError("undo must not be None")
+        self._undo_move(&undo.record)
+
+    cdef void _do_move_undo(self, int code, UndoRecord *undo) noexcept nogil:
+        """Applies the move with the given code after saving in undo what _undo_move needs to take it back"""
+        cdef int dst = MOVE_DST[code]
+        undo.code = code
+        undo.hit = not self._is_nature_turn and dst != -1 and dst != 24 and self.board[self._other_player()][dst] == 1
+        undo.turn = self.turn
+        undo.winner = self.winner
+        undo.is_nature_turn = self._is_nature_turn
+        undo.game_has_started = self.game_has_started
+        memcpy(undo.piece_moves_left, self._piece_moves_left, sizeof(self._piece_moves_left))
+        undo.n_piece_moves_left = self._n_piece_moves_left
+        undo.turn_number = self.turn_number
+        undo.hash = self._hash
+        undo.linear_score = self._linear_score
+        self._do_move_code(code)
+
+    cdef void _undo_move(self, const UndoRecord *undo) noexcept nogil:
+        """Restores the state from before the move recorded in undo, which must be the last move applied"""
+        cdef int player = undo.turn
+        cdef int other = BLACK if player == WHITE else WHITE
+        cdef int src, dst
+        if not undo.is_nature_turn:
+            src = MOVE_SRC[undo.code]
+            dst = MOVE_DST[undo.code]
+            if dst == -1 or dst == 24:
+                self._set_beared_off(player, self.beared_off[player] - 1)
+            else:
+                self._set_board(player, dst, self.board[player][dst] - 1)
+                if undo.hit:
+                    self._set_board(other, dst, 1)
+                    self._set_bar(other, self.bar[other] - 1)
+            if src == -1 or src == 24:
+                self._set_bar(player, self.bar[player] + 1)
+            else:
+                self._set_board(player, src, self.board[player][src] + 1)
+        self.turn = undo.turn
+        self.winner = undo.winner
+        self._is_nature_turn = undo.is_nature_turn
+        self.game_has_started = undo.game_has_started
+        memcpy(self._piece_moves_left, undo.piece_moves_left, sizeof(self._piece_moves_left))
+        self._n_piece_moves_left = undo.n_piece_moves_left
+        self.turn_number = undo.turn_number
+        self._hash = undo.hash
+        self._linear_score = undo.linear_score
+        #The legal moves depend only on what was restored, so they are generated again rather than saved
+        if self._is_nature_turn:
+            self._generate_nature_moves()
         else:
-            lower = 0
-            upper = 18
+            self._generate_movement_moves()
 
-        for i in range(lower, upper, 1):
-            if self.board[self.turn, i] > 0:
-                return False
-        return True
+    cpdef list get_turn_moves(self):
+        """Returns every way of playing the dice left this turn as a Play, one for each position the turn can end in.
+        Unlike single moves, a play has to use as many of the dice as possible and, when only one of two different dice
+        can be used, the larger one if it can be"""
+        return [get_play(code) for code in self.get_turn_move_codes()]
+
+    cpdef list get_turn_move_codes(self):
+        """Returns the codes of the plays of get_turn_moves"""
+        cdef TurnSearch search
+        cdef TurnEnd *end
+        cdef int k, max_used, larger = 0
+        cdef bint larger_only = False
+        cdef set keys = set()
+        cdef list plays = []
+        if self._is_nature_turn or self.winner != NONE:
+            raise ValueError("There are no dice to play")
+        search.n = 0
+        search.capacity = 64
+        search.doubles = True
+        for k in range(self._n_piece_moves_left):
+            search.doubles = search.doubles and self._piece_moves_left[k] == self._piece_moves_left[0]
+            larger = max(larger, self._piece_moves_left[k])
+        search.ends = <TurnEnd *>malloc(search.capacity * sizeof(TurnEnd))
+        if search.ends == NULL:
+            raise MemoryError()
+        try:
+            self._search_turn(0, 24 if self.turn == WHITE else -1, &search)
+            max_used = 0
+            for k in range(search.n):
+                max_used = max(max_used, search.ends[k].used)
+            if max_used == 1 and not search.doubles:
+                for k in range(search.n):
+                    larger_only = larger_only or MOVE_N[play_move(search.ends[k].play, 0)] == larger
+            for k in range(search.n):
+                end = &search.ends[k]
+                if end.used < max_used or (larger_only and MOVE_N[play_move(end.play, 0)] != larger) or end.key in keys:
+                    continue
+                keys.add(end.key)
+                plays.append(end.play)
+        finally:
+            free(search.ends)
+        return plays
+
+    cdef int _search_turn(self, unsigned long long play, int last_src, TurnSearch *search) except -1:
+        """Applies every legal move in turn after the moves of play and records each play after which the turn is over.
+        With doubles, the moves are only tried in order of their source point from the bar towards home, which reaches
+        every position the turn can end in with fewer sequences"""
+        cdef short codes[MAX_LEGAL_MOVES]
+        cdef int k, src, n_codes = self._n_legal_moves
+        cdef UndoRecord undo
+        cdef TurnEnd *ends
+        memcpy(codes, self._legal_moves, n_codes * sizeof(short))
+        for k in range(n_codes):
+            src = MOVE_SRC[codes[k]]
+            if search.doubles and (src > last_src if self.turn == WHITE else src < last_src):
+                continue
+            self._do_move_undo(codes[k], &undo)
+            try:
+                if self._is_nature_turn or self.winner != NONE:
+                    if search.n == search.capacity:
+                        ends = <TurnEnd *>realloc(search.ends, 2 * search.capacity * sizeof(TurnEnd))
+                        if ends == NULL:
+                            raise MemoryError()
+                        search.ends = ends
+                        search.capacity *= 2
+                    search.ends[search.n].play = play_append(play, codes[k])
+                    search.ends[search.n].key = self._hash
+                    #Bearing off the last piece ends the game with every die that was needed used
+                    search.ends[search.n].used = MAX_PLAY_MOVES if self.winner != NONE else play_length(play) + 1
+                    search.n += 1
+                else:
+                    self._search_turn(play_append(play, codes[k]), src, search)
+            finally:
+                self._undo_move(&undo)
+        return 0
+
+    cpdef void do_turn(self, Play play):
+        """Applies the moves of play, which has to end the turn in one of the positions the plays of get_turn_moves end
+        it in, whatever the order of its moves"""
+        cdef UndoRecord undos[MAX_PLAY_MOVES]
+        cdef unsigned long long code
+        cdef set keys = set()
+        cdef int applied = 0
+        if play is None:
+            raise TypeError("play must not be None")
+        for code in self.get_turn_move_codes():
+            keys.add(self._play_key(code))
+        while applied < play_length(play.code) and self._is_legal(play_move(play.code, applied)):
+            self._do_move_undo(play_move(play.code, applied), &undos[applied])
+            applied += 1
+        if applied < play_length(play.code) or not (self._is_nature_turn or self.winner != NONE) or self._hash not in keys:
+            while applied > 0:
+                applied -= 1
+                self._undo_move(&undos[applied])
+            raise ValueError("{} is not a legal play".format(play))
+
+    cdef unsigned long long _play_key(self, unsigned long long play) noexcept nogil:
+        """Returns the Zobrist key of the position play leads to, leaving the state as it was"""
+        cdef UndoRecord undos[MAX_PLAY_MOVES]
+        cdef unsigned long long key
+        cdef int k
+        for k in range(play_length(play)):
+            self._do_move_undo(play_move(play, k), &undos[k])
+        key = self._hash
+        for k in reversed(range(play_length(play))):
+            self._undo_move(&undos[k])
+        return key
+
+    cdef void _do_play(self, unsigned long long play) noexcept nogil:
+        cdef int k
+        for k in range(play_length(play)):
+            self._do_move_code(play_move(play, k))
+
+    cpdef void do_move_code(self, int code):
+        """Applies the move with the given code, which must be one of get_move_codes"""
+        if code < 0 or code >= N_MOVES or not self._is_legal(code):
+            raise ValueError("{} is not the code of a legal move".format(code))
+        self._do_move_code(code)
 
     @cython.wraparound(False)
     @cython.boundscheck(False)
     @cython.initializedcheck(False)
-    cpdef void do_move(self, Move move):
-        if self.is_nature_turn():
-            if self.has_game_started():
-                self._generate_piece_moves_from_dice(move)
-                self.generate_movement_moves()
-                self.set_nature_turn(False)
-                if len(self.legal_moves) == 0:
+    @cython.cdivision(True)
+    cdef void _do_move_code(self, int code) noexcept nogil:
+        cdef int i, j, src, dst
+        if self._is_nature_turn:
+            i = code // 6 + 1
+            j = code % 6 + 1
+            if self.game_has_started:
+                self._generate_piece_moves_from_dice(i, j)
+                self._generate_movement_moves()
+                self._set_nature_turn(False)
+                if self._n_legal_moves == 0:
                     self._goto_next_turn()
             else:
-                if move.i == move.j:
-                    self.generate_pre_game_2d6_moves()
+                if i == j:
+                    self._generate_nature_moves()
                 else:
-                    if move.i > move.j:
-                        self.set_turn(WHITE)
+                    if i > j:
+                        self._set_turn(WHITE)
                     else:
-                        self.set_turn(BLACK)
+                        self._set_turn(BLACK)
                     self.game_has_started = True
-                    self._generate_piece_moves_from_dice(move)
-                    self.generate_movement_moves()
-                    self.set_nature_turn(False)
-                    if len(self.legal_moves) == 0:
+                    self._hash ^= Z_GAME_HAS_STARTED
+                    self._generate_piece_moves_from_dice(i, j)
+                    self._generate_movement_moves()
+                    self._set_nature_turn(False)
+                    if self._n_legal_moves == 0:
                         self._goto_next_turn()
         else:
+            src = MOVE_SRC[code]
+            dst = MOVE_DST[code]
             #Move piece
             #Moving off bar
-            if move.src in [-1, 24]:
-                self.bar[self.turn] -= 1
+            if src == -1 or src == 24:
+                self._set_bar(self.turn, self.bar[self.turn] - 1)
             #Movement
             else:
-                self.board[self.turn, move.src] -= 1
+                self._set_board(self.turn, src, self.board[self.turn][src] - 1)
             #Bearing off
-            if move.dst in [-1, 24]:
-                self.beared_off[self.turn] += 1
+            if dst == -1 or dst == 24:
+                self._set_beared_off(self.turn, self.beared_off[self.turn] + 1)
             #Movement
             else:
-                if self.board[self._other_player(), move.dst] == 1:
-                    self.bar[self._other_player()] += 1
-                    self.board[self._other_player(), move.dst] = 0
-                self.board[self.turn, move.dst] += 1
-            self._piece_moves_left.remove(move.n)
-            if len(self._piece_moves_left) == 0:
+                if self.board[self._other_player()][dst] == 1:
+                    self._set_bar(self._other_player(), self.bar[self._other_player()] + 1)
+                    self._set_board(self._other_player(), dst, 0)
+                self._set_board(self.turn, dst, self.board[self.turn][dst] + 1)
+            self._use_piece_move(MOVE_N[code])
+            if self._n_piece_moves_left == 0:
                 self._goto_next_turn()
             else:
-                self.generate_movement_moves()
-                if len(self.legal_moves) == 0:
+                self._generate_movement_moves()
+                if self._n_legal_moves == 0:
                     self._goto_next_turn()
 
-    cdef void _goto_next_turn(self):
-        self.check_for_winner()
-        if not self.game_ended():
-            self.turn = BLACK if self.turn == WHITE else WHITE
-            self.set_nature_turn(True)
-            self._piece_moves_left = []
-            self.generate_nature_moves()
+    cdef void _goto_next_turn(self) noexcept nogil:
+        self._check_for_winner()
+        if self.winner == NONE:
+            self._set_turn(BLACK if self.turn == WHITE else WHITE)
+            self._set_nature_turn(True)
+            self._clear_piece_moves()
+            self._generate_nature_moves()
             if self.turn == WHITE:
                 self.turn_number += 1
 
@@ -341,35 +1216,48 @@ cdef class State:
         return self.winner != NONE
 
     cpdef bint check_for_winner(self):
-        if self.n_beared_off_pieces(self.turn) == 15:
+        self._check_for_winner()
+
+    cdef void _check_for_winner(self) noexcept nogil:
+        if self.beared_off[self.turn] == 15:
             self.winner = self.turn
 
     cpdef signed char n_pieces_on_bar(self, int player):
         return self.bar[player]
 
     cpdef signed char n_pieces_on_board(self, int player):
-        return np.sum(self.board[player]) + self.bar[player]
+        cdef int i
+        cdef signed char n = self.bar[player]
+        for i in range(24):
+            n += self.board[player][i]
+        return n
 
     cpdef signed char n_beared_off_pieces(self, int player):
         return self.beared_off[player]
 
     cpdef void generate_pre_game_2d6_moves(self):
-        self.legal_moves = self.get_roll_2d6_moves()
+        self.generate_nature_moves()
 
     cpdef void generate_nature_moves(self):
         """Generates all possible rollings of a 2d6 as the possible legal moves"""
-        self.legal_moves = self.get_roll_2d6_moves()
+        self._generate_nature_moves()
+
+    cdef void _generate_nature_moves(self) noexcept nogil:
+        cdef int code
+        for code in range(N_ROLL_MOVES):
+            self._legal_moves[code] = code
+        self._n_legal_moves = N_ROLL_MOVES
+
+    cpdef list get_chance_moves(self):
+        """Returns the distinct outcomes of a nature turn as a list of (move, probability) pairs. Once the game has started
+        the order of the dice does not matter so the 21 distinct rolls are returned, before that all 36 are"""
+        cdef int code
+        cdef double p
+        if self.has_game_started():
+            return [(MOVES[code], p) for (code, p) in DISTINCT_ROLLS]
+        else:
+            return [(MOVES[code], 1.0 / N_ROLL_MOVES) for code in range(N_ROLL_MOVES)]
 
     cpdef list get_roll_2d6_moves(self):
         """Generates all possible rollings of a 2d6."""
-        cdef int i, j
-        cdef Move move
-        cdef list moves = []
-        for i in range(1, 7):
-            for j in range(1, 7):
-                move = Move()
-                move.i = i
-                move.j = j
-                move.is_movement_move = False
-                moves.append(move)
-        return moves
+        return MOVES[:N_ROLL_MOVES]
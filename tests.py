@@ -1,11 +1,24 @@
 from constants import WHITE, BLACK, NONE
-from mcts import get_mcts_move
-from state import State
+from bearoff import BearoffDatabase, generate_bearoff_database
+from mcts import get_mcts_move, MCTSSearcher, TranspositionTable, DefaultPolicy, get_linear_default_policy
+from state import State, Move, Play, LinearWeights, get_move, get_play, get_movement_move, get_roll_move, load_linear_weights, play_batch_to_end, encode_states, decode_states
+from utils import state_to_vector, states_to_matrix, positions_to_matrix
+from function_approximation import fit_least_squares, generate_dataset, load_dataset
 import copy
+import json
+import pickle
 import numpy as np
+import os.path
 import random
+import tempfile
 import unittest
 
+try:
+    import agent_evaluation
+except ImportError:
+    #agent_evaluation rates agents with the elo package
+    agent_evaluation = None
+
 def to_tuple(move):
     if move.is_movement_move:
         return (move.src, move.dst, move.n)
@@ -15,6 +28,13 @@ def to_tuple(move):
 def get_moves(state):
     return [to_tuple(move) for move in state.get_moves()]
 
+if agent_evaluation is not None:
+    class BackAgent(agent_evaluation.Agent):
+        """Always moves the piece nearest to home, which loses to random moves most of the time"""
+        def get_move(self, state):
+            moves = state.get_moves()
+            return min(moves, key=lambda m: m.src) if state.get_player_turn() == WHITE else max(moves, key=lambda m: m.src)
+
 class TestMCTS(unittest.TestCase):
     def test_nocrash(self):
         random.seed(1)
@@ -49,6 +69,193 @@ class TestMCTS(unittest.TestCase):
         self.better_than_random(WHITE)
         self.better_than_random(BLACK)
 
+    def test_return_value(self):
+        random.seed(1)
+        state = State()
+        for _ in range(3):
+            (white_value, black_value) = get_mcts_move(state, 10.0, return_value=True, max_rollouts=500)
+            self.assertAlmostEqual(white_value + black_value, 1.0)
+            self.assertGreaterEqual(white_value, 0.0)
+            self.assertLessEqual(white_value, 1.0)
+            state.do_move(random.choice(state.get_moves()))
+
+    def test_root_parallel(self):
+        random.seed(3)
+        state = State()
+        while state.is_nature_turn():
+            state.do_move(random.choice(state.get_moves()))
+        move = get_mcts_move(state, 10.0, max_rollouts=200, workers=2)
+        self.assertIn(move, state.get_moves())
+        (white_value, black_value) = get_mcts_move(state, 10.0, return_value=True, max_rollouts=200, workers=2)
+        self.assertAlmostEqual(white_value + black_value, 1.0)
+
+    def test_tree_parallel(self):
+        random.seed(4)
+        state = State()
+        while state.is_nature_turn():
+            state.do_move(random.choice(state.get_moves()))
+        move = get_mcts_move(state, 10.0, max_rollouts=500, threads=4)
+        self.assertIn(move, state.get_moves())
+        (white_value, black_value) = get_mcts_move(state, 10.0, return_value=True, max_rollouts=500, threads=4)
+        self.assertAlmostEqual(white_value + black_value, 1.0)
+
+    def test_searcher_reuses_tree(self):
+        random.seed(5)
+        searcher = MCTSSearcher()
+        state = State()
+        while not state.game_ended():
+            if state.is_nature_turn():
+                state.do_move(random.choice(state.get_moves()))
+                continue
+            turn = state.get_player_turn()
+            move = searcher.get_move(state, 10.0, max_rollouts=300)
+            self.assertIn(move, state.get_moves())
+            state.do_move(move)
+            if not state.is_nature_turn() and state.get_player_turn() == turn:
+                #The position after our own move is already in the tree, so no rollouts are needed to value it
+                (white_value, black_value) = searcher.get_value(state, 10.0, max_rollouts=0)
+                self.assertAlmostEqual(white_value + black_value, 1.0)
+                break
+        else:
+            self.fail("No position was reused")
+
+    def test_transposition_table(self):
+        random.seed(6)
+        state = State()
+        while state.is_nature_turn():
+            state.do_move(random.choice(state.get_moves()))
+        table = TranspositionTable(1 << 12)
+        move = get_mcts_move(state, 10.0, max_rollouts=300, transposition_table=table)
+        self.assertIn(move, state.get_moves())
+        self.assertEqual(table.get(state)[0], 300)
+
+    def test_multiple_playouts(self):
+        random.seed(7)
+        state = State()
+        while state.is_nature_turn():
+            state.do_move(random.choice(state.get_moves()))
+        for policy in [DefaultPolicy(8), get_linear_default_policy(10, 8)]:
+            (white_value, black_value) = get_mcts_move(state, 10.0, return_value=True, max_rollouts=100, default_policy=policy)
+            self.assertAlmostEqual(white_value + black_value, 1.0)
+            (white_value, black_value) = policy(state)
+            self.assertAlmostEqual(white_value + black_value, 1.0)
+
+    def test_seed_is_reproducible(self):
+        random.seed(8)
+        state = State()
+        while state.is_nature_turn():
+            state.do_move(random.choice(state.get_moves()))
+        value = get_mcts_move(state, 10.0, return_value=True, max_rollouts=200, seed=1)
+        self.assertEqual(value, get_mcts_move(state, 10.0, return_value=True, max_rollouts=200, seed=1))
+        self.assertNotEqual(value, get_mcts_move(state, 10.0, return_value=True, max_rollouts=200, seed=2))
+        values = [MCTSSearcher(seed=3).get_value(state, 10.0, max_rollouts=200) for _ in range(2)]
+        self.assertEqual(values[0], values[1])
+        searcher = pickle.loads(pickle.dumps(MCTSSearcher(seed=3, transposition_table=TranspositionTable(1 << 10))))
+        self.assertEqual(searcher.tree_size(), 0)
+        values = []
+        for _ in range(2):
+            searcher.reset(3)
+            values.append(searcher.get_value(state, 10.0, max_rollouts=50))
+        self.assertEqual(values[0], values[1])
+        #A pickled searcher continues the random stream where the original is
+        searcher.get_value(state, 10.0, max_rollouts=50)
+        copied = pickle.loads(pickle.dumps(searcher))
+        searcher.reset()
+        (move, statistics) = searcher.get_move(state, 10.0, max_rollouts=200, return_statistics=True)
+        (copied_move, copied_statistics) = copied.get_move(state, 10.0, max_rollouts=200, return_statistics=True)
+        self.assertEqual(copied_move, move)
+        self.assertEqual(copied_statistics.children, statistics.children)
+
+    def test_batched_leaves(self):
+        random.seed(9)
+        state = State()
+        while state.is_nature_turn():
+            state.do_move(random.choice(state.get_moves()))
+        for policy in [DefaultPolicy(), get_linear_default_policy(10, 2)]:
+            table = TranspositionTable(1 << 12)
+            move = get_mcts_move(state, 10.0, max_rollouts=250, default_policy=policy, batch_size=16, transposition_table=table)
+            self.assertIn(move, state.get_moves())
+            self.assertEqual(table.get(state)[0], 250)
+            (white_value, black_value) = get_mcts_move(state, 10.0, return_value=True, max_rollouts=100, default_policy=policy, batch_size=16)
+            self.assertAlmostEqual(white_value + black_value, 1.0)
+        self.assertRaises(ValueError, get_mcts_move, state, 10.0, max_rollouts=10, batch_size=0)
+
+    def test_stop_at_race(self):
+        random.seed(13)
+        state = State()
+        for _ in range(100):
+            state.do_move(random.choice(state.get_moves()))
+        while state.is_nature_turn():
+            state.do_move(random.choice(state.get_moves()))
+        for policy in [DefaultPolicy(stop_at_race=True), get_linear_default_policy(10, stop_at_race=True)]:
+            move = get_mcts_move(state, 10.0, max_rollouts=200, default_policy=policy)
+            self.assertIn(move, state.get_moves())
+            (white_value, black_value) = pickle.loads(pickle.dumps(policy))(state)
+            self.assertAlmostEqual(white_value + black_value, 1.0)
+
+    def test_replay_moves(self):
+        random.seed(17)
+        state = State()
+        while state.is_nature_turn():
+            state.do_move(random.choice(state.get_moves()))
+        for policy in [DefaultPolicy(), get_linear_default_policy(10)]:
+            for batch_size in [1, 8]:
+                value = get_mcts_move(state, 10.0, return_value=True, max_rollouts=300, default_policy=policy, batch_size=batch_size, seed=1)
+                self.assertEqual(value, get_mcts_move(state, 10.0, return_value=True, max_rollouts=300, default_policy=policy, batch_size=batch_size, seed=1, store_states=False))
+        move = get_mcts_move(state, 10.0, max_rollouts=300, threads=2, store_states=False)
+        self.assertIn(move, state.get_moves())
+
+    def test_statistics(self):
+        random.seed(14)
+        state = State()
+        while state.is_nature_turn():
+            state.do_move(random.choice(state.get_moves()))
+        for workers in [1, 2]:
+            (move, statistics) = get_mcts_move(state, 10.0, max_rollouts=300, workers=workers, return_statistics=True)
+            self.assertEqual(statistics.rollouts, 300)
+            self.assertEqual(statistics.playouts, 300)
+            self.assertEqual(statistics.leaves, 300)
+            self.assertGreaterEqual(statistics.copies, 300)
+            self.assertGreater(statistics.nodes, 1)
+            self.assertGreaterEqual(statistics.max_depth, statistics.average_depth)
+            self.assertGreater(statistics.average_rollout_length, 0.0)
+            self.assertGreater(statistics.default_policy_time, 0.0)
+            self.assertEqual(sum(visits for (visits, _, _) in statistics.children.values()), 300)
+            self.assertEqual(max(statistics.children, key=lambda m: statistics.children[m][0]), move)
+            statistics = get_mcts_move(state, float('inf'), max_rollouts=10.5, workers=workers, batch_size=4, return_statistics=True)[1]
+            self.assertEqual(statistics.rollouts, 11)
+        searcher = MCTSSearcher(seed=4)
+        ((white_value, black_value), statistics) = searcher.get_value(state, 10.0, max_rollouts=100, return_statistics=True)
+        self.assertAlmostEqual(white_value + black_value, 1.0)
+        self.assertEqual(statistics.rollouts, 100)
+
+    def test_whole_turns(self):
+        random.seed(19)
+        state = State()
+        while state.is_nature_turn():
+            state.do_move(random.choice(state.get_moves()))
+        (play, statistics) = get_mcts_move(state, 10.0, max_rollouts=300, whole_turns=True, seed=1, return_statistics=True)
+        self.assertIn(play, state.get_turn_moves())
+        self.assertTrue(all(isinstance(child, Play) for child in statistics.children))
+        self.assertEqual(play, get_mcts_move(state, 10.0, max_rollouts=300, whole_turns=True, seed=1, store_states=False))
+        self.assertIn(get_mcts_move(state, 10.0, max_rollouts=100, whole_turns=True, workers=2), state.get_turn_moves())
+        searcher = pickle.loads(pickle.dumps(MCTSSearcher(whole_turns=True, seed=2)))
+        for _ in range(4):
+            if state.is_nature_turn():
+                state.do_move(random.choice(state.get_moves()))
+            else:
+                play = searcher.get_move(state, 10.0, max_rollouts=100)
+                self.assertIn(play, state.get_turn_moves())
+                state.do_turn(play)
+
+    def test_move_is_legal(self):
+        random.seed(2)
+        state = State()
+        while not state.game_ended():
+            move = get_mcts_move(state, 10.0, max_rollouts=50)
+            self.assertIn(move, state.get_moves())
+            state.do_move(move)
+
 class TestState(unittest.TestCase):
     """Application testing for the State class"""
     def assert_state(self, state: State):
@@ -205,6 +412,324 @@ class TestState(unittest.TestCase):
                 self.assert_state_action_next_state(state, move)
                 state.do_move(move)
 
+    def test_copy_is_independent(self):
+        random.seed(1)
+        state = State()
+        for _ in range(10):
+            state.do_move(random.choice(state.get_moves()))
+        board = state.get_board().copy()
+        next_state = copy.copy(state)
+        self.assertTrue(np.array_equal(next_state.get_board(), board))
+        self.assertEqual(get_moves(next_state), get_moves(state))
+        self.assertEqual(next_state.get_player_turn(), state.get_player_turn())
+        while not next_state.game_ended():
+            next_state.do_move(random.choice(next_state.get_moves()))
+        self.assertTrue(np.array_equal(state.get_board(), board))
+
+    def test_copy_from(self):
+        random.seed(2)
+        state = State()
+        for _ in range(10):
+            state.do_move(random.choice(state.get_moves()))
+        other = State()
+        other.copy_from(state)
+        self.assertTrue(np.array_equal(other.get_board(), state.get_board()))
+        self.assertTrue(np.array_equal(other.get_bar(), state.get_bar()))
+        self.assertTrue(np.array_equal(other.get_beared_off(), state.get_beared_off()))
+        self.assertEqual(get_moves(other), get_moves(state))
+        self.assertRaises(TypeError, other.copy_from, None)
+
+    def test_board_is_view(self):
+        state = State()
+        board = state.get_board()
+        del state
+        self.assertEqual(np.sum(board[WHITE]), 15)
+
+    def test_moves_are_interned(self):
+        random.seed(3)
+        state = State()
+        while not state.game_ended():
+            moves = state.get_moves()
+            for (move, code) in zip(moves, state.get_move_codes()):
+                self.assertIs(get_move(code), move)
+                self.assertEqual(move.code, code)
+                if move.is_movement_move:
+                    self.assertIs(get_movement_move(move.src, move.dst, move.n), move)
+                else:
+                    self.assertIs(get_roll_move(move.i, move.j), move)
+            self.assertEqual(len(set(moves)), len(moves))
+            state.do_move(random.choice(moves))
+        self.assertIs(copy.copy(get_roll_move(3, 5)), get_roll_move(3, 5))
+        self.assertIsNone(get_movement_move(5, 8, 2))
+        self.assertRaises(TypeError, Move)
+
+    def test_chance_moves(self):
+        random.seed(4)
+        state = State()
+        chance_moves = state.get_chance_moves()
+        self.assertEqual(len(chance_moves), 36)
+        while state.is_nature_turn():
+            state.do_move(random.choice(state.get_moves()))
+        while not state.is_nature_turn():
+            state.do_move(random.choice(state.get_moves()))
+        chance_moves = state.get_chance_moves()
+        self.assertEqual(len(chance_moves), 21)
+        self.assertAlmostEqual(sum(p for (_, p) in chance_moves), 1.0)
+        for (move, p) in chance_moves:
+            self.assertLessEqual(move.i, move.j)
+            self.assertAlmostEqual(p, (1.0 if move.i == move.j else 2.0) / 36)
+            self.assertIn(move, state.get_moves())
+
+    def test_hash_is_incremental(self):
+        for seed in range(1, 11):
+            random.seed(seed)
+            state = State()
+            while not state.game_ended():
+                #Unpickling computes the key from scratch
+                self.assertEqual(state.get_hash(), pickle.loads(pickle.dumps(state)).get_hash())
+                state.do_move(random.choice(state.get_moves()))
+
+    def test_hash_transpositions(self):
+        state = State()
+        state.do_move(get_roll_move(3, 1))
+        first = copy.copy(state)
+        first.do_move(get_movement_move(7, 4, 3))
+        first.do_move(get_movement_move(5, 4, 1))
+        second = copy.copy(state)
+        second.do_move(get_movement_move(5, 4, 1))
+        second.do_move(get_movement_move(7, 4, 3))
+        self.assertEqual(first.get_hash(), second.get_hash())
+        self.assertTrue(first.same_position(second))
+        self.assertNotEqual(state.get_hash(), first.get_hash())
+        self.assertEqual(first.position_key(), second.position_key())
+        self.assertNotEqual(state.position_key(), first.position_key())
+        self.assertEqual(state.position_key(), pickle.loads(pickle.dumps(state)).position_key())
+
+    def test_play_batch_to_end(self):
+        n_games = 1000
+        boards = np.repeat(State().get_board()[np.newaxis], n_games, axis=0)
+        bars = np.zeros((n_games, 2), dtype=np.int8)
+        beared_off = np.zeros((n_games, 2), dtype=np.int8)
+        turns = np.asarray([WHITE, BLACK] * (n_games // 2), dtype=np.int8)
+        #White has already borne off every piece in the last game
+        boards[-1, WHITE] = 0
+        beared_off[-1, WHITE] = 15
+        winners = play_batch_to_end(boards, bars, beared_off, turns, seed=1)
+        self.assertEqual(winners.shape, (n_games,))
+        self.assertTrue(np.all((winners == WHITE) | (winners == BLACK)))
+        self.assertEqual(winners[-1], WHITE)
+        ratio = np.mean(winners[:-1] == WHITE)
+        self.assertGreaterEqual(ratio, 0.40)
+        self.assertLessEqual(ratio, 0.60)
+        self.assertTrue(np.array_equal(winners, play_batch_to_end(boards, bars, beared_off, turns, seed=1)))
+        self.assertRaises(ValueError, play_batch_to_end, boards, bars[1:], beared_off, turns)
+
+    def test_linear_value_is_incremental(self):
+        random.seed(10)
+        weights = LinearWeights(np.random.RandomState(0).randn(52), 3.0)
+        for _ in range(5):
+            state = State()
+            state.set_linear_weights(weights)
+            while not state.game_ended():
+                state.do_move(random.choice(state.get_moves()))
+                expected = 3.0 + np.dot(np.asarray(state_to_vector(state))[0], weights.get_weights())
+                self.assertAlmostEqual(state.linear_value(), expected, places=6)
+            self.assertAlmostEqual(copy.copy(state).linear_value(), state.linear_value())
+            self.assertAlmostEqual(pickle.loads(pickle.dumps(state)).linear_value(), state.linear_value())
+        state.set_linear_weights(None)
+        self.assertRaises(ValueError, state.linear_value)
+        self.assertRaises(ValueError, LinearWeights, np.zeros(51))
+
+    def test_linear_weights_file(self):
+        weights = LinearWeights(np.arange(52), -1.5)
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "weights.npz")
+            weights.save(path)
+            loaded = load_linear_weights(path)
+            self.assertTrue(np.array_equal(loaded.get_weights(), weights.get_weights()))
+            self.assertEqual(loaded.intercept, -1.5)
+            policy = get_linear_default_policy(4, weights=path)
+            self.assertTrue(np.array_equal(policy.linear_weights.get_weights(), weights.get_weights()))
+
+    def test_undo_move(self):
+        random.seed(18)
+        state = State()
+        state.set_linear_weights(LinearWeights(np.arange(52) / 52.0, 0.5))
+        undos = []
+        encodings = []
+        while not state.game_ended():
+            for move in state.get_moves():
+                played = copy.copy(state)
+                played.undo_move(played.do_move(move))
+                self.assertEqual(played.to_bytes(), state.to_bytes())
+                self.assertEqual(played.get_hash(), state.get_hash())
+                self.assertEqual(played.get_move_codes(), state.get_move_codes())
+                self.assertEqual(played.linear_value(), state.linear_value())
+                self.assertEqual(played.pip_count(WHITE), state.pip_count(WHITE))
+                self.assertEqual(played.pip_count(BLACK), state.pip_count(BLACK))
+            encodings.append(state.to_bytes())
+            undos.append(state.do_move(random.choice(state.get_moves())))
+        while undos:
+            state.undo_move(undos.pop())
+            self.assertEqual(state.to_bytes(), encodings.pop())
+        self.assertTrue(state.same_position(State()))
+
+    def test_illegal_move_is_rejected(self):
+        state = State()
+        state.do_move(get_roll_move(3, 1))
+        encoding = state.to_bytes()
+        self.assertRaises(ValueError, state.do_move, get_movement_move(12, 6, 6))
+        self.assertRaises(ValueError, state.do_move, get_roll_move(3, 1))
+        for code in (-1, 5000, get_roll_move(3, 1).code, get_movement_move(12, 6, 6).code):
+            self.assertRaises(ValueError, state.do_move_code, code)
+        self.assertEqual(state.to_bytes(), encoding)
+        state.do_move_code(get_movement_move(7, 4, 3).code)
+        self.assertNotEqual(state.to_bytes(), encoding)
+        self.assertRaises(ValueError, get_move, -1)
+        self.assertRaises(ValueError, get_move, 306)
+
+    def test_turn_moves(self):
+        def turn_ends(state, moves):
+            #Every position the turn can end in by single moves, with the moves and the number of dice they used
+            for move in state.get_moves():
+                played = copy.copy(state)
+                played.do_move(move)
+                if played.is_nature_turn() or played.game_ended():
+                    yield (played.to_bytes(), moves + [move], 4 if played.game_ended() else len(moves) + 1)
+                else:
+                    yield from turn_ends(played, moves + [move])
+        random.seed(20)
+        for _ in range(3):
+            state = State()
+            while not state.game_ended():
+                if not state.is_nature_turn():
+                    ends = list(turn_ends(state, []))
+                    most_dice = max(used for (_, _, used) in ends)
+                    ends = [(position, moves) for (position, moves, used) in ends if used == most_dice]
+                    largest_die = max(moves[0].n for (_, moves) in ends)
+                    if most_dice == 1:
+                        ends = [(position, moves) for (position, moves) in ends if moves[0].n == largest_die]
+                    positions = []
+                    for play in state.get_turn_moves():
+                        self.assertEqual(get_play(play.code), play)
+                        self.assertEqual(Play(play.moves), play)
+                        played = copy.copy(state)
+                        played.do_turn(play)
+                        positions.append(played.to_bytes())
+                    self.assertEqual(len(set(positions)), len(positions))
+                    self.assertEqual(set(positions), {position for (position, _) in ends})
+                state.do_move(random.choice(state.get_moves()))
+        self.assertRaises(ValueError, State().get_turn_moves)
+        play = Play([get_movement_move(5, 2, 3), get_movement_move(2, 1, 1)])
+        self.assertEqual(pickle.loads(pickle.dumps(play)), play)
+        self.assertEqual(len(play), 2)
+        for code in ((1 << 63) | 7, 5, (1 << 63) | 1, 1 | (306 << 3)):
+            self.assertRaises(ValueError, get_play, code)
+        state = State()
+        state.do_move(get_roll_move(3, 1))
+        encoding = state.to_bytes()
+        self.assertRaises(ValueError, state.do_turn, Play([get_movement_move(5, 4, 1), get_movement_move(12, 6, 6)]))
+        self.assertRaises(ValueError, state.do_turn, Play([get_movement_move(7, 4, 3)]))
+        self.assertEqual(state.to_bytes(), encoding)
+        first = copy.copy(state)
+        first.do_turn(Play([get_movement_move(7, 4, 3), get_movement_move(5, 4, 1)]))
+        self.assertTrue(first.is_nature_turn())
+        state.do_turn(Play([get_movement_move(5, 4, 1), get_movement_move(7, 4, 3)]))
+        self.assertTrue(state.same_position(first))
+
+    def test_bytes_encoding(self):
+        random.seed(16)
+        states = []
+        state = State()
+        while not state.game_ended():
+            states.append(copy.copy(state))
+            state.do_move(random.choice(state.get_moves()))
+        states.append(state)
+        for state in states:
+            data = state.to_bytes()
+            self.assertEqual(len(data), 13)
+            decoded = State.from_bytes(data)
+            self.assertTrue(decoded.same_position(state))
+            self.assertEqual(decoded.get_hash(), state.get_hash())
+            if not state.game_ended():
+                self.assertEqual(decoded.get_move_codes(), state.get_move_codes())
+        packed = encode_states(states)
+        self.assertEqual(packed.shape, (len(states), 13))
+        for decoded in [decode_states(packed), decode_states(packed.tobytes())]:
+            self.assertTrue(all(a.same_position(b) for (a, b) in zip(decoded, states)))
+        self.assertRaises(ValueError, State.from_bytes, b"\xff" * 13)
+        self.assertRaises(ValueError, decode_states, b"\x00" * 14)
+        for bad in [None, (1, 2)]:
+            self.assertRaises(TypeError, encode_states, [states[0], bad])
+
+    def test_states_to_matrix(self):
+        random.seed(15)
+        states = []
+        state = State()
+        while not state.game_ended():
+            states.append(copy.copy(state))
+            state.do_move(random.choice(state.get_moves()))
+        x = states_to_matrix(states)
+        self.assertEqual(x.shape, (len(states), 52))
+        self.assertEqual(x.dtype, np.float32)
+        for (i, state) in enumerate(states):
+            self.assertTrue(np.array_equal(x[i], np.asarray(state_to_vector(state))[0]))
+        packed = positions_to_matrix([s.get_board() for s in states], [s.get_bar() for s in states], [s.get_beared_off() for s in states])
+        self.assertTrue(np.array_equal(x, packed))
+        self.assertEqual(states_to_matrix([]).shape, (0, 52))
+        for bad in [None, (1, 2), "state"]:
+            self.assertRaises(TypeError, state_to_vector, bad)
+            self.assertRaises(TypeError, states_to_matrix, [states[0], bad])
+
+    def test_fit_least_squares(self):
+        rng = np.random.default_rng(1)
+        x = rng.integers(0, 15, (2000, 52)).astype(np.float32)
+        weights = rng.normal(size=52)
+        fitted = fit_least_squares(x, x @ weights - 2.0)
+        self.assertTrue(np.allclose(fitted.get_weights(), weights))
+        self.assertAlmostEqual(fitted.intercept, -2.0)
+
+    def test_generate_dataset_resumes(self):
+        settings = {"positions_per_game": 3, "mcts_c": 0.25, "mcts_t": float('inf'), "max_rollouts": 10, "seed": 5}
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "complete.npy")
+            generate_dataset(path, 4, **settings)
+            complete = np.array(load_dataset(path))
+            #A run stopped while writing its third game leaves part of a record after the header's records
+            path = os.path.join(directory, "resumed.npy")
+            generate_dataset(path, 2, **settings)
+            with open(path, "ab") as f:
+                f.write(complete[-1:].tobytes()[:100])
+            self.assertEqual(generate_dataset(path, 4, **settings), len(complete))
+            self.assertEqual(np.array(load_dataset(path)).tobytes(), complete.tobytes())
+            for (name, value) in [("mcts_t", 1.0), ("seed", 6), ("max_rollouts", 20)]:
+                self.assertRaises(ValueError, generate_dataset, path, 6, **dict(settings, **{name: value}))
+            self.assertEqual(len(load_dataset(path)), len(complete))
+
+    def test_pips_and_race(self):
+        random.seed(12)
+        n_races = 0
+        for _ in range(20):
+            state = State()
+            while not state.game_ended():
+                state.do_move(random.choice(state.get_moves()))
+                board = state.get_board().astype(int)
+                bar = state.get_bar().astype(int)
+                self.assertEqual(state.pip_count(WHITE), sum((i + 1) * board[WHITE][i] for i in range(24)) + 25 * bar[WHITE])
+                self.assertEqual(state.pip_count(BLACK), sum((24 - i) * board[BLACK][i] for i in range(24)) + 25 * bar[BLACK])
+                white_points = [i for i in range(24) if board[WHITE][i] > 0]
+                black_points = [i for i in range(24) if board[BLACK][i] > 0]
+                is_race = bar[WHITE] == 0 and bar[BLACK] == 0 and (not white_points or not black_points or max(white_points) < min(black_points))
+                self.assertEqual(state.is_race(), is_race)
+                if is_race and state.is_nature_turn() and not state.game_ended():
+                    p = state.race_win_probability()
+                    self.assertTrue(0.0 <= p <= 1.0)
+                    played = copy.copy(state)
+                    self.assertEqual(played.play_game_to_end(stop_at_race=True), NONE)
+                    n_races += 1
+        self.assertGreater(n_races, 0)
+        self.assertRaises(ValueError, State().race_win_probability)
+
     def test_game_move_generation(self):
         state = State()
         #Test blue sky pre-game
@@ -287,5 +812,179 @@ class TestState(unittest.TestCase):
 
         #Test doubles pre-game
 
+class TestBearoff(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.TemporaryDirectory()
+        path = os.path.join(cls.directory.name, "bearoff.db")
+        generate_bearoff_database(path)
+        cls.database = BearoffDatabase(path)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.database = None
+        cls.directory.cleanup()
+
+    def test_distributions(self):
+        p = 11.0 / 36.0
+        distribution = self.database.get_distribution([1, 0, 0, 0, 0, 0])
+        self.assertAlmostEqual(distribution[1], p, places=4)
+        self.assertAlmostEqual(distribution[2], (1.0 - p) * p, places=4)
+        self.assertAlmostEqual(self.database.get_distribution([0, 0, 0, 0, 0, 1])[1], 17.0 / 36.0, places=4)
+        self.assertAlmostEqual(self.database.get_distribution([3, 0, 2, 0, 5, 5]).sum(), 1.0, places=6)
+        self.assertAlmostEqual(self.database.win_probability([1, 0, 0, 0, 0, 0], [1, 0, 0, 0, 0, 0]), p / (1.0 - (1.0 - p) ** 2), places=4)
+        self.assertGreater(self.database.win_probability([0, 0, 0, 0, 0, 1], [0, 0, 0, 0, 0, 2]), 0.75)
+        self.assertRaises(ValueError, self.database.get_distribution, [16, 0, 0, 0, 0, 0])
+
+    def test_state_stops_at_bearoff(self):
+        n_bearoffs = 0
+        for seed in range(1, 21):
+            random.seed(seed)
+            state = State()
+            while not state.game_ended():
+                if state.is_nature_turn() and state.has_game_started() and state.is_bearoff():
+                    white = [int(state.get_board()[WHITE][d]) for d in range(6)]
+                    black = [int(state.get_board()[BLACK][23 - d]) for d in range(6)]
+                    p = self.database.win_probability(white, black) if state.get_player_turn() == WHITE else 1.0 - self.database.win_probability(black, white)
+                    self.assertAlmostEqual(state.bearoff_win_probability(self.database), p)
+                    played = copy.copy(state)
+                    self.assertEqual(played.play_game_to_end(self.database), NONE)
+                    self.assertTrue(played.same_position(state))
+                    n_bearoffs += 1
+                    break
+                state.do_move(random.choice(state.get_moves()))
+        self.assertGreater(n_bearoffs, 0)
+        self.assertRaises(ValueError, State().bearoff_win_probability, self.database)
+
+    def test_policy(self):
+        random.seed(11)
+        state = State()
+        while state.is_nature_turn():
+            state.do_move(random.choice(state.get_moves()))
+        for policy in [DefaultPolicy(bearoff=self.database), get_linear_default_policy(10, bearoff=self.database.path)]:
+            move = get_mcts_move(state, 10.0, max_rollouts=100, default_policy=policy, workers=2)
+            self.assertIn(move, state.get_moves())
+            (white_value, black_value) = policy(state)
+            self.assertAlmostEqual(white_value + black_value, 1.0)
+
+@unittest.skipIf(agent_evaluation is None, "agent_evaluation needs the elo package")
+class TestAgentEvaluation(unittest.TestCase):
+    def tournament_agents(self):
+        return [agent_evaluation.RandomAgent("random"), BackAgent("back"), agent_evaluation.MCTSAgent("mcts", 0.25, float('inf'), max_rollouts=10)]
+
+    def read_log(self, path):
+        with open(path) as f:
+            return sorted([(r["game"], r["white"], r["black"], r["winner"], r["plies"]) for r in map(json.loads, f)])
+
+    def test_state_value_uses_rollout_budget(self):
+        state = State()
+        state.do_move(get_roll_move(3, 1))
+        for agent in [agent_evaluation.MCTSAgent("mcts", 0.25, 5.0, max_rollouts=50),
+                      agent_evaluation.MCTSLinearApproximationAgent("linear", 0.25, 5.0, 10, max_rollouts=50),
+                      agent_evaluation.MCTSAgent("mcts", 0.25, 5.0, workers=2, max_rollouts=50)]:
+            agent.setup(3)
+            value = agent.get_state_value(state)
+            agent.setup(3)
+            self.assertEqual(agent.get_state_value(state), value)
+
+    def test_tournament_workers(self):
+        with tempfile.TemporaryDirectory() as directory:
+            runs = []
+            for workers in [1, 2]:
+                path = os.path.join(directory, "{}.jsonl".format(workers))
+                tournament = agent_evaluation.Tournament(self.tournament_agents(), seed=5)
+                tournament.do_tournament(20, workers=workers, log_path=path)
+                runs.append((self.read_log(path), [float(rating) for rating in tournament.ratings], tournament.n_games_played))
+            self.assertEqual(len(runs[0][0]), 20)
+            self.assertEqual(runs[0], runs[1])
+
+    def test_pool_rejects_agents_with_workers(self):
+        agents = [BackAgent("back"), agent_evaluation.MCTSAgent("mcts", 0.25, float('inf'), workers=2, max_rollouts=10)]
+        self.assertRaises(ValueError, agent_evaluation.Tournament(agents, seed=5).do_tournament, 2, workers=2)
+        self.assertRaises(ValueError, agent_evaluation.play_match, agents[1], agents[0], max_games=2, workers=2)
+        self.assertRaises(ValueError, agent_evaluation.race, agents, workers=2)
+
+    def test_tournament_resumes(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "log.jsonl")
+            tournament = agent_evaluation.Tournament(self.tournament_agents(), seed=6)
+            tournament.do_tournament(20, log_path=path)
+            with open(path) as f:
+                lines = f.readlines()
+            #Keep the games in the order they finished, with the last one cut short as by a killed run
+            resumed_path = os.path.join(directory, "resumed.jsonl")
+            with open(resumed_path, "w") as f:
+                f.writelines(lines[:12])
+                f.write(lines[12][:len(lines[12]) // 2])
+            resumed = agent_evaluation.Tournament(self.tournament_agents(), seed=6)
+            resumed.do_tournament(20, log_path=resumed_path)
+            self.assertEqual([float(rating) for rating in resumed.ratings], [float(rating) for rating in tournament.ratings])
+            self.assertEqual(resumed.n_games_played, tournament.n_games_played)
+            records = []
+            with open(resumed_path) as f:
+                lines = f.readlines()
+            for line in lines:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    pass
+            #Only the games missing from the log were played again
+            self.assertEqual(len(lines), 21)
+            self.assertEqual(sorted(r["game"] for r in records), list(range(20)))
+            self.assertRaises(ValueError, agent_evaluation.Tournament(self.tournament_agents(), seed=7).do_tournament, 20, log_path=resumed_path)
+
+    def test_match_stops_early(self):
+        strong = agent_evaluation.MCTSAgent("mcts", 0.25, float('inf'), max_rollouts=50)
+        result = agent_evaluation.play_match(strong, BackAgent("back"), max_games=40, seed=0, sprt=agent_evaluation.SPRT(0, 200))
+        self.assertEqual(result["decision"], 1)
+        self.assertLess(result["wins"] + result["losses"], 40)
+        self.assertGreater(result["llr"], 0.0)
+        self.assertEqual(agent_evaluation.play_match(strong, BackAgent("back"), max_games=40, seed=0, workers=2, sprt=agent_evaluation.SPRT(0, 200)), result)
+        #Without a decision the match ends after max_games
+        result = agent_evaluation.play_match(agent_evaluation.RandomAgent("random"), BackAgent("back"), max_games=6, seed=0)
+        self.assertEqual(result["wins"] + result["losses"], 6)
+        self.assertIsNone(result["decision"])
+
+    def test_race(self):
+        agents = [BackAgent("back"), agent_evaluation.MCTSAgent("mcts", 0.25, float('inf'), max_rollouts=50), agent_evaluation.RandomAgent("random")]
+        ranking = agent_evaluation.race(agents, games_per_round=8, seed=0)
+        #The best agent comes first, followed by the agents in reverse order of elimination
+        self.assertEqual([str(agent) for (agent, _, _) in ranking], ["mcts", "random", "back"])
+        (_, wins, n_games) = ranking[0]
+        self.assertGreater(wins / n_games, 0.5)
+        #The agent dropped in the first round played no more games after it
+        self.assertLess(ranking[2][2], ranking[0][2])
+
+    def test_reference_store(self):
+        state = State()
+        state.do_move(get_roll_move(4, 2))
+        with tempfile.TemporaryDirectory() as directory:
+            store = agent_evaluation.ReferenceStore(os.path.join(directory, "values.db"))
+            self.assertIsNone(store.lookup(state))
+            store.add(state, 100, (0.6, 0.4))
+            self.assertEqual(store.lookup(copy.copy(state)), (100, (0.6, 0.4)))
+            #Adding to a stored value averages the two weighted by their rollouts
+            store.add(state, 300, (0.2, 0.8))
+            (rollouts, (white_value, black_value)) = store.lookup(state)
+            self.assertEqual(rollouts, 400)
+            self.assertAlmostEqual(white_value, 0.3)
+            self.assertAlmostEqual(black_value, 0.7)
+            self.assertIsNone(store.lookup(state, c=1.0))
+            self.assertIsNone(store.lookup(state, policy_name="other"))
+            #Enough rollouts are stored, so no search is made
+            (white_value, _) = store.get_value(state, 300)
+            self.assertAlmostEqual(white_value, 0.3)
+            other = State()
+            other.do_move(get_roll_move(6, 1))
+            (white_value, black_value) = store.get_value(other, 60)
+            self.assertAlmostEqual(white_value + black_value, 1.0)
+            self.assertEqual(store.lookup(other)[0], 60)
+            store.get_value(other, 100)
+            self.assertEqual(store.lookup(other)[0], 100)
+            copied = pickle.loads(pickle.dumps(store))
+            self.assertEqual(copied.lookup(state)[0], 400)
+            copied.close()
+            store.close()
+
 if __name__ == "__main__":
     unittest.main()
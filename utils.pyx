@@ -1,3 +1,4 @@
+from state cimport State, N_FEATURES
 from state import State
 cimport cython
 import numpy as np
@@ -5,11 +6,35 @@ import numpy as np
 @cython.wraparound(False)
 @cython.boundscheck(False)
 @cython.initializedcheck(False)
+cdef int _state_features(State state, float [::1] x) except -1:
+    """Writes the number of white's and then black's pieces on each point, the pieces of white and black on the bar and
+    the pieces white and black have borne off to x"""
+    cdef int player, point
+    if state is None:
+        raise TypeError("Expected a State, got None")
+    for player in range(2):
+        for point in range(24):
+            x[player * 24 + point] = state.board[player][point]
+        x[48 + player] = state.bar[player]
+        x[50 + player] = state.beared_off[player]
+    return 0
+
 cpdef float [:, :] state_to_vector(object state):
-    cdef float [:, ::1] board
-    cdef float [::1] bar, beared_off
+    cdef float [:, ::1] x = np.empty((1, N_FEATURES), dtype=np.float32)
+    _state_features(state, x[0])
+    return x
+
+def states_to_matrix(object states):
+    """Returns the features of state_to_vector of each of states as the rows of an (N, N_FEATURES) float32 matrix"""
+    cdef Py_ssize_t i, n = len(states)
+    cdef float [:, ::1] x = np.empty((n, N_FEATURES), dtype=np.float32)
+    for i in range(n):
+        _state_features(states[i], x[i])
+    return np.asarray(x)
 
-    board = np.asarray(state.get_board(), dtype=np.float32)
-    bar = np.asarray(state.get_bar(), dtype=np.float32)
-    beared_off = np.asarray(state.get_beared_off(), dtype=np.float32)
-    return np.reshape(np.concatenate([board[0], board[1], bar, beared_off], axis=0), (1, -1))
+def positions_to_matrix(object boards, object bars, object beared_off):
+    """Returns the features of state_to_vector of the positions packed as in play_batch_to_end: boards of shape (N, 2,
+    24), bars and beared_off of shape (N, 2)"""
+    boards = np.asarray(boards)
+    n = boards.shape[0]
+    return np.concatenate([boards.reshape(n, 48), np.asarray(bars).reshape(n, 2), np.asarray(beared_off).reshape(n, 2)], axis=1).astype(np.float32)